@@ -4,10 +4,24 @@ Command send to RCs.
 Usage:
   app [-h]
   app [-v]
-  app [-a <element>]
-  app [-u <element>]
-  app [-d <element>]
-  app [-f <filter>]
+  app [-a <element>] [--socket=<path>] [--profile]
+  app [-u <element>] [--socket=<path>] [--profile]
+  app [-d <element>] [--socket=<path>] [--profile]
+  app [-f <filter>] [--socket=<path>] [--format=<format>] [--columns=<names>] [--batch=<size>]
+                                                [--profile] [--explain]
+  app --advise=<log>
+  app --serve=<path> [--snapshot=<dir>] [--profile]
+  app --bulk=<file> [--batch=<size>] [--workers=<n>] [--profile]
+  app --settle=<settlement> [--socket=<path>] [--profile]
+  app --tree=<root> [--active] [--batch=<size>] [--profile]
+  app --rebuild-counts [--profile]
+  app --prune-changes=<seq> [--profile]
+  app --tail=<seq> [--follow] [--batch=<size>] [--profile]
+  app --ticks=<file> [--window=<ms>] [--profile]
+  app --record-history [--follow] [--profile]
+  app --prices=<query> [--profile]
+  app --export=<file> [--snapshot=<dir>] [--profile]
+  app --import=<file> [--profile]
 
 Options:
   -h --help                       Sports bet application:
@@ -31,6 +45,68 @@ Options:
 
   -f                              With serach filter conditions and all details in JSON format
 
+  --bulk=<file>                   Add all elements from a NDJSON file (one -a element per line), - for stdin
+
+  --batch=<size>                  Number of elements inserted per transaction in bulk mode,
+                                  number of rows fetched at once for search output and --tail [default: 500]
+
+  --workers=<n>                   Processes parsing the bulk input next to the single writer, 0 for one per
+                                  core [default: 1]
+
+  --settle=<settlement>           Give outcomes to the selections of an event or market and deactivate them
+                                  eg. {"event": 1, "outcomes": {"12": "win"}, "default": "lose"}
+
+  --tree=<root>                   Print a sport or an event with everything under it as nested JSON
+                                  eg. {"sport": 1}
+
+  --active                        With --tree leave out inactive events, markets and selections
+
+  --rebuild-counts                Recompute the active children counters of all sports, events and markets
+
+  --prune-changes=<seq>           Remove the changes up to a seq, once --tail consumers, columnar servers and the
+                                  price history have read them
+
+  --tail=<seq>                    Print the changes written after a seq as NDJSON, 0 for all of them
+
+  --follow                        With --tail keep printing new changes until Ctrl + C, with --record-history
+                                  keep recording new prices
+
+  --record-history                Record the price changes of the selections since the last run into the price
+                                  history directory
+
+  --prices=<query>                Print the price history of a selection within a time range as NDJSON, in bars
+                                  of an interval in seconds when given
+                                  eg. {"selection": 12, "from": 1700000000, "to": 1700003600, "interval": 60}
+
+  --ticks=<file>                  Apply selection price ticks, one "id price" or {"id": 1, "price": "1.85"} per line,
+                                  - for stdin
+
+  --window=<ms>                   Ticks of a selection within a window are coalesced to the last one and every
+                                  window is applied in one transaction [default: 100]
+
+  --serve=<path>                  Keep the database open and answer -a, -u, -d and -f requests on a unix socket
+
+  --socket=<path>                 Send the command to a server started with --serve instead of opening the database
+
+  --format=<format>               Stream search results to stdout as ndjson or csv
+
+  --columns=<names>               Comma separated columns of the search results to output eg. id,name
+
+  --export=<file>                 Copy the database to a file with the sqlite online backup API, writers keep going
+
+  --import=<file>                 Replace the database with a copy made by --export
+
+  --snapshot=<dir>                With --export also write a columnar snapshot of the copy, with --serve answer
+                                  filter searches from that snapshot, both need numpy
+
+  --explain                       With -f print the query plan of every statement the search runs, with the rows
+                                  sqlite will likely read, instead of the results
+
+  --advise=<log>                  Suggest indexes for the full table scans of the statements in a slow query log
+
+  --profile                       Print the SQL statements, their latencies, commits and rows of the command
+                                  as JSON on stderr, the server prints its totals when it stops
+
 
 
 """
@@ -41,17 +117,142 @@ from os.path import exists
 import sys
 from pathlib import Path
 import signal
+import socket
+import json
+import csv
 from docopt import docopt
+
+VERSION = 'App 1.0'
+
+# commands a server answers, with the argument holding their JSON
+SERVER_COMMANDS = {'-a': '<element>', '-u': '<element>',
+                   '-d': '<element>', '-f': '<filter>', '--settle': '--settle'}
+
+
+def send_command(path, args) -> dict:
+    """
+    It will forward the cli command to a server and give back its decoded reply,
+    an error reply when the server can not be reached or sends nothing back
+    """
+    flag = next(command for command in SERVER_COMMANDS if args[command])
+    request = {flag: args[SERVER_COMMANDS[flag]]}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except OSError as e:
+            return {'error': "no server on " + path + ": " + (e.strerror or str(e))}
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile('rb') as replies:
+            reply = replies.readline()
+    if not reply:
+        return {'error': "the server closed the connection without a reply"}
+    return json.loads(reply)
+
+
+def write_rows(keys, batches, output, output_format, columns=None) -> int:
+    """
+    It will write rows as they come, batch by batch, so memory does not grow with the result
+
+    Args:
+        keys ([list]): [column names of the rows]
+        batches ([iterable]): [lists of rows]
+        output ([file]): [eg. sys.stdout]
+        output_format ([str]): [ndjson or csv]
+        columns ([list]): [names of the columns to output, all when empty]
+
+    Raises:
+        [ValueError]: [for an unknown format or column]
+
+    Returns:
+        [int]: [number of rows written]
+    """
+    if output_format not in ('ndjson', 'csv'):
+        raise ValueError("unknown format " + str(output_format))
+
+    columns = columns or list(keys)
+    for column in columns:
+        if column not in keys:
+            raise ValueError("unknown column " + column +
+                             ", expected one of " + ", ".join(keys))
+    positions = [list(keys).index(column) for column in columns]
+
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(columns)
+
+    started = time.perf_counter()
+    count = 0
+    for rows in batches:
+        if output_format == 'csv':
+            writer.writerows([row[position] for position in positions] for row in rows)
+        else:
+            output.writelines(json.dumps(dict(zip(columns, [row[position] for position in positions])),
+                                         default=str) + "\n" for row in rows)
+        count += len(rows)
+
+    elapsed = time.perf_counter() - started
+    print(str(count) + " rows, " + str(round(count / elapsed) if elapsed else count) + " rows/sec",
+          file=sys.stderr)
+    return count
+
+
+def light_cli(args):
+    """
+    It will answer the commands which never touch the database, so they do not
+    pay for importing SQLAlchemy. -h and -v are answered by docopt itself.
+
+    Returns:
+        [tuple]: [True and the response when answered, otherwise False and None]
+    """
+    # a server keeps the database open, the client does not touch it
+    if args['--socket']:
+        reply = send_command(args['--socket'], args)
+        if args['--format'] and 'rows' in reply:
+            write_rows(reply['columns'], [reply['rows']], sys.stdout, args['--format'],
+                       args['--columns'] and args['--columns'].split(','))
+            if reply.get('cursor'):
+                print("next cursor " + reply['cursor'], file=sys.stderr)
+            return True, None
+
+        for row in reply.get('rows', []):
+            print(tuple(row))
+        return True, reply.get('response', reply.get('error', reply.get('cursor')))
+
+    return False, None
+
+
+if __name__ == "__main__":
+    # docopt prints help or version and exits
+    answered, response = light_cli(
+        docopt(__doc__, version=VERSION, help=True))
+    if answered:
+        if response is not None:
+            print(response)
+        sys.exit(0)
+
+# everything below needs the database
+import socketserver
+import threading
+import queue
 import re
-import json
-from sqlalchemy import create_engine, Column, Table, Column, Integer, String, MetaData, ForeignKey, text, delete, update
+import functools
+import bisect
+import base64
+import sqlite3
+import multiprocessing
+import collections
+import itertools
+from collections import OrderedDict
+from sqlalchemy import create_engine, Column, Table, Column, Integer, String, MetaData, ForeignKey, text, delete, update, insert, select, bindparam, union_all, literal, literal_column, and_, func, event
+from sqlalchemy.engine import Engine, CursorResult
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session, relationship, session
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 # Use the default method for abstracting classes to tables
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.schema import UniqueConstraint
-from sqlalchemy.sql.sqltypes import DECIMAL, Boolean
+from sqlalchemy.sql.sqltypes import DECIMAL, Boolean, Float
 from sqlalchemy import inspect, Index
 
 
@@ -69,8 +270,12 @@ class Sport(Base):
     slug = Column(String(255), nullable=False, unique=True)
     order = Column(Integer)
     active = Column(Boolean, default=False)
+    # number of active events
+    active_children = Column(Integer, nullable=False,
+                             default=0, server_default='0')
     __table_args__ = (UniqueConstraint(
-        'name', 'display_name', 'slug', name='_sports_uc'),)
+        'name', 'display_name', 'slug', name='_sports_uc'),
+        Index('sportactivechildrenindex', 'active_children'))
 
 
 class Event(Base):
@@ -85,7 +290,13 @@ class Event(Base):
     status = Column(Integer)
     slug = Column(String(255), nullable=False, unique=True)
     active = Column(Boolean, default=False)
-    __table_args__ = (UniqueConstraint('name', 'slug', name='_events_uc'),)
+    # number of active markets of the event ie. active market events
+    active_children = Column(Integer, nullable=False,
+                             default=0, server_default='0')
+    __table_args__ = (UniqueConstraint('name', 'slug', name='_events_uc'),
+                      Index('eventactivechildrenindex', 'active_children'),
+                      # events of a sport and its active ones
+                      Index('eventsportactiveindex', 'sport_id', 'active'))
 
 
 class Market(Base):
@@ -100,8 +311,12 @@ class Market(Base):
     active = Column(Boolean, default=False)
     schema = Column(Integer, nullable=False)
     columns = Column(Integer)
+    # number of active selections over all events
+    active_children = Column(Integer, nullable=False,
+                             default=0, server_default='0')
     __table_args__ = (UniqueConstraint(
-        'name', 'display_name', name='_markets_uc'),)
+        'name', 'display_name', name='_markets_uc'),
+        Index('marketactivechildrenindex', 'active_children'))
 
 
 class MarketEvent(Base):
@@ -113,6 +328,12 @@ class MarketEvent(Base):
     market_id = Column(Integer, ForeignKey('markets.id'))
     event_id = Column(Integer, ForeignKey('events.id'))
     active = Column(Boolean, default=False)
+    # number of active selections
+    active_children = Column(Integer, nullable=False,
+                             default=0, server_default='0')
+    # one market event per pair, also serves the market side
+    __table_args__ = (Index('marketeventpairindex', 'market_id', 'event_id', unique=True),
+                      Index('marketeventeventactiveindex', 'event_id', 'active'))
 
 
 class Selection(Base):
@@ -126,7 +347,27 @@ class Selection(Base):
     name = Column(String(255), nullable=False, unique=True)
     outcome = Column(Integer)
     active = Column(Boolean, default=False)
-    __table_args__ = (UniqueConstraint('name', name='_selections_uc'),)
+    __table_args__ = (UniqueConstraint('name', name='_selections_uc'),
+                      Index('selectionmarketeventactiveindex', 'marketevent_id', 'active'))
+
+
+class Change(Base):
+    """
+    This class will keep one row for every written row of the element tables, in write order
+    """
+    __tablename__ = 'changes'
+    seq = Column(Integer, primary_key=True)
+    # table of the written row
+    element = Column(String(32), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    # i, u or d
+    op = Column(String(1), nullable=False)
+    # JSON of the inserted row, of the id and changed columns of an update, NULL for deletes
+    data = Column(String)
+    # unix time of the write in seconds, to the millisecond
+    at = Column(Float)
+    # seq is never handed out again, even after prune_changes() removed old changes
+    __table_args__ = {'sqlite_autoincrement': True}
 
 
 def is_json(myjson):
@@ -154,6 +395,235 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
+# pragmas applied to every new sqlite connection, chosen with APP_DB_PROFILE or the config file
+SQLITE_PROFILES = {
+    # sqlite defaults: rollback journal, full sync, readers block the writer
+    'default': {},
+    'safe': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000},
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 268435456,
+             'cache_size': -65536, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+}
+
+DB_CONFIG_DEFAULTS = {'url': 'sqlite:///app.sqlite', 'profile': 'default',
+                      'pragmas': {}, 'read_only_search': False, 'columnar_search': False,
+                      'metrics_file': None, 'slow_query_ms': None, 'slow_query_log': 'slow_queries.ndjson',
+                      'price_history': None}
+
+
+def load_db_config() -> dict:
+    """
+    It will read the database settings from the JSON file named by APP_DB_CONFIG,
+    then let APP_DB_URL, APP_DB_PROFILE, APP_DB_READ_ONLY_SEARCH, APP_METRICS_FILE,
+    APP_SLOW_QUERY_MS and APP_PRICE_HISTORY override them
+
+    {"url": "sqlite:///app.sqlite", "profile": "fast", "pragmas": {"cache_size": -20000}, "read_only_search": true}
+    """
+    config = dict(DB_CONFIG_DEFAULTS)
+    if os.environ.get('APP_DB_CONFIG'):
+        with open(os.environ['APP_DB_CONFIG']) as config_file:
+            config.update(json.load(config_file))
+
+    config['url'] = os.environ.get('APP_DB_URL', config['url'])
+    config['profile'] = os.environ.get('APP_DB_PROFILE', config['profile'])
+    config['metrics_file'] = os.environ.get(
+        'APP_METRICS_FILE', config['metrics_file'])
+    config['price_history'] = os.environ.get(
+        'APP_PRICE_HISTORY', config['price_history'])
+    if os.environ.get('APP_SLOW_QUERY_MS'):
+        config['slow_query_ms'] = float(os.environ['APP_SLOW_QUERY_MS'])
+    if 'APP_DB_READ_ONLY_SEARCH' in os.environ:
+        config['read_only_search'] = os.environ['APP_DB_READ_ONLY_SEARCH'] not in (
+            '', '0', 'false')
+
+    if config['profile'] not in SQLITE_PROFILES:
+        raise ValueError("unknown profile " + config['profile'] +
+                         ", expected one of " + ", ".join(SQLITE_PROFILES))
+    return config
+
+
+def get_engine(config=None, read_only=False, instrumentation=None, **kwargs):
+    """
+    It will create the engine of the configured database with the pragmas of its profile
+
+    Args:
+        config ([dict]): [settings as given by load_db_config()]
+        read_only ([bool]): [open the file read only eg. for search, it never takes the write lock]
+        instrumentation ([Instrumentation]): [counts the statements of the engine]
+        kwargs: [passed to create_engine]
+    """
+    config = config or load_db_config()
+    pragmas = dict(SQLITE_PROFILES[config['profile']], **config['pragmas'])
+
+    url = config['url']
+    if read_only:
+        # the journal mode can only be changed by a writer
+        pragmas.pop('journal_mode', None)
+        pragmas['query_only'] = 1
+        path = url[len('sqlite:///'):]
+        url = 'sqlite:///file:' + path + '?mode=ro&uri=true'
+
+    engine = create_engine(url, **kwargs)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA " + pragma + " = " + str(value))
+        cursor.close()
+
+    if instrumentation is not None:
+        instrumentation.attach(engine)
+    return engine
+
+
+# upper bounds of the statement latency histogram
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500)
+
+
+class Instrumentation:
+    """
+    This class will count the SQL statements of the engines it is attached to, their
+    latencies, failures, commits and rows touched, per command and in total
+
+    Args:
+        path ([str]): [metrics file, every command is appended to it as one JSON line]
+        slow_ms ([float]): [statements taking at least this long are appended to the slow log]
+        slow_log ([str]): [slow query log, one JSON line per statement with its parameters]
+    """
+
+    def __init__(self, path=None, slow_ms=None, slow_log='slow_queries.ndjson'):
+        self.path = path
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.commands = 0
+        self.current = self.counters()
+        self.totals = self.counters()
+        self.started = time.perf_counter()
+
+    @staticmethod
+    def counters() -> dict:
+        labels = ["<=" + str(bound) for bound in LATENCY_BUCKETS_MS]
+        return {'statements': 0, 'by_kind': {}, 'sql_ms': 0.0, 'slowest_ms': 0.0, 'errors': 0, 'commits': 0,
+                'rollbacks': 0, 'rows': 0, 'latency_ms': dict.fromkeys(labels + [">" + str(LATENCY_BUCKETS_MS[-1])], 0)}
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+        event.listen(engine, "handle_error", self.on_error)
+        event.listen(engine, "commit", self.on_commit)
+        event.listen(engine, "rollback", self.on_rollback)
+        return engine
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count(conn, statement, parameters, executemany, cursor.rowcount)
+
+    def on_error(self, context):
+        # a failed statement never reaches after_execute, its start is taken here
+        if context.connection is None or not context.connection.info.get('statement_started'):
+            return
+        executemany = bool(context.execution_context and context.execution_context.executemany)
+        message = str(context.original_exception).splitlines()
+        self.count(context.connection, context.statement or '', context.parameters, executemany, -1,
+                   message[0] if message else type(context.original_exception).__name__)
+
+    def count(self, conn, statement, parameters, executemany, rowcount, error=None):
+        """
+        It will add a statement that ended, or failed with an error, to the counters
+        and the slow log
+        """
+        elapsed = (time.perf_counter() -
+                   conn.info['statement_started'].pop()) * 1000
+        words = statement.split(None, 1)
+        kind = words[0].lower() if words else 'other'
+
+        counters = self.current
+        counters['statements'] += 1
+        counters['by_kind'][kind] = counters['by_kind'].get(kind, 0) + 1
+        counters['sql_ms'] += elapsed
+        counters['slowest_ms'] = max(counters['slowest_ms'], elapsed)
+        if error is not None:
+            counters['errors'] += 1
+        # rows written, sqlite gives -1 for selects
+        if rowcount > 0:
+            counters['rows'] += rowcount
+        labels = list(counters['latency_ms'])
+        counters['latency_ms'][labels[bisect.bisect_left(
+            LATENCY_BUCKETS_MS, elapsed)]] += 1
+
+        if self.slow_ms is not None and elapsed >= self.slow_ms:
+            entry = {'at': round(time.time(), 3), 'ms': round(elapsed, 3), 'statement': statement,
+                     # the first rows of an executemany are enough to explain it
+                     'parameters': list(parameters[:10]) if executemany else parameters,
+                     'executemany': executemany}
+            if error is not None:
+                entry['error'] = error
+            with open(self.slow_log, 'a') as log:
+                log.write(json.dumps(entry, default=str) + "\n")
+
+    def on_commit(self, conn):
+        self.current['commits'] += 1
+
+    def on_rollback(self, conn):
+        self.current['rollbacks'] += 1
+
+    def end_command(self, name) -> dict:
+        """
+        It will close the counters of a command, add them to the totals and the metrics file
+
+        Returns:
+            [dict]: [counters of the command with its name, time and duration]
+        """
+        record = dict(self.current, command=name, at=round(time.time(), 3),
+                      ms=round((time.perf_counter() - self.started) * 1000, 3),
+                      sql_ms=round(self.current['sql_ms'], 3), slowest_ms=round(self.current['slowest_ms'], 3))
+
+        self.commands += 1
+        for key, value in self.current.items():
+            if isinstance(value, dict):
+                for name_, count in value.items():
+                    self.totals[key][name_] = self.totals[key].get(name_, 0) + count
+            elif key == 'slowest_ms':
+                self.totals[key] = max(self.totals[key], value)
+            else:
+                self.totals[key] += value
+
+        if self.path:
+            with open(self.path, 'a') as metrics:
+                metrics.write(json.dumps(record) + "\n")
+
+        self.current = self.counters()
+        self.started = time.perf_counter()
+        return record
+
+    def report(self) -> dict:
+        """
+        It will give the totals of all commands
+        """
+        return dict(self.totals, commands=self.commands, sql_ms=round(self.totals['sql_ms'], 3),
+                    slowest_ms=round(self.totals['slowest_ms'], 3))
+
+
+def command_name(args) -> str:
+    """
+    It will name a command for the metrics eg. "-a selection", "-f event" or "--bulk"
+    """
+    for flag, argument in SERVER_COMMANDS.items():
+        if args.get(flag):
+            try:
+                element = json.loads(args[argument])
+                return flag + " " + str(element.get('on') or next(iter(element)))
+            except (AttributeError, TypeError, ValueError, StopIteration):
+                return flag
+    for option in ('--serve', '--bulk', '--ticks', '--tail', '--tree', '--advise', '--export', '--import',
+                   '--rebuild-counts', '--prune-changes', '--record-history', '--prices'):
+        if args.get(option):
+            return option
+    return "none"
+
+
 def save_into_db(session, object) -> int:
     """
     It will save into database table
@@ -171,44 +641,383 @@ def save_into_db(session, object) -> int:
     return object.id
 
 
-def finds(session, obj, condition) -> String:
+@functools.lru_cache(maxsize=None)
+def lookup_statement(model, *fields, limit=None):
     """
-    It will query and find all matched results
+    It will build a select of one element table by some of its fields with bound parameters
+
+    Statements are built once per model and fields, so SQLAlchemy compiles each of them
+    once and sqlite finds the same SQL in its prepared statement cache on every call.
     """
-    try:
-        result = session.query(obj).filter(text(condition)).all()
+    table = model.__table__
+    stmt = select(table).where(
+        and_(*[table.c[field] == bindparam(field) for field in fields]))
+    if limit:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def get_by_id(conn, model, row_id):
+    """
+    It will find one element by id
 
-    except MultipleResultsFound as e:
-        print(e)
-        # Deal with it
-    except NoResultFound as e:
-        print(e)
-        # Deal with that as well
+    Raises:
+        [ValueError]: [when the id is not a number]
 
-    return result
+    Returns:
+        [Row]: [the element, None when missing]
+    """
+    return conn.execute(lookup_statement(model, 'id'), {'id': int(row_id)}).first()
 
 
-def find(session, obj, condition, join_obj=None) -> String:
+def get_marketevent(conn, market_id, event_id):
     """
-    It will query and find one
+    It will find the market event of a market and an event, None when missing
     """
-    result = None
-    try:
-        if not join_obj:
-            result = session.query(obj).filter(
-                text(condition)).one_or_none()
+    return conn.execute(lookup_statement(MarketEvent, 'market_id', 'event_id'),
+                        {'market_id': int(market_id), 'event_id': int(event_id)}).first()
+
+
+def get_children(conn, model, parent_field, parent_id, limit=None) -> list:
+    """
+    It will find the elements of a parent eg. get_children(conn, Event, 'sport_id', 1)
+    """
+    return conn.execute(lookup_statement(model, parent_field, limit=limit),
+                        {parent_field: int(parent_id)}).fetchall()
+
+
+# number of ids kept by the hierarchy cache of each connection
+HIERARCHY_CACHE_SIZE = 10000
+
+
+class HierarchyCache:
+    """
+    This class will remember the parents of market events and events, LRU bounded
+
+    Keys are ('pair', market_id, event_id) -> marketevent id, ('marketevent', id) -> (market_id, event_id)
+    and ('event', id) -> sport_id. These never change once written, so only deletes
+    invalidate them. Only ids of committed rows go in, a rolled back insert can hand
+    its id out again. Writes from another process that delete market events are not seen.
+    """
+
+    def __init__(self, maxsize=HIERARCHY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def put_marketevent(self, marketevent_id, market_id, event_id):
+        self.put(('pair', int(market_id), int(event_id)), marketevent_id)
+        self.put(('marketevent', marketevent_id), (int(market_id), int(event_id)))
+
+    def forget_marketevent(self, marketevent_id, market_id, event_id):
+        self.entries.pop(('pair', int(market_id), int(event_id)), None)
+        self.entries.pop(('marketevent', marketevent_id), None)
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0}
+
+
+def hierarchy_cache(conn) -> HierarchyCache:
+    """
+    It will give the hierarchy cache of a connection, it lives as long as the sqlite connection
+    """
+    if 'hierarchy_cache' not in conn.info:
+        conn.info['hierarchy_cache'] = HierarchyCache()
+    return conn.info['hierarchy_cache']
+
+
+# tables keeping a counter of their active children
+COUNTER_MODELS = (Sport, Event, Market, MarketEvent)
+
+
+def add_active_counters(conn):
+    """
+    It will add the active children counters and their indexes to the tables made before them
+    """
+    inspector = inspect(conn)
+    upgraded = False
+    for model in COUNTER_MODELS:
+        columns = [column['name']
+                   for column in inspector.get_columns(model.__tablename__)]
+        if 'active_children' not in columns:
+            conn.execute(text("ALTER TABLE " + model.__tablename__ +
+                         " ADD COLUMN active_children INTEGER NOT NULL DEFAULT 0"))
+            upgraded = True
+
+    if upgraded:
+        rebuild_counts(conn)
+
+    # counter indexes serve the active threshold search
+    create_indexes(conn, *[index for model in COUNTER_MODELS for index in model.__table__.indexes
+                           if index.name.endswith('activechildrenindex')])
+
+
+def add_change_data(conn):
+    """
+    It will give the changes table the written row and make its triggers again
+    """
+    if 'data' not in [column['name'] for column in inspect(conn).get_columns('changes')]:
+        conn.execute(text("ALTER TABLE changes ADD COLUMN data TEXT"))
+    create_change_log(conn)
+
+
+def add_change_times(conn):
+    """
+    It will give the changes table the time of the write and make its triggers again
+    """
+    if 'at' not in [column['name'] for column in inspect(conn).get_columns('changes')]:
+        conn.execute(text("ALTER TABLE changes ADD COLUMN at REAL"))
+    create_change_log(conn)
+
+
+# single column indexes once created by hand, names are unique anyway and
+# the active ones are served by the composite indexes
+LEGACY_INDEXES = ('sportnameindex', 'sportdisplaynameindex', 'sportactiveindex', 'sportslugindex',
+                  'eventnameindex', 'eventslugindex', 'eventactiveindex', 'marketnameindex',
+                  'marketdisplaynameindex', 'marketeventindex', 'selectionnameindex', 'selectionactiveindex')
+
+
+def add_hierarchy_indexes(conn):
+    """
+    It will index the parent lookups of the hierarchy and make market event pairs unique,
+    merging the market events of a pair added twice into the oldest one
+    """
+    duplicates = conn.execute(text("select me.id, pair.kept from marketevents me inner join \
+        (select market_id, event_id, min(id) as kept from marketevents group by market_id, event_id \
+        having count(*) > 1) pair on pair.market_id = me.market_id and pair.event_id = me.event_id \
+        where me.id > pair.kept")).fetchall()
+    if duplicates:
+        conn.execute(update(Selection.__table__).where(Selection.marketevent_id == bindparam('duplicate'))
+                     .values(marketevent_id=bindparam('kept')),
+                     [{'duplicate': duplicate, 'kept': kept} for duplicate, kept in duplicates])
+        conn.execute(delete(MarketEvent.__table__).where(MarketEvent.id == bindparam('duplicate')),
+                     [{'duplicate': duplicate} for duplicate, kept in duplicates])
+        rebuild_counts(conn)
+
+    drop_indexes(conn, *LEGACY_INDEXES)
+    create_indexes(conn, Event.__table__.indexes, MarketEvent.__table__.indexes,
+                   Selection.__table__.indexes)
+
+
+def create_indexes(conn, *indexes):
+    """
+    It will create the indexes which do not exist yet, sets of indexes are flattened
+    """
+    for index in indexes:
+        if isinstance(index, Index):
+            index.create(conn, checkfirst=True)
         else:
-            result = session.query(obj).join(join_obj).filter(
-                text(condition)).one_or_none()
+            create_indexes(conn, *index)
+
+
+def drop_indexes(conn, *names):
+    """
+    It will drop the indexes which exist
+    """
+    for name in names:
+        conn.execute(text("DROP INDEX IF EXISTS " + name))
+
+
+# schema versions in order, each migration runs once and is safe to run
+# on a database made by create_all()
+MIGRATIONS = (
+    (1, "active children counters", add_active_counters),
+    (2, "full text index and change log",
+     lambda conn: (create_search_index(conn), create_change_log(conn))),
+    (3, "written rows in the change log", add_change_data),
+    (4, "hierarchy indexes and unique market event pairs", add_hierarchy_indexes),
+    (5, "write times in the change log", add_change_times),
+    (6, "changed columns only in the change log", lambda conn: create_change_log(conn)),
+    (7, "substring keyword search", lambda conn: rebuild_search_index(conn)),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 
-    except MultipleResultsFound as e:
-        print(e)
-        # Deal with it
-    except NoResultFound as e:
-        print(e)
-        # Deal with that as well
+def init_db(engine):
+    """
+    It will create the tables and run the migrations the database has not seen yet
+
+    The schema version is kept in PRAGMA user_version, a database already at
+    SCHEMA_VERSION costs a single pragma read.
+
+    Raises:
+        [ValueError]: [for a database made by a newer version of the application]
+    """
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise ValueError("database schema " + str(version) +
+                         " is newer than " + str(SCHEMA_VERSION))
+
+    # Create metadata layer that abstracts our SQL DB
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        for number, description, migrate in MIGRATIONS:
+            if number > version:
+                migrate(conn)
+                conn.execute(text("PRAGMA user_version = " + str(number)))
+
+
+def rebuild_counts(conn):
+    """
+    It will recompute every active children counter from scratch
+    and make the active flag of a parent follow its children
+
+    A parent without any child keeps the active flag it was given.
+    """
+    conn.execute(text("update marketevents set active_children = \
+        (select count(*) from selections se where se.marketevent_id = marketevents.id and se.active = 1)"))
+    conn.execute(text("update marketevents set active = active_children > 0 \
+        where exists (select 1 from selections se where se.marketevent_id = marketevents.id)"))
+
+    conn.execute(text("update markets set active_children = \
+        (select count(*) from selections se inner join marketevents me on se.marketevent_id = me.id \
+        where me.market_id = markets.id and se.active = 1)"))
+    conn.execute(text("update markets set active = active_children > 0 \
+        where exists (select 1 from marketevents me inner join selections se on se.marketevent_id = me.id \
+        where me.market_id = markets.id)"))
+
+    conn.execute(text("update events set active_children = \
+        (select count(*) from marketevents me where me.event_id = events.id and me.active = 1)"))
+    conn.execute(text("update events set active = active_children > 0 \
+        where exists (select 1 from marketevents me where me.event_id = events.id)"))
+
+    conn.execute(text("update sports set active_children = \
+        (select count(*) from events e where e.sport_id = sports.id and e.active = 1)"))
+    conn.execute(text("update sports set active = active_children > 0 \
+        where exists (select 1 from events e where e.sport_id = sports.id)"))
+
+
+def move_active_counts(conn, model, deltas) -> dict:
+    """
+    It will move the active children counters of some rows and flip the active flag
+    of a row when its counter reaches or leaves zero
+
+    Args:
+        model ([Base]): [one of COUNTER_MODELS]
+        deltas ([dict]): [row id -> change of its active children]
 
-    return result
+    Returns:
+        [dict]: [row id -> change of its active flag (1 or -1), only for flipped rows]
+    """
+    deltas = {row_id: delta for row_id, delta in deltas.items() if delta}
+    if not deltas:
+        return {}
+
+    table = model.__table__
+    stmt = update(table).where(table.c.id == bindparam('row_id')).values(
+        active_children=table.c.active_children + bindparam('delta'))
+    conn.execute(stmt, [{'row_id': row_id, 'delta': delta}
+                 for row_id, delta in deltas.items()])
+
+    flipped = {}
+    for row in conn.execute(select(table.c.id, table.c.active, table.c.active_children).where(
+            table.c.id.in_(deltas))):
+        if (row.active_children > 0) != bool(row.active):
+            flipped[row.id] = 1 if row.active_children > 0 else -1
+
+    for flag in (1, -1):
+        row_ids = [row_id for row_id, flip in flipped.items() if flip == flag]
+        if row_ids:
+            conn.execute(update(table).where(
+                table.c.id.in_(row_ids)).values(active=flag > 0))
+
+    return flipped
+
+
+def propagate_events(conn, changes):
+    """
+    It will roll active flag changes of events up to their sports
+
+    Args:
+        changes ([dict]): [event id -> change of its active flag]
+    """
+    changes = {event_id: change for event_id,
+               change in changes.items() if change}
+    if not changes:
+        return
+
+    cache = hierarchy_cache(conn)
+    sports = {event_id: cache.get(('event', event_id)) for event_id in changes}
+    missing = [event_id for event_id, sport_id in sports.items() if sport_id is None]
+    if missing:
+        for event_id, sport_id in conn.execute(select(Event.id, Event.sport_id).where(Event.id.in_(missing))):
+            sports[event_id] = sport_id
+            cache.put(('event', event_id), sport_id)
+
+    deltas = {}
+    for event_id, sport_id in sports.items():
+        if sport_id is not None:
+            deltas[sport_id] = deltas.get(sport_id, 0) + changes[event_id]
+    move_active_counts(conn, Sport, deltas)
+
+
+def propagate_selections(conn, changes):
+    """
+    It will roll active selection changes up to market events, markets, events and sports
+
+    Work is done per level and only goes up a level for parents whose active flag flipped,
+    so deactivating one selection never rescans its siblings.
+
+    Args:
+        changes ([dict]): [marketevent id -> change of its number of active selections]
+    """
+    changes = {marketevent_id: change for marketevent_id,
+               change in changes.items() if change}
+    if not changes:
+        return
+
+    cache = hierarchy_cache(conn)
+    parents = {marketevent_id: cache.get(('marketevent', marketevent_id))
+               for marketevent_id in changes}
+    missing = [marketevent_id for marketevent_id,
+               parent in parents.items() if parent is None]
+    if missing:
+        for row in conn.execute(select(MarketEvent.id, MarketEvent.market_id, MarketEvent.event_id).where(
+                MarketEvent.id.in_(missing))):
+            parents[row.id] = (row.market_id, row.event_id)
+            cache.put_marketevent(row.id, row.market_id, row.event_id)
+
+    market_deltas = {}
+    for marketevent_id, change in changes.items():
+        market_id = parents[marketevent_id][0]
+        market_deltas[market_id] = market_deltas.get(market_id, 0) + change
+    move_active_counts(conn, Market, market_deltas)
+
+    event_deltas = {}
+    for marketevent_id, flip in move_active_counts(conn, MarketEvent, changes).items():
+        event_id = parents[marketevent_id][1]
+        event_deltas[event_id] = event_deltas.get(event_id, 0) + flip
+    propagate_events(conn, move_active_counts(conn, Event, event_deltas))
 
 
 def add(conn, session, args):
@@ -237,8 +1046,7 @@ def add(conn, session, args):
 
         elif 'event' in parameters:
             # check sport id available or not
-            sport = find(session, Sport,
-                         "sports.id = " + parameters['event']['sport_id'])
+            sport = get_by_id(conn, Sport, parameters['event']['sport_id'])
 
             # sports data matched
             if sport:
@@ -246,6 +1054,12 @@ def add(conn, session, args):
                                   type=parameters['event']['type'],
                                   slug=parameters['event']['slug'], status=parameters['event']['status'], active=1)
                 new_id = save_into_db(session, new_event)
+                hierarchy_cache(conn).put(
+                    ('event', new_id), int(parameters['event']['sport_id']))
+
+                # a new event is active, count it for its sport
+                with conn.begin():
+                    propagate_events(conn, {new_id: 1})
 
         elif 'market' in parameters:
             new_market = Market(name=parameters['market']['name'], display_name=parameters['market']['display_name'],
@@ -254,148 +1068,634 @@ def add(conn, session, args):
             new_id = save_into_db(session, new_market)
 
         elif 'selection' in parameters:
-            market_event = find(
-                session, MarketEvent,
-                "(marketevents.market_id=" + parameters['selection']['market_id'] + ") & (marketevents.event_id=" +
-                parameters['selection']['event_id'] + ") & (marketevents.active=1)")
-
-            if market_event:
-                market_event_id = market_event.id
-            else:
-                # add market event
-                new_market_event = MarketEvent(
-                    market_id=parameters['selection']['market_id'], event_id=parameters['selection']['event_id'],
-                    active=1)
-                market_event_id = save_into_db(session, new_market_event)
+            cache = hierarchy_cache(conn)
+            market_event_id = cache.get(('pair', int(parameters['selection']['market_id']),
+                                         int(parameters['selection']['event_id'])))
+
+            if not market_event_id:
+                market_event = get_marketevent(
+                    conn, parameters['selection']['market_id'], parameters['selection']['event_id'])
+
+                if market_event:
+                    market_event_id = market_event.id
+                else:
+                    # add market event, it becomes active with its first active selection
+                    new_market_event = MarketEvent(
+                        market_id=parameters['selection']['market_id'], event_id=parameters['selection']['event_id'],
+                        active=0)
+                    market_event_id = save_into_db(session, new_market_event)
+                cache.put_marketevent(
+                    market_event_id, parameters['selection']['market_id'], parameters['selection']['event_id'])
 
             new_selection = Selection(marketevent_id=market_event_id, name=parameters['selection']['name'],
                                       price=parameters['selection']['price'],
                                       outcome=parameters['selection']['outcome'], active=1)
             new_id = save_into_db(session, new_selection)
 
-            # activate market
-            stmt = update(Market).where(
-                Market.id == parameters['selection']['market_id']).values(active=1)
-            conn.execute(stmt)
-
-            # activate event
-            stmt = update(Event).where(
-                Event.id == parameters['selection']['event_id']).values(active=1)
-            conn.execute(stmt)
-
-            # activate sport
-            event_sport_details = find(
-                session, Sport, "events.sport_id=" + parameters['selection']['event_id'], Event)
-            if event_sport_details.active == 0:
-                stmt = update(Sport).where(
-                    Sport.id == event_sport_details.id).values(active=1)
-                conn.execute(stmt)
+            # activate market event, market, event and sport as needed
+            with conn.begin():
+                propagate_selections(conn, {market_event_id: 1})
 
         return new_id
 
 
-def update_element(conn, session, args):
-    """
-    This will update details of an element
-    """
-    parameters = []
-    market_event_id = None
+# fields read from each element in bulk mode, same as add() reads them
+BULK_FIELDS = {
+    'sport': ('name', 'display_name', 'slug', 'order', 'active'),
+    'event': ('sport_id', 'name', 'type', 'slug', 'status'),
+    'market': ('name', 'display_name', 'order', 'schema', 'columns'),
+    'selection': ('market_id', 'event_id', 'name', 'price', 'outcome'),
+}
 
-    if is_json(args['<element>']):
-        parameters = json.loads(args['<element>'])
-        """
-        {"sport":{"id":1, "values": {"name": "football", "display_name": "Football", "slug": "football", "order":1}}}
 
-        {"event":{"id":1, "values": {"name": "France vs England", "status": 0, "slug": "france_vs_england", "type":"0"}}}
+def parse_bulk_line(line):
+    """
+    It will turn one NDJSON line into the element name and its row values
 
-        {"market":{"id":1, "values": {"name": "full time result", "display_name": "Full Time Result", "order":"1", "schema":"2", "columns":"3"}}}
+    Args:
+        line ([str]): [one element in the same JSON format as -a]
 
-        {"selection":{"id":1, "values": {"market_id":"1", "event_id":"1", "name": "France", "price": "1.85", "outcome": "win"}}}
-        """
-        if 'sport' in parameters:
-            stmt = update(Sport).where(
-                Sport.id == parameters['sport']['id']).values(parameters['sport']['values'])
-            conn.execute(stmt)
+    Raises:
+        [ValueError]: [when the line is not a valid element]
 
-        elif 'event' in parameters:
-            # for this version sport_id cant change for event
-            # otherwise need to update all related changes in different places
-            if 'sport_id' in parameters['event']['values']:
-                return "Sport ID cant be change for a Event"
+    Returns:
+        [tuple]: [element name, dict of column values]
+    """
+    parameters = json.loads(line)
+    if not isinstance(parameters, dict) or len(parameters) != 1:
+        raise ValueError("expected exactly one element")
 
-            stmt = update(Event).where(Event.id == parameters['event']['id']).values(
-                parameters['event']['values'])
-            conn.execute(stmt)
+    kind, values = next(iter(parameters.items()))
+    if kind not in BULK_FIELDS or not isinstance(values, dict):
+        raise ValueError("unknown element " + str(kind))
 
-        elif 'market' in parameters:
-            stmt = update(Market).where(Market.id == parameters['market']['id']).values(
-                parameters['market']['values'])
-            conn.execute(stmt)
+    missing = [field for field in BULK_FIELDS[kind] if field not in values]
+    if missing:
+        raise ValueError("missing " + ", ".join(missing))
 
-        elif 'selection' in parameters:
-            # existing selection
-            selection = find(
-                session, Selection,
-                "selections.id=" + str(parameters['selection']['id']))
-
-            if selection:
-                # get selection related marketevent details
-                marketevent = find(
-                    session, MarketEvent,
-                    "marketevents.id=" + str(selection.marketevent_id))
-            else:
-                return "Selection ID not found"
+    row = {field: values[field] for field in BULK_FIELDS[kind]}
+    # parent ids and prices are checked here, not by a failing batch insert
+    for field in ('sport_id', 'market_id', 'event_id'):
+        if field in row:
+            row[field] = int(row[field])
+    if 'price' in row:
+        row['price'] = round(float(row['price']), 2)
 
-            if marketevent and (int(marketevent.market_id) != int(parameters['selection']['values']['market_id']) or int(marketevent.event_id) != int(parameters['selection']['values']['event_id'])):
-                # find previous market event connected with any other selection
-                selections_for_marketevent = finds(session, Selection, "(selections.marketevent_id=" + str(
-                    selection.marketevent_id) + ") & (selections.id != " + str(parameters['selection']['id']) + ")")
+    # same defaults as add()
+    if kind in ('event', 'selection'):
+        row['active'] = 1
+    elif kind == 'market':
+        row['active'] = 0
 
-                # if it is not connected with any selection then need to deactivate or delete
-                if not selections_for_marketevent:
-                    stmt = delete(MarketEvent).where(
-                        MarketEvent.id == marketevent.id)
-                    conn.execute(stmt)
+    return kind, row
 
-            # find if already marketevent available for this market_id and event_id
-            market_event = find(
-                session, MarketEvent,
-                "(marketevents.market_id=" + parameters['selection']['values']['market_id'] + ") & (marketevents.event_id=" +
-                parameters['selection']['values']['event_id'] + ") & (marketevents.active=1)")
 
-            if market_event:
-                market_event_id = market_event.id
-            else:
-                # add new market event
-                new_market_event = MarketEvent(
-                    market_id=parameters['selection']['values']['market_id'], event_id=parameters['selection']['values']['event_id'],
-                    active=1)
-                market_event_id = save_into_db(session, new_market_event)
-
-            # activate market
-            stmt = update(Market).where(
-                Market.id == parameters['selection']['values']['market_id']).values(active=1)
-            conn.execute(stmt)
+def resolve_marketevents(conn, pairs) -> dict:
+    """
+    It will find or create the market event of every (market_id, event_id) pair
 
-            # activate event
-            stmt = update(Event).where(
-                Event.id == parameters['selection']['values']['event_id']).values(active=1)
-            conn.execute(stmt)
+    Args:
+        pairs ([set]): [(market_id, event_id) pairs]
 
-            # update the selection
-            stmt = update(Selection).where(Selection.id == parameters['selection']['id']).values(
-                {"marketevent_id": market_event_id, "name": parameters['selection']['values']['name'], "price": parameters['selection']['values']['price'], "outcome": parameters['selection']['values']['outcome']})
-            conn.execute(stmt)
+    Returns:
+        [dict]: [(market_id, event_id) -> marketevent id]
+    """
+    cache = hierarchy_cache(conn)
+    resolved = {}
+    for market_id, event_id in pairs:
+        marketevent_id = cache.get(('pair', market_id, event_id))
+        if marketevent_id:
+            resolved[(market_id, event_id)] = marketevent_id
+
+    pairs = pairs - resolved.keys()
+    if not pairs:
+        return resolved
+
+    market_ids = {market_id for market_id, event_id in pairs}
+    event_ids = {event_id for market_id, event_id in pairs}
+    stmt = select(MarketEvent.id, MarketEvent.market_id, MarketEvent.event_id).where(
+        MarketEvent.market_id.in_(market_ids), MarketEvent.event_id.in_(event_ids))
+
+    for row in conn.execute(stmt):
+        if (row.market_id, row.event_id) in pairs:
+            resolved.setdefault((row.market_id, row.event_id), row.id)
+
+    missing = sorted(pairs - resolved.keys())
+    if missing:
+        # add market events
+        conn.execute(insert(MarketEvent), [
+            {'market_id': market_id, 'event_id': event_id, 'active': 0} for market_id, event_id in missing])
+        for row in conn.execute(stmt):
+            if (row.market_id, row.event_id) in pairs:
+                resolved.setdefault((row.market_id, row.event_id), row.id)
+
+    return resolved
+
+
+def insert_bulk_batch(conn, records) -> int:
+    """
+    It will insert one batch of parsed elements in a single transaction
 
-        return True
+    Elements are grouped by type and inserted parent first with executemany,
+    so a selection can refer to an event given earlier in the same batch.
 
+    Args:
+        records ([list]): [(line number, element name, row) tuples]
 
-def delete_element(conn, session, args):
+    Returns:
+        [int]: [number of inserted elements]
     """
-    delete an element
-    we can change it to update in active = 0 as well later
+    rows = {kind: [] for kind in BULK_FIELDS}
+    for lineno, kind, row in records:
+        rows[kind].append(row)
+
+    resolved = {}
+    with conn.begin():
+        if rows['sport']:
+            conn.execute(insert(Sport), rows['sport'])
+
+        if rows['event']:
+            # check sport ids available or not
+            sport_ids = {int(row['sport_id']) for row in rows['event']}
+            found = set(conn.execute(select(Sport.id).where(
+                Sport.id.in_(sport_ids))).scalars())
+            if sport_ids - found:
+                raise ValueError("sport not found " +
+                                 ", ".join(str(i) for i in sorted(sport_ids - found)))
+            conn.execute(insert(Event), rows['event'])
+
+            # new events are active, count them for their sports
+            sport_deltas = {}
+            for row in rows['event']:
+                sport_deltas[int(row['sport_id'])] = sport_deltas.get(
+                    int(row['sport_id']), 0) + 1
+            move_active_counts(conn, Sport, sport_deltas)
+
+        if rows['market']:
+            conn.execute(insert(Market), rows['market'])
+
+        if rows['selection']:
+            pairs = {(int(row['market_id']), int(row['event_id']))
+                     for row in rows['selection']}
+            resolved = resolve_marketevents(conn, pairs)
+
+            conn.execute(insert(Selection), [
+                {'marketevent_id': resolved[(int(row['market_id']), int(row['event_id']))],
+                 'name': row['name'], 'price': row['price'], 'outcome': row['outcome'], 'active': 1}
+                for row in rows['selection']])
+
+            # activate market events, markets, events and sports once per batch
+            changes = {}
+            for row in rows['selection']:
+                marketevent_id = resolved[(
+                    int(row['market_id']), int(row['event_id']))]
+                changes[marketevent_id] = changes.get(marketevent_id, 0) + 1
+            propagate_selections(conn, changes)
+
+    # only remember market events of a committed batch
+    cache = hierarchy_cache(conn)
+    for (market_id, event_id), marketevent_id in resolved.items():
+        cache.put_marketevent(marketevent_id, market_id, event_id)
+    return len(records)
+
+
+def flush_bulk_batch(conn, records, errors) -> int:
     """
-    parameters = []
+    It will insert a batch, falling back to one element per transaction when the batch fails
+    so a single bad element does not abort the others
+    """
+    try:
+        return insert_bulk_batch(conn, records)
+    except (SQLAlchemyError, ValueError, TypeError) as e:
+        # ids looked up inside the rolled back transaction can be handed out again
+        hierarchy_cache(conn).clear()
+        if len(records) == 1:
+            errors.append((records[0][0], str(e).splitlines()[0]))
+            print("line " + str(records[0][0]) + ": " +
+                  errors[-1][1], file=sys.stderr)
+            return 0
+
+    return sum(flush_bulk_batch(conn, [record], errors) for record in records)
+
+
+def bulk_add(conn, stream, batch_size=500) -> dict:
+    """
+    It will add all elements of a NDJSON stream in batched transactions
+
+    Args:
+        stream ([iterable]): [lines, each one element in the same JSON format as -a]
+        batch_size ([int]): [number of elements per transaction]
+
+    Returns:
+        [dict]: [inserted rows, errors and rows per second]
+    """
+    started = time.perf_counter()
+    errors = []
+    rows = 0
+    batch = []
+
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+
+        try:
+            kind, row = parse_bulk_line(line)
+        except (ValueError, TypeError) as e:
+            errors.append((lineno, str(e)))
+            print("line " + str(lineno) + ": " + str(e), file=sys.stderr)
+            continue
+
+        batch.append((lineno, kind, row))
+        if len(batch) >= batch_size:
+            rows += flush_bulk_batch(conn, batch, errors)
+            batch = []
+
+        # stop after the current batch on Ctrl + C
+        if interrupted:
+            break
+
+    if batch:
+        rows += flush_bulk_batch(conn, batch, errors)
+
+    elapsed = time.perf_counter() - started
+    return {'rows': rows, 'errors': len(errors), 'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed) if elapsed else rows}
+
+
+def ignore_interrupt():
+    """
+    Ctrl + C is handled by the parent process only
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_bulk_chunk(chunk) -> tuple:
+    """
+    It will parse a chunk of NDJSON lines in a worker process
+
+    Rows go back as tuples of their values, in BULK_FIELDS order then active,
+    which costs less to send between processes than dicts.
+
+    Args:
+        chunk ([tuple]): [line number of the first line, lines]
+
+    Returns:
+        [tuple]: [(line number, element name, values) records, (line number, error) errors, seconds]
+    """
+    started = time.perf_counter()
+    first, lines = chunk
+    records = []
+    errors = []
+    for lineno, line in enumerate(lines, first):
+        if not line.strip():
+            continue
+        try:
+            kind, row = parse_bulk_line(line)
+        except (ValueError, TypeError) as e:
+            errors.append((lineno, str(e)))
+            continue
+        records.append((lineno, kind, tuple(row.values())))
+
+    return records, errors, time.perf_counter() - started
+
+
+def read_chunks(stream, size):
+    """
+    It will cut a stream into chunks of lines with the line number of their first line
+    """
+    chunk = []
+    first = 1
+    for lineno, line in enumerate(stream, 1):
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield first, chunk
+            chunk = []
+            first = lineno + 1
+    if chunk:
+        yield first, chunk
+
+
+def parallel_bulk_add(conn, stream, batch_size=500, workers=None) -> dict:
+    """
+    It will add all elements of a NDJSON stream, parsed by a pool of processes
+
+    Chunks of batch_size lines are parsed and checked by the workers and written in
+    their input order by this process, the only writer, one transaction per chunk.
+    At most two chunks per worker are in flight, so a large file is never read ahead.
+
+    Args:
+        stream ([iterable]): [lines, each one element in the same JSON format as -a]
+        batch_size ([int]): [number of lines per chunk and transaction]
+        workers ([int]): [parsing processes, None for one per core]
+
+    Returns:
+        [dict]: [inserted rows, errors, rows per second and the throughput of the parse and write stages]
+    """
+    started = time.perf_counter()
+    workers = workers or os.cpu_count()
+    errors = []
+    rows = parsed = 0
+    parse_seconds = write_seconds = 0
+    pending = collections.deque()
+    chunks = read_chunks(stream, batch_size)
+
+    with multiprocessing.Pool(workers, initializer=ignore_interrupt) as pool:
+        while True:
+            while len(pending) < workers * 2 and not interrupted:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.apply_async(parse_bulk_chunk, (chunk,)))
+            if not pending:
+                break
+
+            records, chunk_errors, seconds = pending.popleft().get()
+            parse_seconds += seconds
+            parsed += len(records) + len(chunk_errors)
+            for lineno, error in chunk_errors:
+                errors.append((lineno, error))
+                print("line " + str(lineno) + ": " + error, file=sys.stderr)
+
+            write_started = time.perf_counter()
+            records = [(lineno, kind, dict(zip(BULK_FIELDS[kind] + ('active',), values)))
+                       for lineno, kind, values in records]
+            if records:
+                rows += flush_bulk_batch(conn, records, errors)
+            write_seconds += time.perf_counter() - write_started
+
+    elapsed = time.perf_counter() - started
+    return {'rows': rows, 'errors': len(errors), 'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed) if elapsed else rows, 'workers': workers,
+            # parse seconds add up the time of all workers
+            'stages': {'parse': {'seconds': round(parse_seconds, 3),
+                                 'rows_per_sec': round(parsed / parse_seconds * workers) if parse_seconds else parsed},
+                       'write': {'seconds': round(write_seconds, 3),
+                                 'rows_per_sec': round(rows / write_seconds) if write_seconds else rows}}}
+
+
+def parse_tick(line) -> tuple:
+    """
+    It will read one price tick, "12 1.85", "12,1.85" or {"id": 12, "price": "1.85"}
+
+    Raises:
+        [ValueError]: [when the line is not a tick]
+
+    Returns:
+        [tuple]: [selection id, price to 2 decimal places]
+    """
+    if line.lstrip().startswith('{'):
+        tick = json.loads(line)
+        selection_id, price = tick['id'], tick['price']
+    else:
+        selection_id, price = re.split(r"[,\s]+", line.strip())
+
+    return int(selection_id), round(float(price), 2)
+
+
+def apply_ticks(conn, pending) -> int:
+    """
+    It will write the last price of every ticked selection with one batched UPDATE in one transaction
+
+    Args:
+        pending ([dict]): [selection id -> price]
+
+    Returns:
+        [int]: [number of updated selections]
+    """
+    table = Selection.__table__
+    stmt = update(table).where(table.c.id == bindparam('selection_id')).values(
+        price=bindparam('new_price'))
+    with conn.begin():
+        result = conn.execute(stmt, [{'selection_id': selection_id, 'new_price': price}
+                                     for selection_id, price in pending.items()])
+    return result.rowcount
+
+
+# seconds an idle tick feed waits for a line before checking for Ctrl + C
+TICK_POLL = 0.1
+
+
+def read_lines(stream, lines):
+    """
+    It will hand the lines of a stream to another thread, None when it ends
+    """
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def ingest_ticks(conn, stream, window=0.1) -> dict:
+    """
+    It will apply a stream of price ticks, coalescing the ticks of a selection within a window
+
+    A window starts with its first tick and is applied when it is over even if the
+    stream is quiet, so a price is never older than one window plus one transaction.
+
+    Args:
+        stream ([iterable]): [lines, each one tick as taken by parse_tick()]
+        window ([float]): [seconds]
+
+    Returns:
+        [dict]: [ticks, updates, windows, ticks/sec and staleness from receiving a tick to its commit]
+    """
+    lines = queue.Queue(maxsize=100000)
+    threading.Thread(target=read_lines, args=(
+        stream, lines), daemon=True).start()
+
+    started = time.perf_counter()
+    pending = {}
+    received = {}
+    window_end = None
+    ticks = updates = windows = errors = 0
+    staleness = []
+
+    while not interrupted:
+        # a quiet feed still checks for Ctrl + C every poll
+        timeout = max(0, window_end - time.perf_counter()
+                      ) if pending else TICK_POLL
+        try:
+            line = lines.get(timeout=timeout)
+        except queue.Empty:
+            line = ''
+
+        if line:
+            try:
+                selection_id, price = parse_tick(line)
+            except (ValueError, TypeError, KeyError) as e:
+                errors += 1
+                print("bad tick " + line.strip() + ": " +
+                      str(e), file=sys.stderr)
+            else:
+                ticks += 1
+                if not pending:
+                    window_end = time.perf_counter() + window
+                # last price wins, staleness counts from the first unapplied tick
+                pending[selection_id] = price
+                received.setdefault(selection_id, time.perf_counter())
+
+        if pending and (line is None or time.perf_counter() >= window_end):
+            updates += apply_ticks(conn, pending)
+            committed = time.perf_counter()
+            staleness.extend(committed - received[selection_id]
+                             for selection_id in pending)
+            windows += 1
+            pending = {}
+            received = {}
+
+        if line is None:
+            break
+
+    # ticks read before Ctrl + C are not lost
+    if pending:
+        updates += apply_ticks(conn, pending)
+        windows += 1
+
+    elapsed = time.perf_counter() - started
+    return {'ticks': ticks, 'updates': updates, 'windows': windows, 'errors': errors,
+            'ticks_per_sec': round(ticks / elapsed) if elapsed else ticks,
+            'staleness_ms_avg': round(sum(staleness) / len(staleness) * 1000, 3) if staleness else 0,
+            'staleness_ms_max': round(max(staleness) * 1000, 3) if staleness else 0}
+
+
+def update_element(conn, session, args):
+    """
+    This will update details of an element
+    """
+    parameters = []
+    market_event_id = None
+
+    if is_json(args['<element>']):
+        parameters = json.loads(args['<element>'])
+        """
+        {"sport":{"id":1, "values": {"name": "football", "display_name": "Football", "slug": "football", "order":1}}}
+
+        {"event":{"id":1, "values": {"name": "France vs England", "status": 0, "slug": "france_vs_england", "type":"0"}}}
+
+        {"market":{"id":1, "values": {"name": "full time result", "display_name": "Full Time Result", "order":"1", "schema":"2", "columns":"3"}}}
+
+        {"selection":{"id":1, "values": {"market_id":"1", "event_id":"1", "name": "France", "price": "1.85", "outcome": "win"}}}
+
+        {"selection":{"id":1, "values": {"active": 0}}}
+        """
+        if 'sport' in parameters:
+            stmt = update(Sport).where(
+                Sport.id == parameters['sport']['id']).values(parameters['sport']['values'])
+            conn.execute(stmt)
+
+        elif 'event' in parameters:
+            # for this version sport_id cant change for event
+            # otherwise need to update all related changes in different places
+            if 'sport_id' in parameters['event']['values']:
+                return "Sport ID cant be change for a Event"
+
+            with conn.begin():
+                was_active = conn.execute(select(Event.active).where(
+                    Event.id == parameters['event']['id'])).scalar()
+
+                stmt = update(Event).where(Event.id == parameters['event']['id']).values(
+                    parameters['event']['values'])
+                conn.execute(stmt)
+
+                # an event switched on or off by hand counts for its sport
+                if 'active' in parameters['event']['values'] and was_active is not None:
+                    is_active = bool(int(parameters['event']['values']['active']))
+                    if is_active != bool(was_active):
+                        propagate_events(
+                            conn, {parameters['event']['id']: 1 if is_active else -1})
+
+        elif 'market' in parameters:
+            stmt = update(Market).where(Market.id == parameters['market']['id']).values(
+                parameters['market']['values'])
+            conn.execute(stmt)
+
+        elif 'selection' in parameters:
+            # existing selection
+            selection = get_by_id(
+                conn, Selection, parameters['selection']['id'])
+
+            if not selection:
+                return "Selection ID not found"
+
+            # get selection related marketevent details
+            cache = hierarchy_cache(conn)
+            old_marketevent_id = selection.marketevent_id
+            parent = cache.get(('marketevent', old_marketevent_id))
+            if not parent:
+                marketevent = get_by_id(conn, MarketEvent, old_marketevent_id)
+
+                if not marketevent:
+                    return "Market event of the selection not found"
+
+                parent = (marketevent.market_id, marketevent.event_id)
+                cache.put_marketevent(old_marketevent_id, *parent)
+            old_market_id, old_event_id = parent
+
+            values = parameters['selection']['values']
+            market_id = str(values.get('market_id', old_market_id))
+            event_id = str(values.get('event_id', old_event_id))
+            is_active = bool(int(values.get('active', selection.active)))
+            moved = int(old_market_id) != int(
+                market_id) or int(old_event_id) != int(event_id)
+
+            if moved:
+                # find if already marketevent available for this market_id and event_id
+                market_event_id = cache.get(
+                    ('pair', int(market_id), int(event_id)))
+
+                if not market_event_id:
+                    market_event = get_marketevent(conn, market_id, event_id)
+
+                    if market_event:
+                        market_event_id = market_event.id
+                    else:
+                        # add new market event, it becomes active with its first active selection
+                        new_market_event = MarketEvent(
+                            market_id=market_id, event_id=event_id, active=0)
+                        market_event_id = save_into_db(
+                            session, new_market_event)
+                    cache.put_marketevent(market_event_id, market_id, event_id)
+            else:
+                market_event_id = old_marketevent_id
+
+            with conn.begin():
+                # update the selection
+                stmt = update(Selection).where(Selection.id == parameters['selection']['id']).values(
+                    {"marketevent_id": market_event_id, "name": values.get('name', selection.name),
+                     "price": values.get('price', selection.price), "outcome": values.get('outcome', selection.outcome),
+                     "active": is_active})
+                conn.execute(stmt)
+
+                # move the active selection count from the old to the new market event
+                changes = {}
+                if selection.active:
+                    changes[old_marketevent_id] = -1
+                if is_active:
+                    changes[market_event_id] = changes.get(
+                        market_event_id, 0) + 1
+                propagate_selections(conn, changes)
+
+                if moved:
+                    # find previous market event connected with any other selection
+                    selections_for_marketevent = conn.execute(select(Selection.id).where(
+                        Selection.marketevent_id == old_marketevent_id).limit(1)).first()
+
+                    # if it is not connected with any selection then need to delete
+                    if not selections_for_marketevent:
+                        stmt = delete(MarketEvent).where(
+                            MarketEvent.id == old_marketevent_id)
+                        conn.execute(stmt)
+                        cache.forget_marketevent(
+                            old_marketevent_id, old_market_id, old_event_id)
+
+        return True
+
+
+def delete_element(conn, session, args):
+    """
+    delete an element
+    we can change it to update in active = 0 as well later
+    """
+    parameters = []
 
     if is_json(args['<element>']):
         parameters = json.loads(args['<element>'])
@@ -410,8 +1710,8 @@ def delete_element(conn, session, args):
         """
         if 'sport' in parameters:
             # if sport is use in any event can't delete
-            events = finds(session, Event, "events.sport_id=" +
-                           str(parameters['sport']['id']))
+            events = get_children(
+                conn, Event, 'sport_id', parameters['sport']['id'], limit=1)
 
             if not events:
                 stmt = delete(Sport).where(
@@ -422,20 +1722,27 @@ def delete_element(conn, session, args):
 
         elif 'event' in parameters:
             # if event in marketevents then can't delete
-            marketevents = finds(session, MarketEvent, "marketevents.event_id=" +
-                                 str(parameters['event']['id']))
+            marketevents = get_children(
+                conn, MarketEvent, 'event_id', parameters['event']['id'], limit=1)
 
             if not marketevents:
-                stmt = delete(Event).where(
-                    Event.id == parameters['event']['id'])
-                conn.execute(stmt)
+                with conn.begin():
+                    # an active event no longer counts for its sport
+                    if conn.execute(select(Event.active).where(Event.id == parameters['event']['id'])).scalar():
+                        propagate_events(conn, {parameters['event']['id']: -1})
+
+                    stmt = delete(Event).where(
+                        Event.id == parameters['event']['id'])
+                    conn.execute(stmt)
+                hierarchy_cache(conn).forget(
+                    ('event', int(parameters['event']['id'])))
             else:
                 return False
 
         elif 'market' in parameters:
             # if market in marketevents then can't delete
-            marketevents = finds(session, MarketEvent, "marketevents.market_id=" +
-                                 str(parameters['market']['id']))
+            marketevents = get_children(
+                conn, MarketEvent, 'market_id', parameters['market']['id'], limit=1)
 
             if not marketevents:
                 stmt = delete(Market).where(
@@ -445,16 +1752,786 @@ def delete_element(conn, session, args):
                 return False
 
         elif 'selection' in parameters:
-            stmt = delete(Selection).where(
-                Selection.id == parameters['selection']['id'])
-            conn.execute(stmt)
+            with conn.begin():
+                selection = conn.execute(select(Selection.marketevent_id, Selection.active).where(
+                    Selection.id == parameters['selection']['id'])).first()
+
+                stmt = delete(Selection).where(
+                    Selection.id == parameters['selection']['id'])
+                conn.execute(stmt)
+
+                # deactivate market event, market, event and sport as needed
+                if selection and selection.active:
+                    propagate_selections(
+                        conn, {selection.marketevent_id: -1})
 
         return True
 
 
-def search(conn, session, args):
+# outcomes a settlement can give
+SETTLEMENT_OUTCOMES = ('win', 'lose', 'place', 'void')
+
+# outcomes of one settlement, a temp table of the connection
+SETTLEMENT_TABLE = Table('settlement', MetaData(), Column('id', Integer, primary_key=True),
+                         Column('outcome', String), prefixes=['TEMPORARY'])
+
+
+def settle(conn, settlement) -> dict:
+    """
+    It will settle the selections of an event, a market or the market of an event in one
+    transaction: every selection gets its outcome and becomes inactive, then the active
+    counters and flags move up the hierarchy once per level
+
+    {"event": 1, "outcomes": {"12": "win", "13": "lose"}, "default": "lose"}
+    {"market": 2, "event": 1, "outcomes": {"12": "win"}}
+
+    Selections missing from outcomes get the default, or keep their outcome without one.
+
+    Raises:
+        [ValueError]: [for nothing to settle, an unknown outcome or a selection of another event or market]
+
+    Returns:
+        [dict]: [selections settled and selections deactivated]
+    """
+    if isinstance(settlement, str):
+        settlement = json.loads(settlement)
+    if not isinstance(settlement, dict) or not ('event' in settlement or 'market' in settlement):
+        raise ValueError("settle an event or a market")
+
+    outcomes = {int(selection_id): str(outcome).lower()
+                for selection_id, outcome in settlement.get('outcomes', {}).items()}
+    default = settlement.get('default')
+    default = str(default).lower() if default is not None else None
+    for outcome in list(outcomes.values()) + ([default] if default is not None else []):
+        if outcome not in SETTLEMENT_OUTCOMES:
+            raise ValueError("unknown outcome " + outcome +
+                             ", expected one of " + ", ".join(SETTLEMENT_OUTCOMES))
+
+    scope = select(MarketEvent.id)
+    if 'event' in settlement:
+        scope = scope.where(MarketEvent.event_id == int(settlement['event']))
+    if 'market' in settlement:
+        scope = scope.where(MarketEvent.market_id == int(settlement['market']))
+    in_scope = Selection.marketevent_id.in_(scope.scalar_subquery())
+
+    with conn.begin():
+        SETTLEMENT_TABLE.create(conn, checkfirst=True)
+        conn.execute(delete(SETTLEMENT_TABLE))
+        if outcomes:
+            conn.execute(insert(SETTLEMENT_TABLE),
+                         [{'id': selection_id, 'outcome': outcome} for selection_id, outcome in outcomes.items()])
+            outside = conn.execute(select(SETTLEMENT_TABLE.c.id).outerjoin(
+                Selection.__table__, Selection.id == SETTLEMENT_TABLE.c.id).where(
+                (Selection.id == None) | ~in_scope)).scalars().all()
+            if outside:
+                raise ValueError("selections " + ", ".join(str(selection_id) for selection_id in outside) +
+                                 " are not in the settled event or market")
+
+        # every settled selection that was active leaves its market event
+        deltas = {marketevent_id: -count for marketevent_id, count in conn.execute(
+            select(Selection.marketevent_id, func.count()).where(in_scope, Selection.active == True)
+            .group_by(Selection.marketevent_id))}
+
+        # one statement for all selections, each row is written once
+        given = select(SETTLEMENT_TABLE.c.outcome).where(
+            SETTLEMENT_TABLE.c.id == Selection.id).scalar_subquery()
+        settled = conn.execute(update(Selection.__table__).where(in_scope).values(
+            active=False, outcome=func.coalesce(given, default if default is not None else Selection.outcome))).rowcount
+
+        propagate_selections(conn, deltas)
+        conn.execute(delete(SETTLEMENT_TABLE))
+
+    return {'selections': settled, 'deactivated': -sum(deltas.values())}
+
+
+@functools.lru_cache(maxsize=None)
+def tree_statements(active_only):
+    """
+    It will build the level queries of a tree fetch once, children of a batch of events
+    are read with one IN list per level
+    """
+    events = select(Event.__table__).where(Event.sport_id == bindparam('sport_id'))
+    markets = select(Market.__table__, MarketEvent.id.label('marketevent_id'), MarketEvent.event_id,
+                     MarketEvent.active.label('marketevent_active'),
+                     MarketEvent.active_children.label('marketevent_active_children')).join(
+        MarketEvent.__table__, MarketEvent.market_id == Market.id).where(
+        MarketEvent.event_id.in_(bindparam('event_ids', expanding=True)))
+    selections = select(Selection.__table__).where(
+        Selection.marketevent_id.in_(bindparam('marketevent_ids', expanding=True)))
+
+    if active_only:
+        events = events.where(Event.active == True)
+        markets = markets.where(MarketEvent.active == True)
+        selections = selections.where(Selection.active == True)
+
+    return (events.order_by(Event.id), markets.order_by(MarketEvent.event_id, Market.order, Market.id),
+            selections.order_by(Selection.marketevent_id, Selection.id))
+
+
+def event_trees(conn, events, active_only=False, batch_size=500):
+    """
+    It will give the events with their markets and selections, nested, reading the
+    markets and the selections of every batch of events with one query each
+
+    Markets carry the active flag and counter of their market event ie. of that event.
+
+    Args:
+        events ([iterable]): [event rows]
+    """
+    events_statement, markets_statement, selections_statement = tree_statements(active_only)
+    events = iter(events)
+    while True:
+        batch = {row.id: dict(row._mapping, markets=[]) for row in itertools.islice(events, batch_size)}
+        if not batch:
+            return
+
+        markets = {}
+        for row in conn.execute(markets_statement, {'event_ids': list(batch)}):
+            market = dict(row._mapping, selections=[])
+            market['active'] = market.pop('marketevent_active')
+            market['active_children'] = market.pop('marketevent_active_children')
+            batch[market.pop('event_id')]['markets'].append(market)
+            markets[market['marketevent_id']] = market
+
+        if markets:
+            for row in conn.execute(selections_statement, {'marketevent_ids': list(markets)}):
+                markets[row.marketevent_id]['selections'].append(dict(row._mapping))
+
+        yield from batch.values()
+
+
+def fetch_tree(conn, element, row_id, active_only=False, batch_size=500):
+    """
+    It will load the subtree of a sport or an event as nested dicts, eg.
+    {"id": 1, "name": "football", ..., "events": [{..., "markets": [{..., "selections": [...]}]}]}
+
+    Raises:
+        [ValueError]: [for an element other than sport or event]
+
+    Returns:
+        [dict]: [the tree, None when the root is not found or is inactive with active_only]
+    """
+    sport, events = tree_root(conn, element, row_id, active_only)
+    if events is None:
+        return None
+    if sport is None:
+        return next(event_trees(conn, events, active_only, batch_size))
+
+    sport['events'] = list(event_trees(conn, events, active_only, batch_size))
+    return sport
+
+
+def tree_root(conn, element, row_id, active_only=False) -> tuple:
+    """
+    It will find the root of a tree fetch
+
+    Returns:
+        [tuple]: [the sport as a dict with the cursor of its events, None and a list of the event
+                  for an event, events None when the root is not found or inactive with active_only]
+    """
+    if element not in ('sport', 'event'):
+        raise ValueError("a tree starts at a sport or an event")
+
+    row = get_by_id(conn, Sport if element == 'sport' else Event, row_id)
+    if row is None or (active_only and not row.active):
+        return None, None
+    if element == 'event':
+        return None, [row]
+    return dict(row._mapping), conn.execute(tree_statements(active_only)[0], {'sport_id': row.id})
+
+
+def write_tree(conn, element, row_id, stream, active_only=False, batch_size=500) -> dict:
+    """
+    It will write the subtree of a sport or an event as one JSON document, event by event,
+    so a large sport is never held in memory
+
+    Returns:
+        [dict]: [events written, or found False]
+    """
+    sport, events = tree_root(conn, element, row_id, active_only)
+    if events is None:
+        return {'found': False}
+
+    if sport is None:
+        stream.write(json.dumps(next(event_trees(conn, events, active_only)), default=str) + "\n")
+        return {'found': True, 'events': 1}
+
+    # the sport without its closing brace, then its events one at a time
+    stream.write(json.dumps(sport, default=str)[:-1] + ', "events": [')
+    count = 0
+    for event in event_trees(conn, events, active_only, batch_size):
+        stream.write((", " if count else "") + json.dumps(event, default=str))
+        count += 1
+    stream.write("]}\n")
+    return {'found': True, 'events': count}
+
+
+# full text index over the names of all elements, its rowid is id * 4 + the element code
+SEARCH_ELEMENTS = {
+    'sport': ('sports', 0, ('name', 'display_name', 'slug', None)),
+    'event': ('events', 1, ('name', None, 'slug', None)),
+    'market': ('markets', 2, ('name', 'display_name', None, None)),
+    'selection': ('selections', 3, ('name', None, None, 'outcome')),
+}
+
+
+def create_search_index(conn):
+    """
+    It will create the FTS5 index with the triggers keeping it in sync with every write path,
+    including bulk mode, and fill it the first time
+
+    The trigram tokenizer finds a keyword anywhere in a word, as LIKE '%keyword%' does.
+    Sqlite builds without FTS5 or its trigram tokenizer keep working, keyword searches
+    then fall back to LIKE.
+    """
+    if has_search_index(conn):
+        return
+
+    try:
+        conn.execute(text("create virtual table search_index using fts5( \
+            name, display_name, slug, outcome, tokenize = 'trigram')"))
+    except SQLAlchemyError as e:
+        print("Full text search not available: " +
+              str(e).splitlines()[0], file=sys.stderr)
+        return
+
+    for table, code, columns in SEARCH_ELEMENTS.values():
+        values = ", ".join(column or "NULL" for column in columns)
+        new_values = ", ".join(
+            "new." + column if column else "NULL" for column in columns)
+        watched = ", ".join(column for column in columns if column)
+
+        conn.execute(text("insert into search_index(rowid, name, display_name, slug, outcome) \
+            select id * 4 + " + str(code) + ", " + values + " from " + table))
+        conn.execute(text("create trigger " + table + "_search_insert after insert on " + table + " begin \
+            insert into search_index(rowid, name, display_name, slug, outcome) \
+            values (new.id * 4 + " + str(code) + ", " + new_values + "); end"))
+        # only name columns, counters and prices do not touch the index
+        conn.execute(text("create trigger " + table + "_search_update after update of " + watched + " on " + table + " begin \
+            delete from search_index where rowid = old.id * 4 + " + str(code) + "; \
+            insert into search_index(rowid, name, display_name, slug, outcome) \
+            values (new.id * 4 + " + str(code) + ", " + new_values + "); end"))
+        conn.execute(text("create trigger " + table + "_search_delete after delete on " + table + " begin \
+            delete from search_index where rowid = old.id * 4 + " + str(code) + "; end"))
+
+
+def rebuild_search_index(conn):
+    """
+    It will make the FTS5 index and its triggers again, eg. for a new tokenizer
+    """
+    for table, code, columns in SEARCH_ELEMENTS.values():
+        for when in ('insert', 'update', 'delete'):
+            conn.execute(text("drop trigger if exists " + table + "_search_" + when))
+    conn.execute(text("drop table if exists search_index"))
+    create_search_index(conn)
+
+
+# tables whose writes are recorded in the changes table
+CHANGE_TABLES = ('sports', 'events', 'markets', 'marketevents', 'selections')
+
+
+def create_change_log(conn):
     """
-    search with filter
+    It will create the triggers recording every insert, update and delete of the element
+    tables in the changes table, in the same transaction as the write, with the written row
+    as JSON and its time. Updates record the id and the columns they changed, updates
+    which do not change any column are not recorded.
+
+    The triggers are made again, so an upgraded database records the row too. Sqlite
+    builds without JSON functions record the changes without their row.
+    """
+    try:
+        conn.execute(text("select json_object('id', 1)"))
+        json_functions = True
+    except SQLAlchemyError:
+        json_functions = False
+    # the time is added by a later migration than the triggers
+    timed = 'at' in [column['name'] for column in inspect(conn).get_columns('changes')]
+    at_column, now = (", at", ", (julianday('now') - 2440587.5) * 86400.0") if timed else ("", "")
+
+    for table in CHANGE_TABLES:
+        columns = [column.name for column in Base.metadata.tables[table].columns]
+        # order and schema are keywords
+        data = "json_object(" + ", ".join("'" + column + "', new.\"" + column + '"'
+                                          for column in columns) + ")" if json_functions else "NULL"
+        changed = " or ".join('old."' + column + '" is not new."' + column + '"' for column in columns)
+        # unchanged columns are removed, a changed one points to a key the row never has
+        # as json_remove() gives NULL for a NULL path
+        changed_data = "json_remove(" + data + ", " + ", ".join(
+            "case when old.\"" + column + '" is new."' + column + "\" then '$.\"" + column + "\"' else '$.\"-\"' end"
+            for column in columns if column != 'id') + ")" if json_functions else "NULL"
+
+        for op, when, row, condition, values in (('i', 'insert', 'new', "", data),
+                                                 ('u', 'update', 'new', " when " + changed, changed_data),
+                                                 ('d', 'delete', 'old', "", "NULL")):
+            name = table + "_change_" + when
+            conn.execute(text("drop trigger if exists " + name))
+            conn.execute(text("create trigger " + name + " after " + when + " on " + table + condition + " begin \
+                insert into changes(element, row_id, op, data" + at_column + ") \
+                values ('" + table + "', " + row + ".id, '" + op + "', " + values + now + "); end"))
+
+
+# changes after a seq in write order, keyset paged
+TAIL_STATEMENT = select(Change).where(Change.seq > bindparam('seq')).order_by(
+    Change.seq).limit(bindparam('size'))
+
+
+def prune_changes(conn, seq) -> int:
+    """
+    It will remove the changes up to a seq, once every consumer has read them. The last
+    change is kept so the last seq stays known, a seq is never handed out again.
+
+    Returns:
+        [int]: [number of removed changes]
+    """
+    with conn.begin():
+        return conn.execute(delete(Change).where(
+            Change.seq <= int(seq), Change.seq < select(func.max(Change.seq)).scalar_subquery())).rowcount
+
+
+def read_changes(conn, seq, size=500) -> list:
+    """
+    It will give the next changes after a seq
+
+    Returns:
+        [list]: [{"seq", "element", "id", "op", "row"} dicts, row is None for deletes]
+    """
+    return [{'seq': change.seq, 'element': change.element, 'id': change.row_id, 'op': change.op,
+             'row': json.loads(change.data) if change.data else None}
+            for change in conn.execute(TAIL_STATEMENT, {'seq': int(seq), 'size': size})]
+
+
+def tail_changes(conn, seq, stream, follow=False, interval=0.1, batch_size=500) -> dict:
+    """
+    It will write the changes after a seq to the stream as NDJSON, one line per change,
+    and with follow keep waiting for new changes until Ctrl + C
+
+    Args:
+        seq ([int]): [last seq the consumer has seen, 0 for all]
+        interval ([float]): [seconds between two reads when there are no new changes]
+
+    Returns:
+        [dict]: [changes written and the last seq, to tail from next time]
+    """
+    seq = int(seq)
+    count = 0
+    while not interrupted:
+        changes = read_changes(conn, seq, batch_size)
+        for change in changes:
+            stream.write(json.dumps(change) + "\n")
+        stream.flush()
+        count += len(changes)
+        if changes:
+            seq = changes[-1]['seq']
+        elif follow:
+            time.sleep(interval)
+        else:
+            break
+
+    return {'changes': count, 'seq': seq}
+
+
+def has_search_index(conn) -> bool:
+    """
+    It will tell if the database has the full text index
+    """
+    return conn.execute(text("select count(*) from sqlite_master \
+        where type = 'table' and name = 'search_index'")).scalar() > 0
+
+
+# shortest keyword the trigram index can find, shorter ones run as LIKE
+MIN_INDEXED_KEYWORD = 3
+
+
+def use_search_index(conn, keyword) -> bool:
+    """
+    It will tell if a keyword search can run on the full text index
+    """
+    return len(str(keyword)) >= MIN_INDEXED_KEYWORD and has_search_index(conn)
+
+
+def keyword_query(keyword) -> str:
+    """
+    It will turn a keyword into a FTS5 query matching it anywhere in a column,
+    eg. 'ran eng' -> '"ran eng"', quoted so no FTS5 syntax gets through
+    """
+    return '"' + str(keyword).replace('"', '""') + '"'
+
+
+def keyword_pattern(keyword) -> str:
+    """
+    It will turn a keyword into the LIKE pattern of the searches without the index,
+    % and _ of the keyword match themselves as they do in the index
+    """
+    return '%' + re.sub(r"([\\%_])", r"\\\1", str(keyword)) + '%'
+
+
+@functools.lru_cache(maxsize=None)
+def keyword_statement(element, indexed):
+    """
+    It will build the keyword search of an element once, the keyword is its only parameter
+    """
+    if not indexed:
+        selects = []
+        for name, (table, code, columns) in SEARCH_ELEMENTS.items():
+            if element not in ('all', name):
+                continue
+            condition = " or ".join(
+                column + " like :pattern escape '\\'" for column in columns if column)
+            if element == 'all':
+                selects.append("select '" + table + "' as type, id, name, 0 as rank from " +
+                               table + " where " + condition)
+            else:
+                selects.append("select * from " + table + " where " + condition)
+        return text(" union all ".join(selects))
+
+    if element == 'all':
+        types = " ".join("when " + str(code) + " then '" + table + "'"
+                         for table, code, columns in SEARCH_ELEMENTS.values())
+        sql = "select case search_index.rowid % 4 " + types + " end as type, \
+            search_index.rowid / 4 as id, search_index.name, search_index.rank from search_index \
+            where search_index match :query order by search_index.rank"
+    else:
+        table, code, columns = SEARCH_ELEMENTS[element]
+        sql = "select " + table + ".* from search_index \
+            inner join " + table + " on " + table + ".id = search_index.rowid / 4 \
+            where search_index match :query and search_index.rowid % 4 = " + str(code) + " \
+            order by search_index.rank"
+    return text(sql)
+
+
+def keyword_search(conn, element, keyword):
+    """
+    It will search elements of one type, or all types with element 'all', by keyword
+
+    The keyword matches anywhere in a name, display name, slug or outcome, case
+    insensitive. Matches are ranked best first. Without the full text index, or for
+    keywords too short for it, every name column is scanned with LIKE instead, which
+    finds the same rows, unranked.
+
+    Returns:
+        [LegacyCursorResult]: [rows of the element table, or type, id, name and rank for all]
+    """
+    if not use_search_index(conn, keyword):
+        return conn.execute(keyword_statement(element, False), {'pattern': keyword_pattern(keyword)})
+    return conn.execute(keyword_statement(element, True), {'query': keyword_query(keyword)})
+
+
+# elements a filter list can run on
+FILTER_MODELS = {'sport': Sport, 'event': Event,
+                 'market': Market, 'selection': Selection}
+
+# selection fields found on its market event
+SELECTION_PARENT_FIELDS = {'market_id': MarketEvent.market_id,
+                           'event_id': MarketEvent.event_id}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(pattern):
+    """
+    It will compile a pattern once for all rows and all searches using it
+    """
+    return re.compile(pattern)
+
+
+def match_regex(pattern, value) -> bool:
+    """
+    SQL function for the regex filter, registered on every sqlite connection
+    """
+    if value is None:
+        return None
+    return compile_regex(pattern).search(str(value)) is not None
+
+
+@event.listens_for(Engine, "connect")
+def register_functions(dbapi_connection, connection_record):
+    """
+    It will add the python functions used by the generated SQL to a new sqlite connection
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            "match_regex", 2, match_regex, deterministic=True)
+
+
+def compile_predicate(model, predicate):
+    """
+    It will turn one filter into a SQL expression and its evaluation cost
+
+    {"field": "name", "op": "regex", "value": "^Fra"}
+    {"field": "name", "op": "like", "value": "%ran%"}
+    {"field": "active", "op": "eq", "value": 1}
+    {"field": "price", "op": "range", "value": [1.5, 2.5]}
+    {"op": "min_active", "value": 2}
+
+    Raises:
+        [ValueError]: [for an unknown field or operator]
+
+    Returns:
+        [tuple]: [cost, expression], cheaper filters are the indexed ones
+    """
+    op = predicate.get('op')
+    value = predicate.get('value')
+
+    if op == 'min_active':
+        if 'active_children' not in model.__table__.c:
+            raise ValueError(
+                "min_active is not available for " + model.__tablename__)
+        predicate = dict(predicate, field='active_children')
+
+    field = predicate.get('field')
+    if model is Selection and field in SELECTION_PARENT_FIELDS:
+        column = SELECTION_PARENT_FIELDS[field]
+    elif field in model.__table__.c:
+        column = model.__table__.c[field]
+    else:
+        raise ValueError("unknown field " + str(field) +
+                         " for " + model.__tablename__)
+
+    indexed = column.primary_key or any(index.columns.values()[0] is column
+                                        for index in column.table.indexes)
+    if op == 'eq':
+        return (0 if indexed else 2), column == value
+    elif op == 'range':
+        low, high = value
+        bounds = []
+        if low is not None:
+            bounds.append(column >= low)
+        if high is not None:
+            bounds.append(column <= high)
+        return (1 if indexed else 2), and_(*bounds)
+    elif op == 'min_active':
+        return (1 if indexed else 2), column > int(value)
+    elif op == 'like':
+        return 3, column.like(value)
+    elif op == 'regex':
+        compile_regex(value)
+        return 4, func.match_regex(value, column)
+
+    raise ValueError("unknown filter operator " + str(op))
+
+
+def compile_filters(element, filters):
+    """
+    It will combine N filters on an element with AND into a single parameterized statement
+
+    Filters are ordered so the indexed ones run first and the python regex
+    function only sees the rows left by them.
+
+    Args:
+        element ([str]): [sport, event, market or selection]
+        filters ([list]): [filters as taken by compile_predicate()]
+
+    Raises:
+        [ValueError]: [for an unknown element, field or operator]
+
+    Returns:
+        [Select]: [statement selecting the matched elements]
+    """
+    if element not in FILTER_MODELS:
+        raise ValueError("unknown element " + str(element))
+
+    model = FILTER_MODELS[element]
+    predicates = sorted((compile_predicate(model, predicate) for predicate in filters),
+                        key=lambda predicate: predicate[0])
+
+    stmt = select(model.__table__)
+    if model is Selection and any(predicate.get('field') in SELECTION_PARENT_FIELDS for predicate in filters):
+        stmt = stmt.join(MarketEvent.__table__,
+                         Selection.marketevent_id == MarketEvent.id)
+
+    return stmt.where(and_(True, *[expression for cost, expression in predicates])).order_by(model.id)
+
+
+@functools.lru_cache(maxsize=None)
+def active_statement():
+    """
+    It will build the search of elements with more active children than a threshold once
+    """
+    return union_all(*[
+        select(literal(model.__tablename__).label('type'), model.id, model.name,
+               model.active_children.label('active_cnt')).where(model.active_children > bindparam('threshold'))
+        for model in (Sport, Event, Market)])
+
+
+class RowsResult:
+    """
+    This class will hand out search results held in memory like a cursor result,
+    with keys() and fetchmany(), eg. the rows of the columnar snapshot
+    """
+
+    def __init__(self, keys, rows):
+        self._keys = list(keys)
+        self.rows = rows
+        self.position = 0
+
+    def keys(self) -> list:
+        return list(self._keys)
+
+    def fetchmany(self, size) -> list:
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self) -> list:
+        return self.fetchmany(len(self.rows))
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.position = len(self.rows)
+
+
+class Page(RowsResult):
+    """
+    This class will hand out one page of search results, with the cursor of the next
+    page or None on the last one
+    """
+
+    def __init__(self, keys, rows, next_cursor=None):
+        super().__init__(keys, rows)
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(row_type, row_id) -> str:
+    """
+    It will make the opaque token of the page after a row
+    """
+    return base64.urlsafe_b64encode(json.dumps([row_type, row_id]).encode()).decode()
+
+
+def decode_cursor(token) -> tuple:
+    """
+    It will give back the type and id of the last row of a page
+
+    Raises:
+        [ValueError]: [for a token not made by encode_cursor()]
+    """
+    try:
+        row_type, row_id = json.loads(base64.urlsafe_b64decode(str(token).encode()))
+        return str(row_type), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor " + str(token))
+
+
+@functools.lru_cache(maxsize=None)
+def keyword_page_statement(element, indexed, types):
+    """
+    It will build one page of a keyword search once, every type reads at most :limit
+    rows after its own :after_<type> id in id order, so a later page costs the same
+    """
+    selects = []
+    for name, (table, code, columns) in SEARCH_ELEMENTS.items():
+        if table not in types:
+            continue
+        if not indexed:
+            condition = "(" + " or ".join(column + " like :pattern escape '\\'" for column in columns if column) + \
+                ") and id > :after_" + table
+            if element == 'all':
+                selects.append("select '" + table + "' as type, id, name, 0 as rank from " +
+                               table + " where " + condition + " order by id limit :limit")
+            else:
+                selects.append("select * from " + table + " where " +
+                               condition + " order by id limit :limit")
+        elif element == 'all':
+            selects.append("select '" + table + "' as type, rowid / 4 as id, name, rank from search_index \
+                where search_index match :query and rowid % 4 = " + str(code) + " \
+                and rowid > :after_" + table + " * 4 + " + str(code) + " order by rowid limit :limit")
+        else:
+            selects.append("select " + table + ".* from search_index \
+                inner join " + table + " on " + table + ".id = search_index.rowid / 4 \
+                where search_index match :query and search_index.rowid % 4 = " + str(code) + " \
+                and search_index.rowid > :after_" + table + " * 4 + " + str(code) + " \
+                order by search_index.rowid limit :limit")
+
+    if len(selects) == 1:
+        return text(selects[0])
+    return text(" union all ".join("select * from (" + sql + ")" for sql in selects) +
+                " order by type, id limit :limit")
+
+
+@functools.lru_cache(maxsize=None)
+def active_page_statement(types):
+    """
+    It will build one page of the active threshold search once, same keyset as keyword pages
+    """
+    return union_all(*[
+        select(select(literal(model.__tablename__).label('type'), model.id, model.name,
+                      model.active_children.label('active_cnt'))
+               .where(model.active_children > bindparam('threshold'),
+                      model.id > bindparam('after_' + model.__tablename__))
+               .order_by(model.id).limit(bindparam('limit')).subquery())
+        for model in (Sport, Event, Market) if model.__tablename__ in types]
+    ).order_by(literal_column('type'), literal_column('id')).limit(bindparam('limit'))
+
+
+def search_page(conn, parameters) -> Page:
+    """
+    It will run one page of any search, ordered by type then id instead of rank
+
+    Args:
+        parameters ([dict]): [search filter with "limit" and the "cursor" of the previous page]
+
+    Raises:
+        [ValueError]: [for a bad limit or cursor, or an unknown filter]
+    """
+    limit = int(parameters['limit'])
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    element = next((key for key in ('all',) + tuple(SEARCH_ELEMENTS) if key in parameters), None)
+    if element == 'all':
+        types = sorted(table for table, code, columns in SEARCH_ELEMENTS.values())
+    elif element is not None:
+        types = [SEARCH_ELEMENTS[element][0]]
+    elif 'filters' in parameters:
+        stmt = compile_filters(parameters.get('on'), parameters['filters'])
+        model = FILTER_MODELS[parameters['on']]
+        types = [model.__tablename__]
+    elif 'active' in parameters:
+        types = sorted(model.__tablename__ for model in (Sport, Event, Market))
+    else:
+        raise ValueError("nothing to search")
+
+    after_type, after_id = types[0], -1
+    if parameters.get('cursor'):
+        after_type, after_id = decode_cursor(parameters['cursor'])
+        if after_type not in types:
+            raise ValueError("invalid cursor " + str(parameters['cursor']))
+
+    # types before the cursor are done, the cursor type goes on after its id
+    types = tuple(table for table in types if table >= after_type)
+    values = {'after_' + table: after_id if table == after_type else -1 for table in types}
+    # one more row tells if there is a next page
+    values['limit'] = limit + 1
+
+    if element is not None:
+        if use_search_index(conn, parameters[element]):
+            values['query'] = keyword_query(parameters[element])
+            result = conn.execute(keyword_page_statement(element, True, types), values)
+        else:
+            values['pattern'] = keyword_pattern(parameters[element])
+            result = conn.execute(keyword_page_statement(element, False, types), values)
+    elif 'filters' in parameters:
+        result = conn.execute(stmt.where(model.id > bindparam('after_' + types[0]))
+                              .limit(bindparam('limit')), values)
+    else:
+        values['threshold'] = int(parameters['active'])
+        result = conn.execute(active_page_statement(types), values)
+
+    keys = list(result.keys())
+    rows = result.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        next_cursor = encode_cursor(last.get('type', types[0]), last['id'])
+    return Page(keys, rows, next_cursor)
+
+
+def search(conn, session, args, snapshot=None):
+    """
+    search with filter, from the columnar snapshot when one is given and it can answer
     """
     {"all": "text"}
     {"sport": "text"}
@@ -462,135 +2539,633 @@ def search(conn, session, args):
     {"event": "text"}
     {"selection": "text"}
     {"active": "1"}
+    {"filters": [{"field": "name", "op": "regex", "value": "^Fra"}], "on": "event"}
+    {"all": "text", "limit": 50, "cursor": "..."}
 
     if is_json(args['<filter>']):
         parameters = json.loads(args['<filter>'])
         result = None
         keyword = None
 
+        if 'limit' in parameters:
+            # pages always run as SQL, the keyset seeks are what makes them cheap
+            return search_page(conn, parameters)
+
+        if snapshot is not None:
+            # loaded already, the snapshot comes from it
+            import columnar_app
+            snapshot.refresh(conn)
+            try:
+                return snapshot.search(parameters)
+            except columnar_app.Unsupported:
+                # keyword searches and filters it can not mirror exactly run as SQL
+                pass
+
         if 'all' in parameters:
             keyword = parameters['all']
-
-            sql = "select * from sports s \
-                    left join events e on e.sport_id = s.id \
-                    left join marketevents me on me.event_id = e.id \
-                    left join markets m on me.market_id = m.id \
-                    left join selections se on se.marketevent_id = me.id \
-                    group by se.id \
-                    having s.name like '%" + keyword + "%' or \
-                    e.name like '%" + keyword + "%' or \
-                    m.name like '%" + keyword + "%' or \
-                    se.name like '%" + keyword + "%'"
-            result = conn.execute(sql)
+            result = keyword_search(conn, 'all', keyword)
 
         elif 'sport' in parameters:
-            sql = "select * from sports s \
-                    where s.name like '%" + keyword + "%' or \
-                    s.display_name like '%" + keyword + "%' or \
-                    s.slug like '%" + keyword + "%'"
-            result = conn.execute(sql)
+            keyword = parameters['sport']
+            result = keyword_search(conn, 'sport', keyword)
 
         elif 'market' in parameters:
-            sql = "select * from market m \
-                    where m.name like '%" + keyword + "%' or \
-                    m.display_name like '%" + keyword + "%'"
-            result = conn.execute(sql)
+            keyword = parameters['market']
+            result = keyword_search(conn, 'market', keyword)
 
         elif 'event' in parameters:
-            sql = "select * from events e \
-                    where e.name like '%" + keyword + "%' or \
-                    e.slug like '%" + keyword + "%'"
-            result = conn.execute(sql)
+            keyword = parameters['event']
+            result = keyword_search(conn, 'event', keyword)
 
         elif 'selection' in parameters:
-            sql = "select * from selections s \
-                    where s.name like '%" + keyword + "%' or \
-                    s.outcome like '%" + keyword + "%'"
-            result = conn.execute(sql)
+            keyword = parameters['selection']
+            result = keyword_search(conn, 'selection', keyword)
+
+        elif 'filters' in parameters:
+            # N filters combined with AND
+            stmt = compile_filters(parameters.get('on'), parameters['filters'])
+            result = conn.execute(stmt)
 
         elif 'active' in parameters:
-            # minimum number of active child
-            threshold = parameters['active']
-
-            sql = "select 'sports' as 'type', s.id, s.name, count(e.id) as 'active_cnt' from sports s \
-                inner join events e on e.sport_id = s.id \
-                group by s.id \
-                having e.active = 1 and count(e.id) > " + threshold + " \
-                UNION \
-                select 'events' as 'type', e.id, e.name, count(se.id) as 'active_cnt' from events e \
-                inner join marketevents me on me.event_id = e.id \
-                inner join selections se on se.marketevent_id = me.id \
-                group by e.id \
-                having se.active = 1 and count(se.id) > " + threshold + " \
-                UNION \
-                select 'markets' as 'type', m.id, m.name, count(se.id) as 'active_cnt' from markets m \
-                inner join marketevents me on me.market_id = m.id \
-                inner join selections se on se.marketevent_id = me.id \
-                group by m.id \
-                having se.active = 1 and count(se.id) > " + threshold + ""
-            result = conn.execute(sql)
+            # minimum number of active child, sports count active events,
+            # events count active markets and markets count active selections
+            result = conn.execute(active_statement(), {
+                                  'threshold': int(parameters['active'])})
 
         return result
 
 
+# one step of EXPLAIN QUERY PLAN eg. "SEARCH events USING INDEX eventsportactiveindex (sport_id=?)"
+PLAN_STEP = re.compile(r"(SCAN|SEARCH) (\w+)(?: AS (\w+))?(?: USING (?:(?:COVERING )?INDEX (\w+)|INTEGER PRIMARY KEY))?(?: \((.*)\))?")
+
+
+def query_plan(dbapi_connection, statement, parameters=()) -> list:
+    """
+    It will give the EXPLAIN QUERY PLAN steps of a statement with the rows sqlite will
+    likely read in each, from sqlite_stat1 when ANALYZE was run, otherwise from the table size
+
+    Args:
+        dbapi_connection ([sqlite3.Connection]): [a sqlite connection, no SQLAlchemy events fire]
+
+    Returns:
+        [list]: [{"depth", "detail", "table", "index", "rows"} per step, rows None when unknown]
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        plan = cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters or ()).fetchall()
+        stats = {}
+        if cursor.execute("select count(*) from sqlite_master where name = 'sqlite_stat1'").fetchone()[0]:
+            stats = {(table, index): stat for table, index, stat in cursor.execute(
+                "select tbl, idx, stat from sqlite_stat1")}
+
+        depths = {0: -1}
+        steps = []
+        for step_id, parent, unused, detail in plan:
+            depths[step_id] = depths.get(parent, -1) + 1
+            step = {'depth': depths[step_id], 'detail': detail, 'table': None, 'index': None, 'rows': None}
+            match = PLAN_STEP.match(detail)
+            if match and match.group(2) in Base.metadata.tables:
+                step['table'], step['index'] = match.group(2), match.group(4)
+                step['rows'] = estimate_rows(cursor, stats, match.group(1), step['table'], step['index'],
+                                             match.group(5) or '')
+            steps.append(step)
+        return steps
+    finally:
+        cursor.close()
+
+
+def estimate_rows(cursor, stats, kind, table, index, terms):
+    """
+    It will guess the rows read by one plan step, the way the sqlite planner does
+    """
+    stat = stats.get((table, index)) or stats.get((table, table)) or stats.get((table, None))
+    total = int(stat.split()[0]) if stat else (
+        cursor.execute("select max(rowid) from " + table).fetchone()[0] or 0)
+    if kind == 'SCAN':
+        return total
+
+    equalities = len(re.findall(r"(?<![<>!])=", terms))
+    if index is None:
+        rows = 1 if equalities else total
+    elif stat and equalities and len(stat.split()) > equalities:
+        rows = int(stat.split()[equalities])
+    else:
+        # sqlite assumes about 10 rows per key without statistics
+        rows = min(total, 10) if equalities else total
+    # a range keeps about a quarter of the rows
+    if re.search(r"[<>]", terms):
+        rows = max(1, rows // 4)
+    return rows
+
+
+def format_plan(statement, steps) -> str:
+    """
+    It will print a statement with its plan as an indented tree
+    """
+    lines = [statement.strip()]
+    for step in steps:
+        lines.append("  " * (step['depth'] + 1) + step['detail'] +
+                     ("" if step['rows'] is None else " (~" + str(step['rows']) + " rows)"))
+    return "\n".join(lines)
+
+
+def explain_search(conn, session, args) -> str:
+    """
+    It will run a search and give the query plan of every statement it sent to sqlite,
+    with the bound parameters, so a LIKE or UNION shows the scans it does
+    """
+    plans = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        plans.append(format_plan(statement, query_plan(cursor.connection, statement, parameters)) +
+                     "\n  parameters: " + json.dumps(parameters, default=str))
+
+    event.listen(conn, "before_cursor_execute", capture)
+    try:
+        result = search(conn, session, args)
+        if result is not None:
+            result.close()
+    finally:
+        event.remove(conn, "before_cursor_execute", capture)
+    return "\n\n".join(plans)
+
+
+def schema_copy(dbapi_connection):
+    """
+    It will make an empty in memory database with the schema and the statistics of a database,
+    indexes can be tried there without building them on the real tables
+    """
+    copy = sqlite3.connect(':memory:')
+    register_functions(copy, None)
+    for sql, in dbapi_connection.execute("select sql from sqlite_master where sql is not null \
+            and name not like 'sqlite_%' order by type != 'table', rowid").fetchall():
+        try:
+            copy.execute(sql)
+        except sqlite3.OperationalError:
+            # shadow tables made by their full text table already
+            pass
+
+    stats = dbapi_connection.execute("select count(*) from sqlite_master where name = 'sqlite_stat1'").fetchone()[0]
+    if stats:
+        copy.execute("ANALYZE")
+        copy.executemany("insert into sqlite_stat1(tbl, idx, stat) values (?, ?, ?)",
+                         dbapi_connection.execute("select tbl, idx, stat from sqlite_stat1").fetchall())
+        # the planner reads the statistics again
+        copy.execute("ANALYZE sqlite_master")
+    return copy
+
+
+def filtered_columns(statement, table) -> list:
+    """
+    It will find the columns of a table a statement compares, equalities first
+    """
+    # not the selected columns
+    where = statement[re.search(r"\bFROM\b", statement, re.I).start():]
+    columns = [column.name for column in Base.metadata.tables[table].columns if not column.primary_key]
+    found = {}
+    for column in columns:
+        for match in re.finditer(r'(?:\b\w+\.)?"?\b' + column + r'\b"?\s*(=|<|>|IN\b|IS\b|LIKE\b)', where, re.I):
+            found[column] = min(found.get(column, 1), 0 if match.group(1) in ('=', 'IN', 'IS') else 1)
+    return sorted(found, key=lambda column: (found[column], columns.index(column)))
+
+
+def advise_indexes(conn, log_path) -> list:
+    """
+    It will read the slow query log and try indexes for the full table scans of its statements
+    on a copy of the schema, suggesting the one which turns the scan into an index search
+
+    Returns:
+        [list]: [{"table", "index", "statements", "slow_runs", "total_ms", "example"}, slowest first,
+                 index is None when no index helps eg. LIKE with a leading %]
+    """
+    statements = {}
+    with open(log_path) as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            entry = statements.setdefault(record['statement'], {'runs': 0, 'ms': 0.0})
+            entry['runs'] += 1
+            entry['ms'] += record['ms']
+            entry['parameters'] = record['parameters'][0] if record.get('executemany') else record['parameters']
+
+    copy = schema_copy(conn.connection)
+    suggestions = {}
+    try:
+        for statement, entry in statements.items():
+            try:
+                steps = query_plan(copy, statement, entry['parameters'])
+            except sqlite3.Error:
+                # eg. temp tables of the writing connection
+                continue
+
+            for table in {step['table'] for step in steps if step['table'] and step['detail'].startswith("SCAN")}:
+                columns = filtered_columns(statement, table)
+                # the smallest index first, so related statements share it
+                candidates = [(column,) for column in columns] + ([tuple(columns)] if len(columns) > 1 else [])
+                helping = None
+                for candidate in candidates:
+                    copy.execute("SAVEPOINT advise")
+                    try:
+                        copy.execute("CREATE INDEX advise_candidate ON " + table +
+                                     " (" + ", ".join('"' + column + '"' for column in candidate) + ")")
+                        tried = query_plan(copy, statement, entry['parameters'])
+                    finally:
+                        copy.execute("ROLLBACK TO advise")
+                        copy.execute("RELEASE advise")
+                    if not any(step['table'] == table and step['detail'].startswith("SCAN") for step in tried):
+                        helping = candidate
+                        break
+
+                index = helping and "CREATE INDEX " + table + "_" + "_".join(helping) + "_index ON " + \
+                    table + " (" + ", ".join(helping) + ")"
+                suggestion = suggestions.setdefault((table, index), {
+                    'table': table, 'index': index, 'statements': 0, 'slow_runs': 0, 'total_ms': 0.0,
+                    'example': statement.strip()})
+                suggestion['statements'] += 1
+                suggestion['slow_runs'] += entry['runs']
+                suggestion['total_ms'] = round(suggestion['total_ms'] + entry['ms'], 3)
+    finally:
+        copy.close()
+
+    return sorted(suggestions.values(), key=lambda suggestion: -suggestion['total_ms'])
+
+
+# pages copied per step of a backup, the source is unlocked between steps
+BACKUP_PAGES = 1024
+
+
+def export_db(engine, path, pages=BACKUP_PAGES) -> dict:
+    """
+    It will copy the database to a file with the sqlite online backup API
+
+    The copy is consistent, a write by another connection during the copy makes
+    sqlite start it again. With a WAL profile readers never block writers, so the
+    copy does not stop the application.
+
+    Returns:
+        [dict]: [file, bytes and seconds]
+    """
+    started = time.perf_counter()
+    source = engine.raw_connection()
+    target = sqlite3.connect(path)
+    try:
+        source.connection.backup(target, pages=pages)
+    finally:
+        target.close()
+        source.close()
+
+    return {'file': path, 'bytes': os.path.getsize(path),
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def import_db(engine, path) -> dict:
+    """
+    It will replace the database with a copy made by export_db(), then upgrade its schema
+
+    Raises:
+        [ValueError]: [when the file is missing or not a sound sqlite database]
+    """
+    started = time.perf_counter()
+    if not exists(path):
+        raise ValueError(path + " does not exist")
+    source = None
+    target = engine.raw_connection()
+    try:
+        source = sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+        check = source.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            raise ValueError(path + " is damaged: " + check)
+        source.backup(target.connection, pages=-1)
+    except sqlite3.DatabaseError as e:
+        raise ValueError(path + " is not a database: " + str(e))
+    finally:
+        target.close()
+        if source is not None:
+            source.close()
+
+    # connections of this engine may cache ids of the old rows
+    engine.dispose()
+    init_db(engine)
+    return {'file': path, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def run_command(conn, session, args, snapshot=None):
+    """
+    It will run the add, update, delete, search or settle command given in the cli arguments
+    """
+    if args['-a'] and args['<element>'] != None:
+        return add(conn, session, args)
+    elif args['-u'] and args['<element>'] != None:
+        return update_element(conn, session, args)
+    elif args['-d'] and args['<element>'] != None:
+        return delete_element(conn, session, args)
+    elif args['-f'] and args['<filter>'] != None:
+        return search(conn, session, args, snapshot)
+    elif args.get('--settle'):
+        return settle(conn, args['--settle'])
+
+    return "No option provided"
+
+
+def command_args(request) -> dict:
+    """
+    It will turn a server request into cli arguments
+
+    Args:
+        request ([dict]): [one command flag with its JSON eg. {"-a": {"sport": {...}}}]
+
+    Raises:
+        [ValueError]: [when the request is not one known command]
+    """
+    if not isinstance(request, dict) or len(request) != 1 or next(iter(request)) not in SERVER_COMMANDS:
+        raise ValueError("expected one of " + ", ".join(SERVER_COMMANDS))
+
+    flag, payload = next(iter(request.items()))
+    args = {command: False for command in SERVER_COMMANDS}
+    args.update({'<element>': None, '<filter>': None, flag: True})
+    args[SERVER_COMMANDS[flag]] = payload if isinstance(
+        payload, str) else json.dumps(payload)
+    return args
+
+
+def response_json(response) -> str:
+    """
+    It will encode a command response as one JSON line, search results as columns and rows
+    """
+    # search results of sqlite or of the columnar snapshot
+    if isinstance(response, CursorResult) or hasattr(response, 'fetchmany'):
+        reply = {'columns': list(response.keys()),
+                 'rows': [list(row) for row in response]}
+        if isinstance(response, Page):
+            reply['cursor'] = response.next_cursor
+        return json.dumps(reply, default=str)
+    return json.dumps({'response': response}, default=str)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """
+    This class will answer the newline delimited JSON requests of one client
+    using the warm connection and session of the server
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                args = command_args(json.loads(line))
+                # sqlite has one writer, commands run one at a time
+                with self.server.lock:
+                    try:
+                        reply = response_json(run_command(
+                            self.server.conn, self.server.session, args, self.server.snapshot))
+                    finally:
+                        if self.server.instrumentation is not None:
+                            self.server.instrumentation.end_command(
+                                command_name(args))
+            except Exception as e:
+                # any bad request is answered, the client and the server keep going
+                with self.server.lock:
+                    self.server.session.rollback()
+                reply = json.dumps({'error': (str(e).splitlines() or [type(e).__name__])[0]})
+
+            self.wfile.write(reply.encode() + b"\n")
+            self.wfile.flush()
+
+
+def make_server(engine, path, columnar=False, snapshot=None, instrumentation=None):
+    """
+    It will open a unix socket server sharing one connection and session of the engine
+    The engine must allow its connections to be used from the handler threads.
+    With columnar, filter searches are answered from a NumPy snapshot of the tables,
+    read from the database or mapped from the snapshot directory written by --export.
+    """
+    if exists(path):
+        os.remove(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, CommandHandler)
+    server.daemon_threads = True
+    server.conn = engine.connect()
+    server.session = Session(bind=engine)
+    server.lock = threading.Lock()
+    server.instrumentation = instrumentation
+    server.snapshot = None
+    if snapshot:
+        # numpy is only needed by this mode
+        import columnar_app
+        server.snapshot = columnar_app.ColumnarSnapshot.open(snapshot)
+        server.snapshot.refresh(server.conn)
+    elif columnar:
+        import columnar_app
+        server.snapshot = columnar_app.ColumnarSnapshot.load(server.conn)
+    return server
+
+
+def serve(engine, path, columnar=False, snapshot=None, instrumentation=None):
+    """
+    It will answer commands on the unix socket until Ctrl + C
+    """
+    server = make_server(engine, path, columnar, snapshot, instrumentation)
+    if instrumentation is not None:
+        # loading the snapshot is not a request
+        instrumentation.end_command("--serve")
+    server.timeout = 0.5
+    print("Serving on " + path, file=sys.stderr)
+
+    try:
+        while not interrupted:
+            server.handle_request()
+    finally:
+        print("Hierarchy cache " + json.dumps(hierarchy_cache(server.conn).stats()), file=sys.stderr)
+        server.server_close()
+        server.session.close()
+        server.conn.close()
+        os.remove(path)
+
+    return "Server stopped"
+
+
 # starting point
 def cli():
     """
     This is the cli or command line interface for send command to rc tool
     """
-    args = docopt(__doc__, version='App 1.0', help=True)
+    args = docopt(__doc__, version=VERSION, help=True)
+
+    answered, response = light_cli(args)
+    if answered:
+        return response
 
     # Create DB connection with sqlite
-    engine = create_engine("sqlite:///app.sqlite")
+    config = load_db_config()
+    instrumentation = None
+    if args['--profile'] or config['metrics_file'] or config['slow_query_ms'] is not None:
+        instrumentation = Instrumentation(
+            config['metrics_file'], config['slow_query_ms'], config['slow_query_log'])
+    if args['--serve']:
+        # server connections are shared by the handler threads under a lock
+        engine = get_engine(config, instrumentation=instrumentation,
+                            connect_args={'check_same_thread': False})
+    else:
+        engine = get_engine(config, instrumentation=instrumentation)
     conn = engine.connect()
     session = Session(bind=engine)
-    inspector = inspect(engine)
-
-    # create index
-    sportnameindex = Index('sportnameindex', Sport.name)
-    sportdisplaynameindex = Index('sportdisplaynameindex', Sport.display_name)
-    sportactiveindex = Index('sportactiveindex', Sport.active)
-    sportslugindex = Index('sportslugindex', Sport.slug)
-    eventnameindex = Index('eventnameindex', Event.name)
-    eventslugindex = Index('eventslugindex', Event.slug)
-    eventactiveindex = Index('eventactiveindex', Event.active)
-    marketnameindex = Index('marketnameindex', Market.name)
-    marketdisplaynameindex = Index(
-        'marketdisplaynameindex', Market.display_name)
-    marketeventindex = Index('marketeventindex', MarketEvent.active)
-    selectionnameindex = Index('selectionnameindex', Selection.name)
-    selectionactiveindex = Index('selectionactiveindex', Selection.active)
 
-    # Create metadata layer that abstracts our SQL DB
-    Base.metadata.create_all(engine)
+    # Create metadata layer that abstracts our SQL DB, indexes come with the migrations
+    init_db(engine)
 
-    # comment out following index creation lines first time
-    # sportnameindex.create(bind=engine)
-    # sportdisplaynameindex.create(bind=engine)
-    # sportactiveindex.create(bind=engine)
-    # sportslugindex.create(bind=engine)
-    # eventnameindex.create(bind=engine)
-    # eventslugindex.create(bind=engine)
-    # eventactiveindex.create(bind=engine)
-    # marketnameindex.create(bind=engine)
-    # marketdisplaynameindex.create(bind=engine)
-    # marketeventindex.create(bind=engine)
-    # selectionnameindex.create(bind=engine)
-    # selectionactiveindex.create(bind=engine)
+    try:
+        return run_cli(args, config, engine, conn, session, instrumentation)
+    finally:
+        if instrumentation is not None:
+            if args['--serve']:
+                # its requests were recorded one by one
+                record = instrumentation.report()
+            else:
+                record = instrumentation.end_command(command_name(args))
+            if args['--profile']:
+                print(json.dumps(record), file=sys.stderr)
 
+
+def run_cli(args, config, engine, conn, session, instrumentation=None):
+    """
+    It will run the command given on the command line
+
+    Args:
+        args ([dict]): [arguments as parsed by docopt]
+        config ([dict]): [settings as given by load_db_config()]
+        instrumentation ([Instrumentation]): [counts the statements of every engine opened]
+    """
     # call for create an element
-    if args['-a'] and args['<element>'] != None:
-        response = add(conn, session, args)
-    elif args['-u'] and args['<element>'] != None:
-        response = update_element(conn, session, args)
-    elif args['-d'] and args['<element>'] != None:
-        response = delete_element(conn, session, args)
+    if (args['-a'] or args['-u'] or args['-d']) and args['<element>'] != None:
+        response = run_command(conn, session, args)
     elif args['-f'] and args['<filter>'] != None:
-        response = search(conn, session, args)
+        if config['read_only_search']:
+            # searches never wait for or hold the write lock
+            conn = get_engine(config, read_only=True,
+                              instrumentation=instrumentation).connect()
+
+        try:
+            if args['--explain']:
+                return explain_search(conn, session, args)
+            response = run_command(conn, session, args)
+            if args['--format']:
+                # stream batches straight from the cursor
+                batch_size = int(args['--batch'])
+                write_rows(list(response.keys()), iter(lambda: response.fetchmany(batch_size), []),
+                           sys.stdout, args['--format'], args['--columns'] and args['--columns'].split(','))
+                if isinstance(response, Page) and response.next_cursor:
+                    print("next cursor " + response.next_cursor, file=sys.stderr)
+                return None
+        except ValueError as e:
+            return str(e)
+
         for res in response:
             print(res)
 
+        if isinstance(response, Page):
+            # printed after the rows, None on the last page
+            return response.next_cursor
         return response
+    elif args['--advise']:
+        try:
+            suggestions = advise_indexes(conn, args['--advise'])
+        except OSError as e:
+            return "no slow query log at " + args['--advise'] + ": " + (e.strerror or str(e))
+        for suggestion in suggestions:
+            print(json.dumps(suggestion))
+        return None
+    elif args['--tree']:
+        if config['read_only_search']:
+            conn = get_engine(config, read_only=True,
+                              instrumentation=instrumentation).connect()
+        try:
+            root = json.loads(args['--tree'])
+            element, row_id = next(iter(root.items()))
+            response = write_tree(conn, element, row_id, sys.stdout,
+                                  args['--active'], int(args['--batch']))
+        except (ValueError, AttributeError, StopIteration):
+            return "expected a root like {\"sport\": 1} or {\"event\": 1}"
+        # the tree went to stdout
+        return None if response['found'] else "Root not found"
+    elif args['--settle']:
+        try:
+            response = run_command(conn, session, args)
+        except ValueError as e:
+            response = str(e)
+    elif args['--serve']:
+        response = serve(engine, args['--serve'], config['columnar_search'],
+                         args['--snapshot'], instrumentation)
+    elif args['--bulk']:
+        # - reads the elements from stdin eg. piped from a feed
+        stream = sys.stdin if args['--bulk'] == '-' else open(args['--bulk'])
+        with stream:
+            if args['--workers'] == '1':
+                response = bulk_add(conn, stream, int(args['--batch']))
+            else:
+                response = parallel_bulk_add(conn, stream, int(
+                    args['--batch']), int(args['--workers']) or None)
+
+    elif args['--ticks']:
+        window = int(args['--window']) / 1000
+        if args['--ticks'] == '-':
+            response = ingest_ticks(conn, sys.stdin, window)
+        else:
+            with open(args['--ticks']) as stream:
+                response = ingest_ticks(conn, stream, window)
+    elif args['--tail']:
+        if config['read_only_search']:
+            conn = get_engine(config, read_only=True,
+                              instrumentation=instrumentation).connect()
+        response = tail_changes(conn, args['--tail'], sys.stdout,
+                                args['--follow'], batch_size=int(args['--batch']))
+        # the changes went to stdout
+        print(json.dumps(response), file=sys.stderr)
+        return None
+    elif args.get('--record-history') or args.get('--prices'):
+        if not config['price_history']:
+            return "no price history, set price_history in the database settings or APP_PRICE_HISTORY"
+        # the history is opt in, the other commands never import it
+        import history_app
+        # queries only read the segments, writing and merging them is the recorder's job
+        history = history_app.PriceHistory(config['price_history'], read_only=bool(args['--prices']))
+        try:
+            if args['--prices']:
+                try:
+                    history_app.write_prices(history, args['--prices'], sys.stdout)
+                except (ValueError, TypeError) as e:
+                    return "expected a query like {\"selection\": 12, \"interval\": 60}: " + str(e)
+                # the prices went to stdout
+                return None
+            elif args['--follow']:
+                response = history.follow(conn)
+            else:
+                response = history.record(conn)
+                history.flush()
+        finally:
+            history.close()
+    elif args['--export']:
+        response = export_db(engine, args['--export'])
+        if args['--snapshot']:
+            import columnar_app
+            # taken from the copy, so it matches the exported rows
+            with create_engine("sqlite:///" + args['--export']).connect() as copy:
+                columnar_app.ColumnarSnapshot.load(
+                    copy).save(args['--snapshot'])
+    elif args['--import']:
+        try:
+            response = import_db(engine, args['--import'])
+        except ValueError as e:
+            response = str(e)
+    elif args.get('--prune-changes'):
+        response = prune_changes(conn, args['--prune-changes'])
+    elif args['--rebuild-counts']:
+        with conn.begin():
+            rebuild_counts(conn)
+        response = True
 
     # call for update an element
     elif args['-u'] and args['-u']:
@@ -609,4 +3184,5 @@ So when you are building with poetry kindly comment the following part.
 """
 if __name__ == "__main__":
     response = cli()
-    print(response)
+    if response is not None:
+        print(response)
@@ -0,0 +1,180 @@
+"""
+Asyncio interface to the add, update, delete and search commands of the sports bet application.
+
+Writes of any number of coroutines go through one queue to a single writer thread
+owning the only write connection, the commands queued meanwhile run together in one
+thread hop. Searches run on a reader thread with its own connection and are read as
+async iterators, fetching the rows in batches.
+
+    store = AsyncStore()
+    await store.start()
+    sport_id = await store.add({"sport": {"name": "football", ...}})
+    async for row in store.search({"event": "france"}):
+        print(row)
+    await store.close()
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from sqlalchemy.orm import Session
+
+
+class AsyncStore:
+    """
+    This class will run the commands of app.py for coroutines without blocking the event loop
+
+    Args:
+        config ([dict]): [database settings as given by app.load_db_config()]
+        batch ([int]): [most queued writes run per thread hop]
+        fetch_size ([int]): [rows fetched per thread hop by search]
+    """
+
+    def __init__(self, config=None, batch=100, fetch_size=500):
+        self.config = config or app.load_db_config()
+        self.batch = batch
+        self.fetch_size = fetch_size
+        # sqlite objects stay on the thread that made them
+        self.writer_pool = ThreadPoolExecutor(max_workers=1)
+        self.reader_pool = ThreadPoolExecutor(max_workers=1)
+        self.writes = None
+        self.writer = None
+
+    async def start(self):
+        """
+        It will open the writer and reader connections, creating the schema if needed
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer_pool, self.open_writer)
+        await loop.run_in_executor(self.reader_pool, self.open_reader)
+        self.writes = asyncio.Queue()
+        self.writer = asyncio.create_task(self.write_loop())
+        return self
+
+    def open_writer(self):
+        engine = app.get_engine(self.config)
+        app.init_db(engine)
+        self.write_conn = engine.connect()
+        self.write_session = Session(bind=engine)
+
+    def open_reader(self):
+        engine = app.get_engine(
+            self.config, read_only=self.config['read_only_search'])
+        self.read_conn = engine.connect()
+
+    async def add(self, element):
+        """
+        It will add an element, same JSON as -a, and give its new id
+        """
+        return await self.write('-a', element)
+
+    async def update(self, element):
+        """
+        It will update an element, same JSON as -u
+        """
+        return await self.write('-u', element)
+
+    async def delete(self, element):
+        """
+        It will delete an element, same JSON as -d
+        """
+        return await self.write('-d', element)
+
+    async def write(self, flag, element):
+        if self.writer is None or self.writer.done():
+            raise RuntimeError("store is not started")
+
+        done = asyncio.get_running_loop().create_future()
+        await self.writes.put((app.command_args({flag: element}), done))
+        return await done
+
+    async def write_loop(self):
+        """
+        It will run the queued writes in order on the writer thread
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            commands = [await self.writes.get()]
+            while len(commands) < self.batch and not self.writes.empty():
+                commands.append(self.writes.get_nowait())
+
+            stop = None in commands
+            commands = [command for command in commands if command is not None]
+            if commands:
+                replies = await loop.run_in_executor(self.writer_pool, self.run_writes,
+                                                     [args for args, done in commands])
+                for (args, done), (failed, reply) in zip(commands, replies):
+                    if done.cancelled():
+                        continue
+                    if failed:
+                        done.set_exception(reply)
+                    else:
+                        done.set_result(reply)
+
+            if stop:
+                return
+
+    def run_writes(self, commands) -> list:
+        """
+        It will run some commands one after another, a failed one does not stop the others
+
+        Returns:
+            [list]: [(failed, response or exception) of every command]
+        """
+        replies = []
+        for args in commands:
+            try:
+                replies.append(
+                    (False, app.run_command(self.write_conn, self.write_session, args)))
+            except Exception as e:
+                self.write_session.rollback()
+                replies.append((True, e))
+        return replies
+
+    async def search(self, parameters):
+        """
+        It will search like -f and yield the matched rows
+
+        Raises:
+            [ValueError]: [for a filter on an unknown element, field or operator]
+        """
+        loop = asyncio.get_running_loop()
+        args = app.command_args({'-f': parameters})
+        result = await loop.run_in_executor(self.reader_pool, app.search, self.read_conn, None, args)
+        if result is None:
+            return
+
+        try:
+            while True:
+                rows = await loop.run_in_executor(self.reader_pool, result.fetchmany, self.fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            await loop.run_in_executor(self.reader_pool, result.close)
+
+    async def close(self):
+        """
+        It will finish the queued writes and close the connections
+        """
+        if self.writer is not None and not self.writer.done():
+            await self.writes.put(None)
+            await self.writer
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer_pool, self.close_writer)
+        await loop.run_in_executor(self.reader_pool, self.read_conn.close)
+        self.writer_pool.shutdown()
+        self.reader_pool.shutdown()
+
+    def close_writer(self):
+        self.write_session.close()
+        self.write_conn.close()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,496 @@
+"""
+Benchmarks of the sports bet application.
+
+Usage:
+  bench_app startup [--runs=<n>] [--output=<file>] [--baseline=<file>] [--tolerance=<pct>]
+  bench_app scenarios [--sports=<n>] [--events=<n>] [--markets=<n>] [--selections=<range>] [--seed=<n>]
+                      [--runs=<n>] [--output=<file>] [--baseline=<file>] [--tolerance=<pct>]
+  bench_app profiles [--readers=<n>] [--seconds=<s>] [--sports=<n>] [--events=<n>] [--markets=<n>]
+                     [--selections=<range>] [--seed=<n>] [--output=<file>]
+  bench_app generate [--sports=<n>] [--events=<n>] [--markets=<n>] [--selections=<range>] [--seed=<n>]
+
+Options:
+  -h --help                       Show this screen.
+
+  --runs=<n>                      Runs of every measured command [default: 10]
+
+  --sports=<n>                    Generated sports [default: 2]
+
+  --events=<n>                    Generated events of every sport [default: 50]
+
+  --markets=<n>                   Generated markets, every event gets all of them [default: 5]
+
+  --selections=<range>            Generated selections of every market of an event, min-max [default: 3-30]
+
+  --seed=<n>                      Seed of the generator, same seed same data [default: 1]
+
+  --readers=<n>                   Reader processes running searches next to one writer [default: 4]
+
+  --seconds=<s>                   Duration of the concurrent run of every profile [default: 5]
+
+  --output=<file>                 Machine readable results [default: bench_results.json]
+
+  --baseline=<file>               Results of an earlier run, exit with 1 when a command got slower
+
+  --tolerance=<pct>               Slow down against the baseline allowed, in percent [default: 25]
+
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from docopt import docopt
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+DATABASE = os.path.join(os.path.dirname(APP), 'app.sqlite')
+
+# seconds the server of the startup benchmark gets to listen
+SERVER_START_TIMEOUT = 10
+
+# cli modes measured by the startup benchmark, {n} makes every added element unique
+STARTUP_MODES = {
+    'help': ['-h'],
+    'version': ['-v'],
+    'search': ['-f', '{"sport": "foot"}'],
+    'add': ['-a', '{"sport":{"name": "bench{n}", "display_name": "Bench{n}", "slug": "bench{n}", "order":1, "active": 0}}'],
+    'client': ['-f', '{"sport": "foot"}', '--socket', '{socket}'],
+}
+
+
+def import_time(command, cwd) -> float:
+    """
+    It will run a command with -X importtime and give back the total import time in ms
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=cwd,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    total = 0
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            self_us = line.split(':', 1)[1].split('|')[0].strip()
+            if self_us.isdigit():
+                total += int(self_us)
+
+    return total / 1000
+
+
+def startup(runs) -> dict:
+    """
+    It will measure wall time and import time of every cli mode, each run in a new process,
+    against a copy of app.sqlite so the real database is not touched
+
+    Returns:
+        [dict]: [mode -> median and best wall time and import time in ms]
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        shutil.copy(DATABASE, cwd)
+        socket_path = os.path.join(cwd, 'app.sock')
+
+        # first run upgrades the copied schema, it is not a startup cost
+        subprocess.run([sys.executable, APP, '-f', '{"sport": "foot"}'], cwd=cwd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server = subprocess.Popen([sys.executable, APP, '--serve', socket_path], cwd=cwd,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while not os.path.exists(socket_path):
+            if server.poll() is not None:
+                raise RuntimeError("--serve exited with " + str(server.returncode) + " before listening")
+            if time.monotonic() > deadline:
+                server.kill()
+                server.wait()
+                raise RuntimeError("--serve did not listen on " + socket_path + " within " +
+                                   str(SERVER_START_TIMEOUT) + "s")
+            time.sleep(0.05)
+
+        try:
+            for mode, arguments in STARTUP_MODES.items():
+                walls = []
+                for n in range(runs):
+                    command = [APP] + [argument.replace('{n}', mode + str(n)).replace('{socket}', socket_path)
+                                       for argument in arguments]
+                    started = time.perf_counter()
+                    subprocess.run([sys.executable] + command, cwd=cwd,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    walls.append((time.perf_counter() - started) * 1000)
+
+                command = [APP] + [argument.replace('{n}', mode + 'import').replace('{socket}', socket_path)
+                                   for argument in arguments]
+                results[mode] = {'wall_ms_median': round(statistics.median(walls), 2),
+                                 'wall_ms_best': round(min(walls), 2),
+                                 'import_ms': round(import_time(command, cwd), 2)}
+                print(mode, results[mode], file=sys.stderr)
+        finally:
+            server.send_signal(2)
+            server.wait()
+
+    return results
+
+
+def generate(sports, events, markets, selections=(3, 30), seed=1):
+    """
+    It will generate a realistic hierarchy as NDJSON elements for --bulk, the same for the same seed
+
+    Args:
+        sports ([int]): [number of sports]
+        events ([int]): [events of every sport]
+        markets ([int]): [markets, shared by all events]
+        selections ([tuple]): [min and max selections of every market of an event]
+
+    Returns:
+        [generator]: [one element per line, parents before children]
+    """
+    rng = random.Random(seed)
+
+    for sport in range(1, sports + 1):
+        yield json.dumps({"sport": {"name": "sport %d" % sport, "display_name": "Sport %d" % sport,
+                                    "slug": "sport_%d" % sport, "order": sport, "active": 0}})
+
+    for market in range(1, markets + 1):
+        yield json.dumps({"market": {"name": "market %d" % market, "display_name": "Market %d" % market,
+                                     "order": market, "schema": rng.randint(1, 3), "columns": rng.randint(1, 3)}})
+
+    for event in range(1, sports * events + 1):
+        sport = (event - 1) // events + 1
+        yield json.dumps({"event": {"sport_id": str(sport), "name": "team %d vs team %d" % (2 * event, 2 * event + 1),
+                                    "status": rng.randint(0, 2), "slug": "team_%d_vs_team_%d" % (2 * event, 2 * event + 1),
+                                    "type": rng.randint(0, 1)}})
+
+    for event in range(1, sports * events + 1):
+        for market in range(1, markets + 1):
+            for selection in range(rng.randint(*selections)):
+                yield json.dumps({"selection": {"market_id": str(market), "event_id": str(event),
+                                                "name": "e%d m%d s%d" % (event, market, selection),
+                                                "price": "%.2f" % rng.uniform(1.01, 50), "outcome": "unsettled"}})
+
+
+def summary(latencies, elapsed=None) -> dict:
+    """
+    It will summarize latencies in seconds as percentiles in ms and throughput
+    """
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3)
+
+    elapsed = elapsed or sum(latencies)
+    return {'ops': len(ordered), 'p50_ms': percentile(50), 'p95_ms': percentile(95),
+            'p99_ms': percentile(99), 'max_ms': round(ordered[-1] * 1000, 3),
+            'ops_per_sec': round(len(ordered) / elapsed, 1) if elapsed else None}
+
+
+def timed(function, runs) -> dict:
+    """
+    It will call function runs times, with the run number, and summarize its latencies
+    """
+    latencies = []
+    for run in range(runs):
+        started = time.perf_counter()
+        function(run)
+        latencies.append(time.perf_counter() - started)
+
+    return summary(latencies)
+
+
+def scenarios(sports, events, markets, selections, seed, runs) -> dict:
+    """
+    It will load generated data into a new database and measure every write path and search filter
+
+    Returns:
+        [dict]: [scenario -> latency percentiles and throughput]
+    """
+    # the startup benchmark must not pay for these imports
+    import app
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import Session
+
+    results = {}
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine("sqlite:///" + os.path.join(directory, 'bench.sqlite'))
+        app.init_db(engine)
+        conn = engine.connect()
+        session = Session(bind=engine)
+
+        def command(flag, argument, value):
+            args = {'-a': flag == '-a', '-u': flag == '-u', '-d': flag == '-d', '-f': flag == '-f',
+                    '<element>': None, '<filter>': None}
+            args[argument] = json.dumps(value)
+            return {'-a': app.add, '-u': app.update_element, '-d': app.delete_element,
+                    '-f': app.search}[flag](conn, session, args)
+
+        # bulk add of the whole hierarchy
+        started = time.perf_counter()
+        loaded = app.bulk_add(conn, generate(sports, events, markets, selections, seed))
+        results['bulk_add'] = {'rows': loaded['rows'], 'seconds': round(time.perf_counter() - started, 3),
+                               'rows_per_sec': loaded['rows_per_sec']}
+        print('bulk_add', results['bulk_add'], file=sys.stderr)
+
+        # the same load parsed by one process per core next to the writer
+        parallel_engine = create_engine("sqlite:///" + os.path.join(directory, 'parallel.sqlite'))
+        app.init_db(parallel_engine)
+        with parallel_engine.connect() as parallel_conn:
+            results['bulk_add_parallel'] = app.parallel_bulk_add(
+                parallel_conn, generate(sports, events, markets, selections, seed))
+        print('bulk_add_parallel', results['bulk_add_parallel'], file=sys.stderr)
+
+        last_event = sports * events
+        last_selection = conn.execute(text("select max(id) from selections")).scalar()
+
+        measures = {
+            'add_selection': lambda run: command('-a', '<element>', {"selection": {
+                "market_id": str(rng.randint(1, markets)), "event_id": str(rng.randint(1, last_event)),
+                "name": "bench %d" % run, "price": "2.00", "outcome": "unsettled"}}),
+            'price_tick': lambda run: command('-u', '<element>', {"selection": {
+                "id": rng.randint(1, last_selection), "values": {"price": "%.2f" % rng.uniform(1.01, 50)}}}),
+            'search_all': lambda run: command('-f', '<filter>', {"all": "team %d" % rng.randint(1, last_event)}).fetchall(),
+            'search_sport': lambda run: command('-f', '<filter>', {"sport": "sport"}).fetchall(),
+            'search_event': lambda run: command('-f', '<filter>', {"event": "team %d" % rng.randint(1, last_event)}).fetchall(),
+            'search_market': lambda run: command('-f', '<filter>', {"market": "market"}).fetchall(),
+            'search_selection': lambda run: command('-f', '<filter>', {"selection": "e%d" % rng.randint(1, last_event)}).fetchall(),
+            'search_active': lambda run: command('-f', '<filter>', {"active": str(rng.randint(0, 10))}).fetchall(),
+            'search_filters': lambda run: command('-f', '<filter>', {"on": "selection", "filters": FILTERS}).fetchall(),
+            'search_filters_python': lambda run: python_filters(conn),
+            # the same lookups with a new SQL string per call, as find() used to build them
+            'lookup_text': lambda run: session.query(app.Selection).filter(text(
+                "selections.id = " + str(rng.randint(1, last_selection)))).one_or_none(),
+            'lookup_marketevent_text': lambda run: session.query(app.MarketEvent).filter(text(
+                "(marketevents.market_id=" + str(rng.randint(1, markets)) + ") & (marketevents.event_id=" +
+                str(rng.randint(1, last_event)) + ")")).one_or_none(),
+            'lookup_by_id': lambda run: app.get_by_id(conn, app.Selection, rng.randint(1, last_selection)),
+            'lookup_marketevent': lambda run: app.get_marketevent(
+                conn, rng.randint(1, markets), rng.randint(1, last_event)),
+            'lookup_children': lambda run: app.get_children(conn, app.Event, 'sport_id', rng.randint(1, sports)),
+        }
+        try:
+            import columnar_app
+        except ImportError:
+            print('numpy is not installed, no columnar searches', file=sys.stderr)
+        else:
+            snapshot = columnar_app.ColumnarSnapshot.load(conn)
+            measures['search_filters_columnar'] = lambda run: app.search(conn, session, {'<filter>': json.dumps(
+                {"on": "selection", "filters": FILTERS})}, snapshot).fetchall()
+            measures['search_active_columnar'] = lambda run: app.search(conn, session, {'<filter>': json.dumps(
+                {"active": str(rng.randint(0, 10))})}, snapshot).fetchall()
+
+        for name, measure in measures.items():
+            results[name] = timed(measure, runs)
+            print(name, results[name], file=sys.stderr)
+
+        # price feed: many ticks on a few hot selections, coalesced per window
+        started = time.perf_counter()
+        ticks = ["%d %.2f" % (rng.randint(1, min(last_selection, 100)), rng.uniform(1.01, 50))
+                 for _ in range(runs * 100)]
+        results['tick_ingest'] = app.ingest_ticks(conn, ticks, window=0.01)
+        results['tick_ingest']['seconds'] = round(time.perf_counter() - started, 3)
+        print('tick_ingest', results['tick_ingest'], file=sys.stderr)
+
+        # price history of the ticks, recorded from the change log next to the writer
+        import history_app
+        history = history_app.PriceHistory(os.path.join(directory, 'history'))
+        started = time.perf_counter()
+        recorded = history.record(conn)
+        history.flush()
+        elapsed = time.perf_counter() - started
+        results['price_history'] = dict(recorded, seconds=round(elapsed, 3),
+                                        points_per_sec=round(recorded['points'] / elapsed) if elapsed else 0)
+        print('price_history', results['price_history'], file=sys.stderr)
+        results['price_ohlc'] = timed(lambda run: history.ohlc(rng.randint(1, min(last_selection, 100)), 1), runs)
+        print('price_ohlc', results['price_ohlc'], file=sys.stderr)
+        history.close()
+
+        def event_selections(event_id):
+            return [row.id for row in conn.execute(text(
+                "select se.id from selections se inner join marketevents me on se.marketevent_id = me.id \
+                where me.event_id = :event_id"), {'event_id': event_id})]
+
+        # cascade delete: all selections of one event, the last one deactivates event and sport
+        selection_ids = event_selections(last_event)
+        results['cascade_delete'] = timed(lambda run: command(
+            '-d', '<element>', {"selection": {"id": selection_ids[run]}}), len(selection_ids))
+        print('cascade_delete', results['cascade_delete'], file=sys.stderr)
+
+        # settlement of whole events, set based and as one update per selection
+        results['settle_event'] = timed(lambda run: app.settle(
+            conn, {"event": run + 1, "default": "lose"}), runs)
+        print('settle_event', results['settle_event'], file=sys.stderr)
+        results['settle_per_selection'] = timed(lambda run: [command('-u', '<element>', {"selection": {
+            "id": selection_id, "values": {"outcome": "lose", "active": 0}}})
+            for selection_id in event_selections(runs + run + 1)], runs)
+        print('settle_per_selection', results['settle_per_selection'], file=sys.stderr)
+
+        results['hierarchy_cache'] = app.hierarchy_cache(conn).stats()
+        print('hierarchy_cache', results['hierarchy_cache'], file=sys.stderr)
+
+        session.close()
+        conn.close()
+
+    return results
+
+
+# regex, range and parent filters of the search_filters scenario
+FILTERS = [{"field": "name", "op": "regex", "value": "^e1\\d* m[12] "},
+           {"field": "price", "op": "range", "value": [2, 10]},
+           {"field": "active", "op": "eq", "value": 1}]
+
+
+def python_filters(conn) -> list:
+    """
+    It will run the FILTERS one by one in python over all selections, what search_filters replaces
+    """
+    from sqlalchemy import text
+
+    rows = conn.execute(text("select * from selections")).fetchall()
+    pattern = re.compile(FILTERS[0]['value'])
+    rows = [row for row in rows if pattern.search(row.name)]
+    rows = [row for row in rows if 2 <= row.price <= 10]
+    return [row for row in rows if row.active == 1]
+
+
+def profile_worker(path, profile, role, seconds, results):
+    """
+    It will search (reader) or update prices (writer) for some seconds and report its operations
+    """
+    import app
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import Session
+
+    config = dict(app.DB_CONFIG_DEFAULTS, url='sqlite:///' + path, profile=profile)
+    engine = app.get_engine(config, read_only=role == 'reader')
+    conn = engine.connect()
+    session = Session(bind=engine)
+    rng = random.Random(os.getpid())
+    last_selection = conn.execute(app.select(app.func.max(app.Selection.id))).scalar()
+
+    operations = errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if role == 'reader':
+                parameters = rng.choice([{"active": str(rng.randint(0, 5))},
+                                         {"event": "team %d" % rng.randint(1, 100)},
+                                         {"selection": "e%d" % rng.randint(1, 100)}])
+                app.search(conn, session, {'<filter>': json.dumps(parameters)}).fetchall()
+            else:
+                app.update_element(conn, session, {'<element>': json.dumps({"selection": {
+                    "id": rng.randint(1, last_selection), "values": {"price": "%.2f" % rng.uniform(1.01, 50)}}})})
+            operations += 1
+        except OperationalError:
+            # database is locked
+            session.rollback()
+            errors += 1
+
+    results.put((role, operations, errors))
+
+
+def profiles(readers, seconds, sports, events, markets, selections, seed) -> dict:
+    """
+    It will run readers and one writer concurrently against a database made with every sqlite profile
+
+    Returns:
+        [dict]: [profile -> reads and writes per second and locked errors]
+    """
+    import app
+
+    results = {}
+    for profile in app.SQLITE_PROFILES:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.sqlite')
+            config = dict(app.DB_CONFIG_DEFAULTS, url='sqlite:///' + path, profile=profile)
+            engine = app.get_engine(config)
+            app.init_db(engine)
+            with engine.connect() as conn:
+                app.bulk_add(conn, generate(sports, events, markets, selections, seed))
+            engine.dispose()
+
+            queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=profile_worker, args=(path, profile, role, seconds, queue))
+                       for role in ['writer'] + ['reader'] * readers]
+            for worker in workers:
+                worker.start()
+            reports = [queue.get() for worker in workers]
+            for worker in workers:
+                worker.join()
+
+            reads = sum(operations for role, operations, errors in reports if role == 'reader')
+            writes = sum(operations for role, operations, errors in reports if role == 'writer')
+            results[profile] = {'reads_per_sec': round(reads / seconds, 1),
+                                'writes_per_sec': round(writes / seconds, 1),
+                                'read_errors': sum(errors for role, operations, errors in reports if role == 'reader'),
+                                'write_errors': sum(errors for role, operations, errors in reports if role == 'writer')}
+            print(profile, results[profile], file=sys.stderr)
+
+    return results
+
+
+def regressions(results, baseline, tolerance) -> list:
+    """
+    It will list every measure slower than the baseline by more than tolerance percent
+    """
+    slower = []
+    for mode, measures in results.items():
+        for measure, value in measures.items():
+            before = baseline.get(mode, {}).get(measure)
+            # only times, where bigger is worse
+            if measure.endswith('_ms') and before and value > before * (1 + tolerance / 100):
+                slower.append(mode + " " + measure + ": " +
+                              str(before) + " -> " + str(value))
+
+    return slower
+
+
+def main():
+    """
+    This is the cli of the benchmarks
+    """
+    args = docopt(__doc__, help=True)
+
+    selections = tuple(int(n) for n in args['--selections'].split('-'))
+    if args['generate']:
+        for line in generate(int(args['--sports']), int(args['--events']), int(args['--markets']),
+                             selections, int(args['--seed'])):
+            print(line)
+        return 0
+
+    results = {'python': sys.version.split()[0], 'runs': int(args['--runs'])}
+    if args['startup']:
+        results['startup'] = startup(int(args['--runs']))
+    if args['profiles']:
+        results['readers'] = int(args['--readers'])
+        results['profiles'] = profiles(int(args['--readers']), float(args['--seconds']), int(args['--sports']),
+                                       int(args['--events']), int(args['--markets']), selections, int(args['--seed']))
+    if args['scenarios']:
+        results['sizes'] = {'sports': int(args['--sports']), 'events': int(args['--events']),
+                            'markets': int(args['--markets']), 'selections': args['--selections'],
+                            'seed': int(args['--seed'])}
+        results['scenarios'] = scenarios(int(args['--sports']), int(args['--events']), int(args['--markets']),
+                                         selections, int(args['--seed']), int(args['--runs']))
+
+    with open(args['--output'], 'w') as output:
+        json.dump(results, output, indent=2)
+
+    if args['--baseline']:
+        with open(args['--baseline']) as previous:
+            baseline = json.load(previous)
+        slower = []
+        for suite in ('startup', 'scenarios'):
+            if suite in results:
+                slower += regressions(results[suite], baseline.get(suite, {}),
+                                      float(args['--tolerance']))
+        for line in slower:
+            print("regression " + line, file=sys.stderr)
+        return 1 if slower else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,581 @@
+"""
+Columnar in-memory snapshot of the sports bet hierarchy for filter searches.
+
+Every table is held as NumPy columns: ids, parent ids, prices, flags and counters as
+float arrays [NaN for NULL], names and other text as codes into the distinct values of
+the column. The filters and active threshold searches of app.search() run as vectorized
+masks over them and give the same rows in the same order as the SQL. The snapshot
+follows the database through the changes table, a refresh only reads again the rows
+written since the last one.
+
+NumPy is optional, app.py imports this module only when columnar search is configured.
+
+    snapshot = ColumnarSnapshot.load(conn)
+    snapshot.refresh(conn)
+    rows = snapshot.search({"on": "selection", "filters": [{"field": "price", "op": "range", "value": [1.5, 2]}]})
+"""
+
+import decimal
+import json
+import os
+import re
+
+import numpy
+from sqlalchemy import select, func, bindparam, type_coerce, Float, Integer, Boolean, Numeric
+
+import app
+
+# element tables of the snapshot
+SNAPSHOT_MODELS = (app.Sport, app.Event, app.Market,
+                   app.MarketEvent, app.Selection)
+
+# rows read by one refresh query
+REFRESH_CHUNK = 500
+
+LAST_SEQ = select(func.max(app.Change.seq))
+
+FIRST_SEQ = select(func.min(app.Change.seq))
+
+# rows written after a seq, once each
+CHANGES_SINCE = select(app.Change.element, app.Change.row_id, func.max(app.Change.seq)).where(
+    app.Change.seq > bindparam('seq')).group_by(app.Change.element, app.Change.row_id)
+
+
+class RebuildTable(Exception):
+    """
+    A change that can not be applied in place, the table is read again
+    """
+
+
+class Unsupported(Exception):
+    """
+    A search the snapshot can not answer exactly like the SQL, it runs as SQL
+    """
+
+
+class NumericColumn:
+    """
+    This class will keep a column of numbers as a float array, NULL as NaN
+    """
+    numeric = True
+
+    def __init__(self, values):
+        self.array = numpy.array([numpy.nan if value is None else value for value in values],
+                                 dtype=numpy.float64)
+
+    def set(self, position, value):
+        if not is_number(value):
+            raise RebuildTable("text in a number column")
+        self.array[position] = numpy.nan if value is None else value
+
+    def extend(self, values):
+        if not all(map(is_number, values)):
+            raise RebuildTable("text in a number column")
+        self.array = numpy.concatenate([self.array, NumericColumn(values).array])
+
+
+class DictionaryColumn:
+    """
+    This class will keep a column as codes into its distinct values, so a filter
+    on names tests every distinct name once and maps the answer onto the rows
+    """
+    numeric = False
+
+    def __init__(self, values):
+        self.uniques = []
+        self.codes_of = {}
+        self.codes = numpy.array([self.code(value) for value in values], dtype=numpy.int32)
+
+    def code(self, value) -> int:
+        # 1 and True are one dict key, their type keeps them apart
+        key = (type(value), value)
+        if key not in self.codes_of:
+            self.codes_of[key] = len(self.uniques)
+            self.uniques.append(value)
+        return self.codes_of[key]
+
+    def set(self, position, value):
+        self.codes[position] = self.code(value)
+
+    def extend(self, values):
+        self.codes = numpy.concatenate(
+            [self.codes, numpy.array([self.code(value) for value in values], dtype=numpy.int32)])
+
+    def mask(self, test, rows=None):
+        """
+        It will test the distinct values, only those of the rows still matched when given
+        """
+        if rows is None:
+            candidates = range(len(self.uniques))
+        else:
+            candidates = numpy.unique(self.codes[rows]).tolist()
+
+        matched = numpy.zeros(len(self.uniques), dtype=bool)
+        for code in candidates:
+            matched[code] = bool(test(self.uniques[code]))
+        return matched[self.codes]
+
+
+def is_number(value) -> bool:
+    return value is None or isinstance(value, (int, float))
+
+
+class ColumnTable:
+    """
+    This class will keep the rows of one element table and their columns, sorted by id
+
+    Rows are kept as read by select(table) for the results, the columns hold the values
+    as sqlite stores them [flags as 0/1, prices as floats] for the filters.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.table = model.__table__
+        self.keys = list(self.table.c.keys())
+        # flags and prices are read a second time without their result conversion
+        self.raw = [position for position, column in enumerate(self.table.c)
+                    if isinstance(column.type, (Boolean, Numeric))]
+        self.statement = select(self.table, *[type_coerce(self.table.c[self.keys[position]], Float)
+                                              for position in self.raw])
+
+    def split(self, row) -> tuple:
+        """
+        It will turn a read row into the result row and the stored values
+        """
+        values = list(row[:len(self.keys)])
+        for offset, position in enumerate(self.raw):
+            values[position] = row[len(self.keys) + offset]
+        return tuple(row[:len(self.keys)]), values
+
+    def load(self, conn):
+        self.build([self.split(row) for row in conn.execute(
+            self.statement.order_by(self.table.c.id))])
+
+    def build(self, rows):
+        self.rows = [result for result, values in rows]
+        self.ids = numpy.array([values[0] for result, values in rows], dtype=numpy.int64)
+        self.columns = {}
+        for position, key in enumerate(self.keys):
+            values = [values[position] for result, values in rows]
+            if isinstance(self.table.c[key].type, (Integer, Boolean, Numeric)) and all(map(is_number, values)):
+                self.columns[key] = NumericColumn(values)
+            else:
+                self.columns[key] = DictionaryColumn(values)
+
+    def apply(self, conn, row_ids):
+        """
+        It will read again the rows of some ids, in place when they were only updated
+        """
+        row_ids = sorted(row_ids)
+        fetched = {}
+        for start in range(0, len(row_ids), REFRESH_CHUNK):
+            for row in conn.execute(self.statement.where(
+                    self.table.c.id.in_(row_ids[start:start + REFRESH_CHUNK]))):
+                fetched[row.id] = self.split(row)
+
+        positions = numpy.searchsorted(self.ids, row_ids)
+        known = {row_id: int(position) for row_id, position in zip(row_ids, positions)
+                 if position < len(self.ids) and self.ids[position] == row_id}
+        deleted = known.keys() - fetched.keys()
+        inserted = sorted(fetched.keys() - known.keys())
+
+        try:
+            if deleted or (inserted and len(self.ids) and inserted[0] <= self.ids[-1]):
+                raise RebuildTable("rows moved")
+
+            for row_id in known.keys() & fetched.keys():
+                result, values = fetched[row_id]
+                if self.rows is not None:
+                    self.rows[known[row_id]] = result
+                for key, value in zip(self.keys, values):
+                    self.columns[key].set(known[row_id], value)
+
+            # new ids come after the others, the columns grow at the end
+            if inserted:
+                if self.rows is not None:
+                    self.rows.extend(fetched[row_id][0] for row_id in inserted)
+                self.ids = numpy.concatenate(
+                    [self.ids, numpy.array(inserted, dtype=numpy.int64)])
+                for position, key in enumerate(self.keys):
+                    self.columns[key].extend(
+                        [fetched[row_id][1][position] for row_id in inserted])
+        except RebuildTable:
+            # a delete, an id out of order or text in a numeric column
+            self.load(conn)
+
+    def value(self, key, position):
+        """
+        It will give one value as select(table) gives it, eg. a Decimal price
+        """
+        column = self.columns[key]
+        if not column.numeric:
+            return column.uniques[column.codes[position]]
+
+        value = column.array[position]
+        column_type = self.table.c[key].type
+        if numpy.isnan(value):
+            return None
+        elif isinstance(column_type, Boolean):
+            return bool(value)
+        elif isinstance(column_type, Numeric):
+            return decimal.Decimal("%.*f" % (column_type.scale or 10, value))
+        return int(value) if value.is_integer() else float(value)
+
+    def row(self, position) -> tuple:
+        """
+        It will give one result row, built from the columns when the rows are not kept
+        """
+        if self.rows is not None:
+            return self.rows[position]
+        return tuple(self.value(key, position) for key in self.keys)
+
+    def save(self, directory, manifest):
+        """
+        It will write the ids and every column as .npy files, distinct values go in the manifest
+        """
+        name = self.table.name
+        numpy.save(os.path.join(directory, name + ".id.npy"), self.ids)
+        columns = manifest[name] = {}
+        for key, column in self.columns.items():
+            path = os.path.join(directory, name + "." + key + ".npy")
+            if column.numeric:
+                numpy.save(path, column.array)
+                columns[key] = None
+            else:
+                numpy.save(path, column.codes)
+                columns[key] = column.uniques
+
+    def open(self, directory, manifest):
+        """
+        It will map the files of save() copy on write, the files are never changed
+        """
+        name = self.table.name
+        self.rows = None
+        self.ids = load_array(os.path.join(directory, name + ".id.npy"))
+        self.columns = {}
+        for key, uniques in manifest[name].items():
+            array = load_array(os.path.join(directory, name + "." + key + ".npy"))
+            if uniques is None:
+                column = NumericColumn([])
+                column.array = array
+            else:
+                column = DictionaryColumn([])
+                for value in uniques:
+                    column.code(value)
+                column.codes = array
+            self.columns[key] = column
+
+    def positions(self, ids):
+        """
+        It will give the position of every id in this table, -1 when missing
+        """
+        ids = numpy.nan_to_num(ids, nan=-1).astype(numpy.int64)
+        if not len(self.ids):
+            return numpy.full(len(ids), -1)
+        positions = numpy.searchsorted(self.ids, ids).clip(0, len(self.ids) - 1)
+        return numpy.where(self.ids[positions] == ids, positions, -1)
+
+
+def load_array(path):
+    """
+    It will map a .npy file copy on write, an empty array can not be mapped
+    """
+    try:
+        return numpy.load(path, mmap_mode='c')
+    except ValueError:
+        return numpy.load(path)
+
+
+def like_pattern(pattern):
+    """
+    It will turn a sql LIKE pattern into a regex, % any text, _ one character,
+    ascii letters match in any case as sqlite does
+    """
+    return re.compile("".join(".*" if char == '%' else "." if char == '_' else re.escape(char)
+                              for char in pattern), re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+def looks_numeric(value) -> bool:
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+class ColumnarSnapshot:
+    """
+    This class will answer filter searches from NumPy columns of all element tables
+
+    search() raises Unsupported for searches it can not answer exactly like
+    the SQL, eg. keyword searches, the caller then runs the SQL.
+    """
+
+    def __init__(self):
+        self.tables = {model.__tablename__: ColumnTable(model) for model in SNAPSHOT_MODELS}
+        self.seq = 0
+
+    @classmethod
+    def load(cls, conn):
+        snapshot = cls()
+        with conn.begin():
+            # rows and the change sequence come from the same read transaction
+            snapshot.seq = conn.execute(LAST_SEQ).scalar() or 0
+            for table in snapshot.tables.values():
+                table.load(conn)
+        snapshot.link()
+        return snapshot
+
+    def save(self, directory):
+        """
+        It will write the snapshot as one .npy file per column and a manifest.json,
+        to be mapped by open() eg. on a read node
+        """
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, "manifest.json")):
+            os.remove(os.path.join(directory, "manifest.json"))
+
+        manifest = {}
+        for table in self.tables.values():
+            table.save(directory, manifest)
+
+        # the manifest goes last, a directory without it is not a snapshot
+        with open(os.path.join(directory, "manifest.json"), 'w') as manifest_file:
+            json.dump({'seq': self.seq, 'tables': manifest}, manifest_file)
+
+    @classmethod
+    def open(cls, directory):
+        """
+        It will map a snapshot written by save(), without reading the rows
+
+        refresh() then brings it up to date with a database holding its changes.
+        """
+        with open(os.path.join(directory, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        snapshot = cls()
+        snapshot.seq = manifest['seq']
+        for table in snapshot.tables.values():
+            table.open(directory, manifest['tables'])
+        snapshot.link()
+        return snapshot
+
+    def refresh(self, conn) -> int:
+        """
+        It will read again the rows written since the last refresh
+
+        Returns:
+            [int]: [number of changed rows]
+        """
+        # nothing written since, a single read of the last seq
+        if (conn.execute(LAST_SEQ).scalar() or 0) == self.seq:
+            return 0
+
+        with conn.begin():
+            # changes this snapshot has not read were pruned, every table is read again
+            if (conn.execute(FIRST_SEQ).scalar() or 0) > self.seq + 1:
+                self.seq = conn.execute(LAST_SEQ).scalar()
+                for table in self.tables.values():
+                    table.load(conn)
+                self.link()
+                return sum(len(table.ids) for table in self.tables.values())
+
+            changed = {}
+            seq = self.seq
+            for element, row_id, last in conn.execute(CHANGES_SINCE, {'seq': self.seq}):
+                changed.setdefault(element, set()).add(row_id)
+                seq = max(seq, last)
+
+            for element, row_ids in changed.items():
+                table = self.tables[element]
+                # many changes cost less as one full read
+                if len(row_ids) > len(table.ids) / 4:
+                    table.load(conn)
+                else:
+                    table.apply(conn, row_ids)
+            self.seq = seq
+
+        if changed:
+            self.link()
+        return sum(len(row_ids) for row_ids in changed.values())
+
+    def link(self):
+        """
+        It will find the market and event of every selection through its market event
+        """
+        selections = self.tables['selections']
+        marketevents = self.tables['marketevents']
+        parents = marketevents.positions(
+            selections.columns['marketevent_id'].array)
+        self.selection_marketevents = parents
+        self.selection_parents = {}
+        for field in app.SELECTION_PARENT_FIELDS:
+            column = marketevents.columns[field]
+            values = column.array[parents.clip(0)] if column.numeric and len(
+                marketevents.ids) else numpy.full(len(parents), numpy.nan)
+            self.selection_parents[field] = numpy.where(parents >= 0, values, numpy.nan)
+
+    def resolve(self, model, table, predicate) -> tuple:
+        """
+        It will find the column of one filter, checked as compile_predicate() checks it
+
+        Returns:
+            [tuple]: [cost, column array or DictionaryColumn, op, value, numeric affinity of the column]
+        """
+        op = predicate.get('op')
+        value = predicate.get('value')
+
+        if op == 'min_active':
+            if 'active_children' not in model.__table__.c:
+                raise ValueError(
+                    "min_active is not available for " + model.__tablename__)
+            predicate = dict(predicate, field='active_children')
+
+        field = predicate.get('field')
+        if model is app.Selection and field in app.SELECTION_PARENT_FIELDS:
+            column = self.selection_parents[field]
+        elif field in model.__table__.c:
+            column = table.columns[field]
+            column = column.array if column.numeric else column
+        else:
+            raise ValueError("unknown field " + str(field) +
+                             " for " + model.__tablename__)
+
+        if op not in ('eq', 'range', 'min_active', 'like', 'regex'):
+            raise ValueError("unknown filter operator " + str(op))
+        if op == 'regex':
+            app.compile_regex(value)
+
+        if isinstance(column, numpy.ndarray):
+            return 0, column, op, value, True
+        # python tests last, on the distinct values of the rows left by the others
+        cost = {'eq': 1, 'range': 1, 'like': 2, 'regex': 3}[op]
+        return cost, column, op, value, isinstance(model.__table__.c[field].type, (Integer, Numeric))
+
+    def numeric_mask(self, array, op, value):
+        if op == 'min_active':
+            return array > int(value)
+        elif op == 'eq' and value is None:
+            return numpy.isnan(array)
+        elif op == 'eq' and is_number(value):
+            return array == value
+        elif op == 'range':
+            low, high = value
+            if not (is_number(low) and is_number(high)):
+                raise Unsupported("range of text on a number column")
+            mask = numpy.ones(len(array), dtype=bool)
+            if low is not None:
+                mask &= array >= low
+            if high is not None:
+                mask &= array <= high
+            return mask
+
+        # sqlite would compare the text of the numbers
+        raise Unsupported(op + " on a number column")
+
+    def dictionary_mask(self, column, op, value, numeric_affinity, rows):
+        if op == 'regex':
+            pattern = app.compile_regex(value)
+            return column.mask(lambda stored: stored is not None and pattern.search(str(stored)) is not None, rows)
+
+        bounds = list(value) if op == 'range' else [value]
+        if not all(bound is None or isinstance(bound, str) for bound in bounds) or \
+                (numeric_affinity and any(looks_numeric(bound) for bound in bounds)):
+            # sqlite would convert the value to the type of the column first
+            raise Unsupported(op + " of a number on a text column")
+
+        if op == 'like':
+            if value is None:
+                return numpy.zeros(len(column.codes), dtype=bool)
+            pattern = like_pattern(value)
+            return column.mask(lambda stored: isinstance(stored, (str, int))
+                               and pattern.fullmatch(str(stored)) is not None, rows)
+        elif op == 'eq':
+            if value is None:
+                return column.mask(lambda stored: stored is None, rows)
+            return column.mask(lambda stored: isinstance(stored, str) and stored == value, rows)
+        elif op == 'range':
+            low, high = value
+            return column.mask(lambda stored: isinstance(stored, str) and (low is None or stored >= low)
+                               and (high is None or stored <= high), rows)
+
+        raise Unsupported(op + " on a text column")
+
+    def filter_rows(self, element, filters) -> app.RowsResult:
+        """
+        It will combine N filters on an element with AND, same rows and order as compile_filters()
+        """
+        if element not in app.FILTER_MODELS:
+            raise ValueError("unknown element " + str(element))
+
+        model = app.FILTER_MODELS[element]
+        table = self.tables[model.__tablename__]
+        mask = numpy.ones(len(table.ids), dtype=bool)
+        resolved = sorted((self.resolve(model, table, predicate) for predicate in filters),
+                          key=lambda predicate: predicate[0])
+        for cost, column, op, value, numeric_affinity in resolved:
+            if isinstance(column, numpy.ndarray):
+                mask &= self.numeric_mask(column, op, value)
+            else:
+                mask &= self.dictionary_mask(
+                    column, op, value, numeric_affinity, mask)
+
+        # the SQL joins the market event only for these fields
+        if model is app.Selection and any(predicate.get('field') in app.SELECTION_PARENT_FIELDS for predicate in filters):
+            mask &= self.selection_marketevents >= 0
+
+        return app.RowsResult(table.keys, [table.row(position) for position in numpy.flatnonzero(mask)])
+
+    def active_rows(self, threshold) -> app.RowsResult:
+        """
+        It will find sports, events and markets with more active children than a threshold
+        """
+        rows = []
+        for model in (app.Sport, app.Event, app.Market):
+            table = self.tables[model.__tablename__]
+            counts = table.columns['active_children'].array
+            for position in numpy.flatnonzero(counts > threshold):
+                rows.append((model.__tablename__, int(table.ids[position]),
+                             table.value('name', position), int(counts[position])))
+        return app.RowsResult(('type', 'id', 'name', 'active_cnt'), rows)
+
+    def search(self, parameters) -> app.RowsResult:
+        """
+        It will answer a search given as the JSON of -f
+
+        Raises:
+            [ValueError]: [for an unknown element, field or operator, as the SQL search]
+            [Unsupported]: [for searches to run as SQL]
+        """
+        if 'filters' in parameters and not any(key in parameters for key in ('all', 'sport', 'market', 'event', 'selection')):
+            return self.filter_rows(parameters.get('on'), parameters['filters'])
+        elif list(parameters) == ['active']:
+            return self.active_rows(int(parameters['active']))
+
+        raise Unsupported("keyword search")
+
+    def active_children_counts(self) -> dict:
+        """
+        It will count the active children of every row from the flags of the child tables,
+        with the same rules as rebuild_counts(), eg. to check the stored counters
+
+        Returns:
+            [dict]: [table name -> array of counts in id order]
+        """
+        selections = self.tables['selections']
+        marketevents = self.tables['marketevents']
+        events = self.tables['events']
+
+        def count(parent, parent_ids, active):
+            positions = self.tables[parent].positions(parent_ids)
+            return numpy.bincount(positions[(positions >= 0) & (active == 1)],
+                                  minlength=len(self.tables[parent].ids))
+
+        selection_active = selections.columns['active'].array
+        marketevent_active = marketevents.columns['active'].array
+        return {
+            'marketevents': count('marketevents', selections.columns['marketevent_id'].array, selection_active),
+            'markets': count('markets', self.selection_parents['market_id'], selection_active),
+            'events': count('events', marketevents.columns['event_id'].array, marketevent_active),
+            'sports': count('sports', events.columns['sport_id'].array, events.columns['active'].array),
+        }
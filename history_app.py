@@ -0,0 +1,433 @@
+"""
+Append-only price history of the selections, in compact binary segments.
+
+Every price written to a selection is recorded as a point, its time in milliseconds as
+an int64 and its price in hundredths as an int32. The points come from the changes
+table, so the writers of the selections do nothing more than they already do: a
+recorder runs next to them, like --tail, and reads the price changes after the last
+seq it has seen.
+
+Points are kept in memory and written as one segment file at a time. A segment holds
+the points of every selection it has, one after another in time order, behind an
+index of the selections, and is never written again. Segments are mapped, a query
+reads only the points of its selection within its time range. Small segments are
+merged by the recorder once there are too many of them, queries open the history
+read only.
+
+    history = PriceHistory('history/')
+    history.record(conn)
+    history.flush()
+    points = history.prices(12, start, end)
+    bars = history.ohlc(12, 60, start, end)
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from sqlalchemy import select, bindparam
+
+import app
+
+SEGMENT_MAGIC = b'PHS1'
+
+# magic, selections, first and last change seq of the points
+HEADER = struct.Struct('<4sIqq')
+
+# selection id, first point, points, first and last time, last price, padding to
+# keep the columns aligned
+ENTRY = struct.Struct('<qIIqqi4x')
+
+# price changes read from the changes table at once
+RECORD_CHUNK = 5000
+
+# points kept in memory before they are written as a segment
+SEGMENT_POINTS = 65536
+
+# small segments allowed before they are merged into one
+MERGE_SEGMENTS = 16
+
+# selection writes after a seq, deletes keep the history of the selection
+PRICE_CHANGES = select(app.Change.seq, app.Change.row_id, app.Change.at, app.Change.data).where(
+    app.Change.seq > bindparam('seq'), app.Change.element == 'selections',
+    app.Change.op != 'd').order_by(app.Change.seq).limit(bindparam('size'))
+
+
+def little_endian(column):
+    """
+    It will give the column as stored in the segment files
+    """
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class Segment:
+    """
+    This class will map one segment file and find the points of a selection in it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.first_seq, self.seq = HEADER.unpack_from(self.map)
+        if magic != SEGMENT_MAGIC:
+            self.map.close()
+            raise ValueError(path + " is not a price history segment")
+
+        # selection id -> first point, points, first and last time, last price
+        self.entries = {}
+        for position in range(count):
+            entry = ENTRY.unpack_from(self.map, HEADER.size + position * ENTRY.size)
+            self.entries[entry[0]] = entry[1:]
+        self.points = sum(entry[1] for entry in self.entries.values())
+
+        offset = HEADER.size + count * ENTRY.size
+        self.times = self.column('q', offset)
+        self.prices = self.column('i', offset + self.points * 8)
+
+    def column(self, typecode, offset):
+        view = memoryview(self.map)[offset:offset + self.points * array.array(typecode).itemsize]
+        if sys.byteorder == 'big':
+            return little_endian(array.array(typecode, view.cast(typecode)))
+        return view.cast(typecode)
+
+    def select(self, selection_id, start, end) -> tuple:
+        """
+        It will give the times and prices of a selection within [start, end) milliseconds
+        """
+        entry = self.entries.get(selection_id)
+        if entry is None or entry[2] >= end or entry[3] < start:
+            return (), ()
+        first, count = entry[0], entry[1]
+        low = bisect.bisect_left(self.times, start, first, first + count)
+        high = bisect.bisect_left(self.times, end, low, first + count)
+        return self.times[low:high], self.prices[low:high]
+
+    def close(self):
+        for column in (self.times, self.prices):
+            if isinstance(column, memoryview):
+                column.release()
+        self.map.close()
+
+
+def write_segment(path, first_seq, seq, points):
+    """
+    It will write the points of the selections as a new segment, all at once so a
+    reader never sees a part of it
+
+    Args:
+        points ([dict]): [selection id -> (times, prices) arrays in time order]
+    """
+    selection_ids = sorted(points)
+    entries = []
+    first = 0
+    for selection_id in selection_ids:
+        times, prices = points[selection_id]
+        entries.append(ENTRY.pack(selection_id, first, len(times), times[0], times[-1], prices[-1]))
+        first += len(times)
+
+    with open(path + '.tmp', 'wb') as segment_file:
+        segment_file.write(HEADER.pack(SEGMENT_MAGIC, len(selection_ids), first_seq, seq))
+        segment_file.write(b''.join(entries))
+        for column in (0, 1):
+            for selection_id in selection_ids:
+                little_endian(points[selection_id][column]).tofile(segment_file)
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class PriceHistory:
+    """
+    This class will record the prices of the selections from the changes table and
+    answer time range and OHLC queries over them
+    """
+
+    def __init__(self, directory, segment_points=SEGMENT_POINTS, read_only=False):
+        """
+        With read_only it only answers queries from the segments written by a recorder,
+        it never writes nor removes a file.
+        """
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_points = segment_points
+        self.read_only = read_only
+        self.segments = self.open_segments()
+        self.drop_merged()
+
+        # selection id -> time and price of its last point
+        self.last = {}
+        for segment in self.segments:
+            for selection_id, entry in segment.entries.items():
+                self.last[selection_id] = (entry[3], entry[4])
+        self.seq = self.segments[-1].seq if self.segments else 0
+
+        # points read since the last segment, selection id -> (times, prices)
+        self.buffer = {}
+        self.buffered = 0
+        self.buffer_seq = self.seq
+
+    def open_segments(self) -> list:
+        """
+        It will map the segments of the directory in seq order
+        """
+        while os.path.isdir(self.directory):
+            segments = []
+            try:
+                for name in sorted(os.listdir(self.directory)):
+                    if name.endswith('.seg'):
+                        segments.append(Segment(os.path.join(self.directory, name)))
+                return segments
+            except FileNotFoundError:
+                # a recorder merged segments meanwhile, list them again
+                for segment in segments:
+                    segment.close()
+        return []
+
+    def drop_merged(self):
+        """
+        It will leave out the segments a merge was stopped from removing, their points
+        are in the merged segment, and remove them unless read only
+        """
+        kept = []
+        for segment in self.segments:
+            # in seq order a merged segment comes after the segments it replaced
+            while kept and segment.first_seq <= kept[-1].first_seq and kept[-1].seq <= segment.seq:
+                merged = kept.pop()
+                merged.close()
+                if not self.read_only:
+                    os.remove(merged.path)
+            kept.append(segment)
+        self.segments = kept
+
+    def check_writable(self):
+        if self.read_only:
+            raise ValueError("price history " + self.directory + " is open read only")
+
+    def record(self, conn, size=RECORD_CHUNK) -> dict:
+        """
+        It will read the selection writes after the last seq seen and keep the prices
+        which changed, writing a segment when enough points are in memory
+
+        Changes written before their time was recorded, or without their row, have no
+        price point. A write older than the last point of its selection, eg. from a
+        clock going back, gets the time of that point.
+
+        Returns:
+            [dict]: [changes read, points added and the last seq]
+        """
+        self.check_writable()
+        changes = points = 0
+        while True:
+            rows = conn.execute(PRICE_CHANGES, {'seq': self.buffer_seq, 'size': size}).fetchall()
+            for seq, selection_id, at, data in rows:
+                self.buffer_seq = seq
+                if at is None or data is None:
+                    continue
+                price = json.loads(data).get('price')
+                if price is None:
+                    continue
+                price = int(round(float(price) * 100))
+                last = self.last.get(selection_id)
+                if last is not None and last[1] == price:
+                    continue
+
+                at = int(round(at * 1000))
+                if last is not None and at < last[0]:
+                    at = last[0]
+                if selection_id not in self.buffer:
+                    self.buffer[selection_id] = (array.array('q'), array.array('i'))
+                times, prices = self.buffer[selection_id]
+                times.append(at)
+                prices.append(price)
+                self.last[selection_id] = (at, price)
+                self.buffered += 1
+                points += 1
+                if self.buffered >= self.segment_points:
+                    self.flush()
+
+            changes += len(rows)
+            if len(rows) < size:
+                break
+
+        return {'changes': changes, 'points': points, 'seq': self.buffer_seq}
+
+    def flush(self):
+        """
+        It will write the points in memory as a new segment and merge the small segments
+        when there are too many of them
+        """
+        self.check_writable()
+        if not self.buffer:
+            return
+        path = os.path.join(self.directory, "%020d.seg" % self.buffer_seq)
+        write_segment(path, self.seq + 1, self.buffer_seq, self.buffer)
+        self.segments.append(Segment(path))
+        self.seq = self.buffer_seq
+        self.buffer = {}
+        self.buffered = 0
+
+        small = 0
+        while small < len(self.segments) and self.segments[-1 - small].points < self.segment_points:
+            small += 1
+        if small > MERGE_SEGMENTS:
+            self.merge(self.segments[-small:])
+
+    def merge(self, segments):
+        """
+        It will write the points of consecutive segments as one segment, which takes the
+        name of the last one, then remove the others
+        """
+        self.check_writable()
+        points = {}
+        for segment in segments:
+            for selection_id, entry in segment.entries.items():
+                first, count = entry[0], entry[1]
+                if selection_id not in points:
+                    points[selection_id] = (array.array('q'), array.array('i'))
+                points[selection_id][0].extend(segment.times[first:first + count])
+                points[selection_id][1].extend(segment.prices[first:first + count])
+
+        first_seq, seq, path = segments[0].first_seq, segments[-1].seq, segments[-1].path
+        for segment in segments:
+            segment.close()
+        write_segment(path, first_seq, seq, points)
+        for segment in segments[:-1]:
+            os.remove(segment.path)
+        self.segments = self.segments[:-len(segments)] + [Segment(path)]
+
+    def follow(self, conn, interval=0.1, flush_interval=1.0) -> dict:
+        """
+        It will keep recording new prices until Ctrl + C, writing a segment at least
+        every flush_interval seconds
+
+        Returns:
+            [dict]: [changes read, points added and the last seq]
+        """
+        totals = {'changes': 0, 'points': 0, 'seq': self.buffer_seq}
+        flushed = time.monotonic()
+        # app's SIGINT handler only sets the flag
+        while not app.interrupted:
+            recorded = self.record(conn)
+            totals['changes'] += recorded['changes']
+            totals['points'] += recorded['points']
+            if time.monotonic() - flushed >= flush_interval:
+                self.flush()
+                flushed = time.monotonic()
+            if not recorded['changes']:
+                time.sleep(interval)
+
+        self.flush()
+        totals['seq'] = self.buffer_seq
+        return totals
+
+    def columns(self, selection_id, start=None, end=None):
+        """
+        It will give the times and prices of a selection within [start, end) milliseconds,
+        one slice per segment then the points in memory
+        """
+        start = -2 ** 63 if start is None else start
+        end = 2 ** 63 - 1 if end is None else end
+        for segment in self.segments:
+            times, prices = segment.select(selection_id, start, end)
+            if len(times):
+                yield times, prices
+        if selection_id in self.buffer:
+            times, prices = self.buffer[selection_id]
+            low = bisect.bisect_left(times, start)
+            high = bisect.bisect_left(times, end, low)
+            if high > low:
+                yield times[low:high], prices[low:high]
+
+    def prices(self, selection_id, start=None, end=None) -> list:
+        """
+        It will give the prices of a selection within a time range
+
+        Args:
+            start ([float]): [unix time in seconds, included, None for the first point]
+            end ([float]): [unix time in seconds, excluded, None for the last point]
+
+        Returns:
+            [list]: [(time in seconds, price) in time order]
+        """
+        return [(at / 1000, price / 100)
+                for times, prices in self.columns(selection_id, to_ms(start), to_ms(end))
+                for at, price in zip(times, prices)]
+
+    def ohlc(self, selection_id, interval, start=None, end=None) -> list:
+        """
+        It will downsample the prices of a selection to bars of a fixed interval,
+        aligned on multiples of the interval since the epoch. Intervals without any
+        point have no bar.
+
+        Args:
+            interval ([float]): [seconds]
+
+        Returns:
+            [list]: [{"at", "open", "high", "low", "close", "ticks"} in time order, at is
+                     the start of the bar in seconds]
+        """
+        width = int(round(interval * 1000))
+        if width <= 0:
+            raise ValueError("interval must be positive")
+
+        bars = []
+        bar = None
+        for times, prices in self.columns(selection_id, to_ms(start), to_ms(end)):
+            for at, price in zip(times, prices):
+                bucket = at - at % width
+                if bar is None or bar[0] != bucket:
+                    bar = [bucket, price, price, price, price, 0]
+                    bars.append(bar)
+                bar[2] = max(bar[2], price)
+                bar[3] = min(bar[3], price)
+                bar[4] = price
+                bar[5] += 1
+
+        return [{'at': bucket / 1000, 'open': first / 100, 'high': high / 100, 'low': low / 100,
+                 'close': close / 100, 'ticks': ticks}
+                for bucket, first, high, low, close, ticks in bars]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+def write_prices(history, query, stream) -> int:
+    """
+    It will write the prices or the bars asked by a JSON query as NDJSON
+
+    {"selection": 12, "from": 1700000000, "to": 1700003600, "interval": 60}
+
+    Raises:
+        [ValueError]: [when the query has no selection or a bad interval]
+
+    Returns:
+        [int]: [lines written]
+    """
+    query = json.loads(query)
+    if not isinstance(query, dict) or 'selection' not in query:
+        raise ValueError("no selection")
+    selection_id, start, end = int(query['selection']), query.get('from'), query.get('to')
+    if query.get('interval') is not None:
+        lines = history.ohlc(selection_id, float(query['interval']), start, end)
+    else:
+        lines = [{'at': at, 'price': price} for at, price in history.prices(selection_id, start, end)]
+    for line in lines:
+        stream.write(json.dumps(line) + "\n")
+    stream.flush()
+    return len(lines)
+
+
+def to_ms(seconds):
+    return None if seconds is None else int(round(float(seconds) * 1000))
@@ -1,11 +1,27 @@
 from sqlalchemy.orm import session
 import unittest
-from sqlalchemy import create_engine, Column, Table, Column, Integer, String, MetaData, ForeignKey, text, delete, update
+from sqlalchemy import create_engine, Column, Table, Column, Integer, String, MetaData, ForeignKey, text, delete, update, select, func
 from sqlalchemy.orm import Session, relationship, session
 import sqlalchemy
+import io
+import json
+import os
+import tempfile
+import shutil
+import threading
+import asyncio
 
 # Use the default method for abstracting classes to tables
 from app import *
+import app
+from docopt import docopt
+import bench_app
+import async_app
+import history_app
+try:
+    import columnar_app
+except ImportError:
+    columnar_app = None
 
 
 class SimpleTest(unittest.TestCase):
@@ -14,12 +30,31 @@ class SimpleTest(unittest.TestCase):
     element_id = None
     # for the sake of time constraint not created test db
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        # the tests share a copy of app.sqlite, init_db() upgrades the copy
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, 'app.sqlite')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.sqlite'), cls.path)
+        return super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.directory)
+        return super().tearDownClass()
+
     def setUp(self) -> None:
-        engine = create_engine("sqlite:///app.sqlite")
+        engine = create_engine("sqlite:///" + self.path)
+        init_db(engine)
         self.conn = engine.connect()
         self.session = Session(bind=engine)
         return super().setUp()
 
+    def tearDown(self) -> None:
+        self.session.close()
+        self.conn.close()
+        return super().tearDown()
+
     def test_add(self):
         args = {'--help': False,
                 '--version': False,
@@ -82,5 +117,761 @@ class SimpleTest(unittest.TestCase):
             self.conn, self.session, args), 1)
 
 
+
+class TempDBTest(unittest.TestCase):
+    """
+    Runs against a fresh database, so tests can check exact rows
+    """
+
+    def setUp(self) -> None:
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        engine = create_engine("sqlite:///" + self.path)
+        init_db(engine)
+        self.conn = engine.connect()
+        self.session = Session(bind=engine)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.session.close()
+        self.conn.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        return super().tearDown()
+
+    def run_command(self, command, element):
+        args = {'-a': command == 'a', '-u': command == 'u', '-d': command == 'd',
+                '-f': False, '<element>': element, '<filter>': None}
+        handler = {'a': add, 'u': update_element, 'd': delete_element}[command]
+        return handler(self.conn, self.session, args)
+
+    def add_fixtures(self):
+        self.run_command('a', '{"sport":{"name": "football", "display_name": "Football", "slug": "football", "order":1, "active": 0}}')
+        self.run_command('a', '{"event":{"sport_id":"1", "name": "France vs England", "status": 0, "slug": "france_vs_england", "type":"0"}}')
+        self.run_command('a', '{"market":{"name": "full time result", "display_name": "Full Time Result", "order":"1", "schema":"2", "columns":"3"}}')
+        self.run_command('a', '{"selection":{"market_id":"1", "event_id":"1", "name": "France", "price": "1.85", "outcome": "win"}}')
+        self.run_command('a', '{"selection":{"market_id":"1", "event_id":"1", "name": "England", "price": "2.10", "outcome": "lose"}}')
+
+    def active(self, table, row_id):
+        return self.conn.execute(text("select active, active_children from " + table +
+                                      " where id = " + str(row_id))).first()
+
+
+class SchemaTest(TempDBTest):
+
+    def test_schema_version(self):
+        self.assertEqual(self.conn.execute(
+            text("PRAGMA user_version")).scalar(), SCHEMA_VERSION)
+
+        # a current schema is not inspected again
+        self.conn.execute(text("drop index sportactivechildrenindex"))
+        init_db(create_engine("sqlite:///" + self.path))
+        self.assertIsNone(self.conn.execute(text(
+            "select name from sqlite_master where name = 'sportactivechildrenindex'")).scalar())
+
+
+    def test_unique_pairs_migration(self):
+        self.add_fixtures()
+        # a database of version 3 with a pair added twice
+        self.conn.execute(text("drop index marketeventpairindex"))
+        self.conn.execute(text("insert into marketevents(market_id, event_id, active, active_children) values (1, 1, 1, 1)"))
+        self.conn.execute(text("insert into selections(marketevent_id, name, price, outcome, active) values (2, 'Draw', 3.5, 0, 1)"))
+        self.conn.execute(text("create index sportnameindex on sports(name)"))
+        self.conn.execute(text("PRAGMA user_version = 3"))
+
+        init_db(create_engine("sqlite:///" + self.path))
+        self.assertEqual(self.conn.execute(text("select id, active_children from marketevents")).fetchall(), [(1, 3)])
+        self.assertEqual(self.conn.execute(text("select count(*) from selections where marketevent_id = 1")).scalar(), 3)
+        self.assertIsNone(self.conn.execute(text(
+            "select name from sqlite_master where name = 'sportnameindex'")).scalar())
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            self.conn.execute(text("insert into marketevents(market_id, event_id) values (1, 1)"))
+
+    def test_hot_queries_use_indexes(self):
+        hot = [(lookup_statement(MarketEvent, 'market_id', 'event_id'), {'market_id': 1, 'event_id': 1}),
+               (lookup_statement(Event, 'sport_id', limit=1), {'sport_id': 1}),
+               (lookup_statement(MarketEvent, 'event_id', limit=1), {'event_id': 1}),
+               (lookup_statement(MarketEvent, 'market_id', limit=1), {'market_id': 1}),
+               (lookup_statement(Selection, 'marketevent_id'), {'marketevent_id': 1}),
+               (select(func.count()).where(Event.sport_id == 1, Event.active == True), {}),
+               (select(func.count()).where(MarketEvent.event_id == 1, MarketEvent.active == True), {}),
+               (select(func.count()).where(Selection.marketevent_id == 1, Selection.active == True), {})]
+        for statement, values in hot:
+            compiled = statement.compile(self.conn)
+            parameters = compiled.construct_params(values)
+            plan = self.conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled),
+                                             tuple(parameters[name] for name in compiled.positiontup)).fetchall()
+            details = [row[-1] for row in plan]
+            self.assertFalse([detail for detail in details if detail.startswith("SCAN")],
+                             str(compiled) + " " + str(details))
+
+
+class ProfileTest(TempDBTest):
+
+    def test_profile_pragmas(self):
+        config = dict(DB_CONFIG_DEFAULTS, url="sqlite:///" + self.path, profile='fast')
+        with get_engine(config).connect() as conn:
+            self.assertEqual(conn.execute(text("PRAGMA journal_mode")).scalar(), 'wal')
+            self.assertEqual(conn.execute(text("PRAGMA synchronous")).scalar(), 1)
+
+        with get_engine(config, read_only=True).connect() as conn:
+            self.assertEqual(conn.execute(text("select count(*) from sports")).scalar(), 0)
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                conn.execute(text("delete from sports"))
+
+
+class InstrumentationTest(TempDBTest):
+
+    def test_command_counters(self):
+        metrics = self.path + '.metrics'
+        self.addCleanup(lambda: os.path.exists(metrics) and os.remove(metrics))
+        instrumentation = Instrumentation(metrics)
+        engine = get_engine(dict(DB_CONFIG_DEFAULTS, url="sqlite:///" + self.path),
+                            instrumentation=instrumentation)
+        self.session.close()
+        self.conn.close()
+        self.conn = engine.connect()
+        self.session = Session(bind=engine)
+
+        self.add_fixtures()
+        record = instrumentation.end_command(command_name({'-a': True, '<element>': '{"selection": {}}'}))
+        self.assertEqual(record['command'], '-a selection')
+        self.assertGreaterEqual(record['by_kind']['insert'], 5)
+        self.assertGreaterEqual(record['rows'], 5)
+        self.assertEqual(sum(record['latency_ms'].values()), record['statements'])
+
+        self.conn.execute(text("select * from sports")).fetchall()
+        second = instrumentation.end_command("-f sport")
+        self.assertEqual((second['statements'], second['rows']), (1, 0))
+        self.assertEqual(instrumentation.report()['statements'],
+                         record['statements'] + 1)
+
+        with open(metrics) as lines:
+            self.assertEqual([json.loads(line)['command'] for line in lines], ['-a selection', '-f sport'])
+
+        # a failed statement is counted and does not leave its start behind
+        with self.assertRaises(SQLAlchemyError):
+            self.conn.execute(text("select * from missing_table"))
+        failed = instrumentation.end_command("-f sport")
+        self.assertEqual((failed['statements'], failed['errors']), (1, 1))
+        self.assertEqual(self.conn.info['statement_started'], [])
+
+    def test_slow_queries_advise_index(self):
+        slow_log = self.path + '.slow'
+        self.addCleanup(lambda: os.path.exists(slow_log) and os.remove(slow_log))
+        self.add_fixtures()
+        self.conn.execute(text("drop index eventsportactiveindex"))
+        engine = get_engine(dict(DB_CONFIG_DEFAULTS, url="sqlite:///" + self.path),
+                            instrumentation=Instrumentation(slow_ms=0, slow_log=slow_log))
+        self.conn.close()
+        self.conn = engine.connect()
+
+        args = {'-f': True, '<filter>': '{"on": "event", "filters": [{"field": "sport_id", "op": "eq", "value": 1}]}'}
+        self.assertIn("SCAN events", explain_search(self.conn, self.session, args))
+        suggestions = advise_indexes(self.conn, slow_log)
+        self.assertEqual([(s['table'], s['index']) for s in suggestions if s['table'] == 'events'],
+                         [('events', 'CREATE INDEX events_sport_id_index ON events (sport_id)')])
+
+    def test_advise_missing_log(self):
+        args = docopt(app.__doc__, argv=['--advise', self.path + '.missing'])
+        engine = create_engine("sqlite:///" + self.path)
+        self.assertEqual(run_cli(args, DB_CONFIG_DEFAULTS, engine, self.conn, self.session),
+                         "no slow query log at " + self.path + ".missing: No such file or directory")
+
+
+class BulkTest(TempDBTest):
+
+    def test_bulk_add(self):
+        lines = [
+            '{"sport":{"name": "football", "display_name": "Football", "slug": "football", "order":1, "active": 0}}',
+            '{"event":{"sport_id":1, "name": "France vs England", "status": 0, "slug": "france_vs_england", "type":"0"}}',
+            '{"market":{"name": "full time result", "display_name": "Full Time Result", "order":"1", "schema":"2", "columns":"3"}}',
+            '{"selection":{"market_id":"1", "event_id":"1", "name": "France", "price": "1.85", "outcome": "win"}}',
+            '{"selection":{"market_id":"1", "event_id":"1", "name": "England", "price": "2.10", "outcome": "lose"}}',
+            '{"selection":{"market_id":"1", "event_id":"1", "name": "France", "price": "1.85", "outcome": "win"}}',
+            '{"event":{"sport_id":9, "name": "Spain vs Italy", "status": 0, "slug": "spain_vs_italy", "type":"0"}}',
+            'not json']
+        response = bulk_add(self.conn, io.StringIO("\n".join(lines)), 3)
+
+        self.assertEqual(response['rows'], 5)
+        self.assertEqual(response['errors'], 3)
+        # one market event for both selections of the pair
+        self.assertEqual(self.conn.execute(
+            text("select count(*) from marketevents")).scalar(), 1)
+        self.assertEqual(self.conn.execute(
+            text("select active from sports where id = 1")).scalar(), 1)
+
+
+    def test_parallel_bulk_add(self):
+        lines = list(bench_app.generate(1, 4, 2, (1, 3), seed=3)) + ['{"event":{"sport_id":"x"}}']
+        response = parallel_bulk_add(self.conn, lines, 5, workers=2)
+
+        self.assertEqual((response['rows'], response['errors']), (len(lines) - 1, 1))
+        self.assertEqual(set(response['stages']), {'parse', 'write'})
+        self.assertEqual(tuple(self.active('sports', 1)), (1, 4))
+
+    def test_generated_data(self):
+        lines = list(bench_app.generate(2, 3, 2, (1, 3), seed=7))
+        self.assertEqual(lines, list(bench_app.generate(2, 3, 2, (1, 3), seed=7)))
+
+        response = bulk_add(self.conn, lines)
+        self.assertEqual((response['rows'], response['errors']), (len(lines), 0))
+        self.assertEqual(self.conn.execute(
+            text("select count(*) from marketevents")).scalar(), 2 * 3 * 2)
+
+
+class SettlementTest(TempDBTest):
+
+    def test_settle_event(self):
+        self.add_fixtures()
+        response = settle(self.conn, {"event": 1, "outcomes": {"1": "Win"}, "default": "lose"})
+
+        self.assertEqual(response, {'selections': 2, 'deactivated': 2})
+        self.assertEqual(self.conn.execute(text("select outcome, active from selections order by id")).fetchall(),
+                         [('win', 0), ('lose', 0)])
+        # the last active selections take their parents down
+        for table in ('marketevents', 'markets', 'events', 'sports'):
+            self.assertEqual(tuple(self.active(table, 1)), (0, 0))
+
+    def test_bad_settlement(self):
+        self.add_fixtures()
+        with self.assertRaises(ValueError):
+            settle(self.conn, {"event": 1, "outcomes": {"1": "won"}})
+        with self.assertRaises(ValueError):
+            settle(self.conn, {"market": 1, "event": 2, "outcomes": {"1": "win"}})
+        # nothing was written
+        self.assertEqual(self.conn.execute(text("select count(*) from selections where active = 1")).scalar(), 2)
+        self.assertEqual(tuple(self.active('sports', 1)), (1, 1))
+
+
+class TreeTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+        self.run_command('a', '{"event":{"sport_id":"1", "name": "Spain vs Italy", "status": 0, "slug": "spain_vs_italy", "type":"0"}}')
+        self.run_command('a', '{"selection":{"market_id":"1", "event_id":"2", "name": "Spain", "price": "1.50", "outcome": "win"}}')
+        self.run_command('u', '{"selection":{"id":2, "values": {"active": 0}}}')
+
+    def test_nested_tree(self):
+        tree = fetch_tree(self.conn, 'sport', 1)
+        self.assertEqual([event['name'] for event in tree['events']], ["France vs England", "Spain vs Italy"])
+        self.assertEqual([[selection['name'] for selection in market['selections']]
+                          for market in tree['events'][0]['markets']], [["France", "England"]])
+
+        active = fetch_tree(self.conn, 'event', 1, active_only=True)
+        self.assertEqual([selection['id'] for selection in active['markets'][0]['selections']], [1])
+        self.assertIsNone(fetch_tree(self.conn, 'sport', 9))
+        with self.assertRaises(ValueError):
+            fetch_tree(self.conn, 'market', 1)
+
+    def test_streamed_tree(self):
+        instrumentation = Instrumentation()
+        engine = instrumentation.attach(create_engine("sqlite:///" + self.path))
+        with engine.connect() as conn:
+            stream = io.StringIO()
+            response = write_tree(conn, 'sport', 1, stream, batch_size=1)
+            # sport, events, then markets and selections per batch of events
+            self.assertEqual(instrumentation.end_command('--tree')['statements'], 2 + 2 * 2)
+            self.assertEqual(response, {'found': True, 'events': 2})
+            self.assertEqual(json.loads(stream.getvalue()),
+                             json.loads(json.dumps(fetch_tree(conn, 'sport', 1), default=str)))
+
+
+class TickTest(TempDBTest):
+
+    def test_coalesced_ticks(self):
+        self.add_fixtures()
+        lines = ['1 1.90', '1,1.95', '{"id": 2, "price": "2.204"}', '2 x', '1 1.99']
+        response = ingest_ticks(self.conn, lines, window=60)
+
+        # one window at the end of the stream, the last price of each selection wins
+        self.assertEqual((response['ticks'], response['errors']), (4, 1))
+        self.assertEqual((response['updates'], response['windows']), (2, 1))
+        self.assertEqual(self.conn.execute(text("select price from selections order by id")).fetchall(),
+                         [(1.99,), (2.2,)])
+
+
+class LookupTest(TempDBTest):
+
+    def test_lookups(self):
+        self.add_fixtures()
+        self.assertEqual(get_by_id(self.conn, Selection, "2").name, "England")
+        self.assertIsNone(get_by_id(self.conn, Sport, 9))
+        self.assertEqual(get_marketevent(self.conn, "1", 1).id, 1)
+        self.assertEqual([row.name for row in get_children(self.conn, Event, 'sport_id', 1)],
+                         ["France vs England"])
+        # ids are bound parameters, never SQL
+        with self.assertRaises(ValueError):
+            get_by_id(self.conn, Sport, "1 or 1=1")
+
+
+class HierarchyCacheTest(TempDBTest):
+
+    def test_lru_eviction(self):
+        cache = HierarchyCache(maxsize=2)
+        cache.put(('event', 1), 1)
+        cache.put(('event', 2), 1)
+        cache.get(('event', 1))
+        cache.put(('event', 3), 2)
+
+        # the least recently used key goes first
+        self.assertIsNone(cache.get(('event', 2)))
+        self.assertEqual(cache.get(('event', 1)), 1)
+        self.assertEqual({key: cache.stats()[key] for key in ('hits', 'misses', 'evictions')},
+                         {'hits': 2, 'misses': 1, 'evictions': 1})
+
+    def test_write_paths(self):
+        self.add_fixtures()
+        cache = hierarchy_cache(self.conn)
+        # the second selection of the pair found its market event in the cache
+        self.assertEqual(cache.get(('pair', 1, 1)), 1)
+        self.assertGreater(cache.hits, 0)
+
+        # moving both selections away deletes the old market event and forgets it
+        self.run_command('a', '{"event":{"sport_id":"1", "name": "Spain vs Italy", "status": 0, "slug": "spain_vs_italy", "type":"0"}}')
+        self.run_command('u', '{"selection":{"id":1, "values": {"event_id": "2"}}}')
+        self.run_command('u', '{"selection":{"id":2, "values": {"event_id": "2"}}}')
+        self.assertIsNone(cache.get(('pair', 1, 1)))
+        self.assertEqual(cache.get(('pair', 1, 2)), 2)
+        self.assertEqual(tuple(self.active('events', 1)), (0, 0))
+        self.assertEqual(tuple(self.active('events', 2)), (1, 1))
+
+
+class PropagationTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+
+    def test_activation(self):
+        self.assertEqual(tuple(self.active('marketevents', 1)), (1, 2))
+        self.assertEqual(tuple(self.active('markets', 1)), (1, 2))
+        self.assertEqual(tuple(self.active('events', 1)), (1, 1))
+        self.assertEqual(tuple(self.active('sports', 1)), (1, 1))
+
+    def test_deactivation(self):
+        self.run_command('u', '{"selection":{"id":1, "values": {"active": 0}}}')
+        self.assertEqual(tuple(self.active('markets', 1)), (1, 1))
+        self.assertEqual(tuple(self.active('events', 1)), (1, 1))
+
+        # last active selection turns everything above it inactive
+        self.run_command('d', '{"selection":{"id":2}}')
+        self.assertEqual(tuple(self.active('marketevents', 1)), (0, 0))
+        self.assertEqual(tuple(self.active('markets', 1)), (0, 0))
+        self.assertEqual(tuple(self.active('events', 1)), (0, 0))
+        self.assertEqual(tuple(self.active('sports', 1)), (0, 0))
+
+        self.run_command('u', '{"selection":{"id":1, "values": {"active": 1}}}')
+        self.assertEqual(tuple(self.active('sports', 1)), (1, 1))
+
+    def test_active_threshold(self):
+        args = {'-f': True, '<element>': None, '<filter>': '{"active": "1"}'}
+        rows = search(self.conn, self.session, args).fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+                         [('markets', 1, 'full time result', 2)])
+
+    def test_rebuild_counts(self):
+        self.conn.execute(text("update markets set active_children = 0"))
+        rebuild_counts(self.conn)
+        self.assertEqual(tuple(self.active('markets', 1)), (1, 2))
+
+
+
+class FilterTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+
+    def filter(self, parameters):
+        args = {'-f': True, '<element>': None,
+                '<filter>': json.dumps(parameters)}
+        return [row.name for row in search(self.conn, self.session, args)]
+
+    def test_and_filters(self):
+        self.assertEqual(self.filter({"on": "selection", "filters": [
+            {"field": "name", "op": "regex", "value": "^(France|England)$"},
+            {"field": "event_id", "op": "eq", "value": 1},
+            {"field": "price", "op": "range", "value": [2, None]}]}), ['England'])
+        self.assertEqual(self.filter({"on": "event", "filters": [
+            {"field": "name", "op": "like", "value": "%england"},
+            {"op": "min_active", "value": 1}]}), [])
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            self.filter({"on": "sport", "filters": [
+                {"field": "sport_id", "op": "eq", "value": 1}]})
+
+
+
+class PageTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+
+    def pages(self, parameters):
+        rows, cursor = [], None
+        while True:
+            page = search_page(self.conn, dict(parameters, cursor=cursor))
+            rows.extend(tuple(row) for row in page)
+            cursor = page.next_cursor
+            if cursor is None:
+                return rows
+
+    def test_keyset_pages(self):
+        everything = [tuple(row) for row in keyword_search(self.conn, 'all', 'fr')]
+        rows = self.pages({'all': 'fr', 'limit': 1})
+        self.assertEqual([row[:2] for row in rows], sorted(row[:2] for row in everything))
+        self.assertEqual([row[:2] for row in rows],
+                         [('events', 1), ('selections', 1)])
+
+        self.assertEqual([row[:2] for row in self.pages({'active': 0, 'limit': 2})],
+                         [('events', 1), ('markets', 1), ('sports', 1)])
+        self.assertEqual([row[0] for row in self.pages({'on': 'selection', 'filters': [], 'limit': 1})], [1, 2])
+
+        page = search_page(self.conn, {'selection': 'fr', 'limit': 5})
+        self.assertIsNone(page.next_cursor)
+        self.assertIn('"cursor": null', response_json(page))
+
+    def test_bad_cursor(self):
+        with self.assertRaises(ValueError):
+            search_page(self.conn, {'all': 'fr', 'limit': 1, 'cursor': 'xx'})
+        with self.assertRaises(ValueError):
+            search_page(self.conn, {'event': 'fr', 'limit': 1, 'cursor': encode_cursor('sports', 1)})
+        with self.assertRaises(ValueError):
+            search_page(self.conn, {'all': 'fr', 'limit': 0})
+
+
+@unittest.skipUnless(columnar_app, "numpy is not installed")
+class ColumnarTest(TempDBTest):
+
+    SEARCHES = [
+        {"on": "selection", "filters": [{"field": "price", "op": "range", "value": [1.5, 20]}]},
+        {"on": "selection", "filters": [{"field": "name", "op": "regex", "value": "^e[0-9] m[12]"},
+                                        {"field": "event_id", "op": "range", "value": [2, 4]}]},
+        {"on": "selection", "filters": [{"field": "outcome", "op": "eq", "value": "unsettled"}]},
+        {"on": "event", "filters": [{"field": "name", "op": "like", "value": "TEAM 1%"},
+                                    {"op": "min_active", "value": 1}]},
+        {"on": "market", "filters": [{"field": "active", "op": "eq", "value": 1}]},
+        {"on": "sport", "filters": []},
+        {"active": "2"},
+    ]
+
+    def setUp(self) -> None:
+        super().setUp()
+        bulk_add(self.conn, bench_app.generate(2, 5, 3, (2, 4), seed=5))
+
+    def assertSameRows(self, snapshot):
+        for parameters in self.SEARCHES:
+            args = {'<filter>': json.dumps(parameters)}
+            expected = [tuple(row) for row in search(self.conn, self.session, args)]
+            found = [tuple(row) for row in snapshot.search(parameters)]
+            # the union of the active search has no order
+            if 'active' in parameters:
+                expected, found = sorted(expected), sorted(found)
+            self.assertEqual(found, expected, parameters)
+
+    def test_same_rows_after_writes(self):
+        snapshot = columnar_app.ColumnarSnapshot.load(self.conn)
+        self.assertSameRows(snapshot)
+
+        self.run_command('u', '{"selection":{"id":3, "values": {"price": "7.25", "active": 0}}}')
+        self.run_command('u', '{"event":{"id":2, "values": {"name": "team 100 vs team 101"}}}')
+        self.run_command('d', '{"selection":{"id":5}}')
+        self.run_command('a', '{"selection":{"market_id":"1", "event_id":"3", "name": "e3 m1 new", "price": "1.60", "outcome": "win"}}')
+        self.assertGreater(snapshot.refresh(self.conn), 0)
+        self.assertSameRows(snapshot)
+        self.assertEqual(snapshot.refresh(self.conn), 0)
+
+        for table, counts in snapshot.active_children_counts().items():
+            stored = [row[0] for row in self.conn.execute(
+                text("select active_children from " + table + " order by id"))]
+            self.assertEqual(counts.tolist(), stored, table)
+
+        # changes the snapshot never read are pruned, it reads the tables again
+        seq = snapshot.seq
+        self.run_command('u', '{"selection":{"id":4, "values": {"price": "9.50"}}}')
+        self.run_command('u', '{"selection":{"id":6, "values": {"price": "9.75"}}}')
+        prune_changes(self.conn, seq + 1)
+        self.assertGreater(snapshot.refresh(self.conn), 2)
+        self.assertSameRows(snapshot)
+
+    def test_sql_fallback(self):
+        snapshot = columnar_app.ColumnarSnapshot.load(self.conn)
+        with self.assertRaises(columnar_app.Unsupported):
+            snapshot.search({"all": "team"})
+        with self.assertRaises(ValueError):
+            snapshot.search({"on": "event", "filters": [{"field": "price", "op": "eq", "value": 1}]})
+
+        args = {'<filter>': json.dumps({"event": "team"})}
+        self.assertEqual(len(search(self.conn, self.session, args, snapshot).fetchall()), 10)
+
+
+class ExportTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+        return super().tearDown()
+
+    def test_export_import(self):
+        engine = create_engine("sqlite:///" + self.path)
+        copy = os.path.join(self.directory, 'copy.sqlite')
+        export_db(engine, copy, pages=1)
+
+        # a new database holds the same rows and counters
+        target = create_engine("sqlite:///" + os.path.join(self.directory, 'target.sqlite'))
+        import_db(target, copy)
+        with target.connect() as conn:
+            for table in ('sports', 'events', 'marketevents', 'selections'):
+                query = text("select * from " + table + " order by id")
+                self.assertEqual(conn.execute(query).fetchall(), self.conn.execute(query).fetchall())
+
+        with open(os.path.join(self.directory, 'bad.sqlite'), 'w') as bad:
+            bad.write("not a database")
+        with self.assertRaises(ValueError):
+            import_db(target, bad.name)
+        with self.assertRaises(ValueError):
+            import_db(target, os.path.join(self.directory, 'missing.sqlite'))
+
+    @unittest.skipUnless(columnar_app, "numpy is not installed")
+    def test_mapped_snapshot(self):
+        snapshot = columnar_app.ColumnarSnapshot.load(self.conn)
+        snapshot.save(self.directory)
+        mapped = columnar_app.ColumnarSnapshot.open(self.directory)
+
+        search = {"on": "selection", "filters": [{"field": "price", "op": "range", "value": [1, 2]}]}
+        self.assertEqual(mapped.search(search).fetchall(), snapshot.search(search).fetchall())
+
+        # writes after the snapshot are read from the changes
+        self.run_command('u', '{"selection":{"id":2, "values": {"price": "1.95"}}}')
+        mapped.refresh(self.conn)
+        self.assertEqual([row[0] for row in mapped.search(search)], [1, 2])
+
+
+class ChangeFeedTest(TempDBTest):
+
+    def test_tail(self):
+        self.add_fixtures()
+        added = read_changes(self.conn, 0)
+        self.assertEqual(added[0], {'seq': 1, 'element': 'sports', 'id': 1, 'op': 'i', 'row': {
+            'id': 1, 'name': 'football', 'display_name': 'Football', 'slug': 'football',
+            'order': 1, 'active': 0, 'active_children': 0}})
+        seq = added[-1]['seq']
+
+        # the cascade is recorded with the write, a write changing nothing is not
+        self.run_command('u', '{"selection":{"id":1, "values": {"active": 0}}}')
+        self.run_command('u', '{"selection":{"id":1, "values": {"active": 0}}}')
+        self.run_command('u', '{"selection":{"id":2, "values": {"active": 0}}}')
+        self.run_command('d', '{"selection":{"id":2}}')
+
+        stream = io.StringIO()
+        response = tail_changes(self.conn, seq, stream, batch_size=2)
+        changes = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(response, {'changes': len(changes), 'seq': changes[-1]['seq']})
+        self.assertEqual([change['seq'] for change in changes], list(range(seq + 1, seq + 1 + len(changes))))
+        self.assertEqual((changes[0]['element'], changes[0]['id']), ('selections', 1))
+        self.assertLessEqual({'markets', 'marketevents', 'events'}, {change['element'] for change in changes})
+        self.assertIn(('sports', 1, 0), [(change['element'], change['id'], change['row'].get('active'))
+                                         for change in changes if change['op'] == 'u'])
+        self.assertEqual(changes[-1], {'seq': changes[-1]['seq'], 'element': 'selections', 'id': 2,
+                                       'op': 'd', 'row': None})
+        self.assertEqual(read_changes(self.conn, response['seq']), [])
+        # updates record only the columns they changed
+        self.assertEqual(changes[0]['row'], {'id': 1, 'active': 0})
+
+        # the last change is always kept
+        last = response['seq']
+        self.assertEqual(prune_changes(self.conn, seq), seq)
+        self.assertEqual(read_changes(self.conn, 0)[0]['seq'], seq + 1)
+        prune_changes(self.conn, last)
+        self.assertEqual([change['seq'] for change in read_changes(self.conn, 0)], [last])
+
+
+class PriceHistoryTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.add_fixtures()
+        for price in ("1.50", "1.60", "1.40", "1.55"):
+            self.run_command('u', '{"selection":{"id":1, "values": {"price": "' + price + '"}}}')
+        # not a price change
+        self.run_command('u', '{"selection":{"id":1, "values": {"name": "Les Bleus"}}}')
+        # one selection write a second, from 999 seconds after the epoch
+        self.conn.execute(text("update changes set at = 999 + (select count(*) from changes c \
+            where c.element = 'selections' and c.seq < changes.seq) where element = 'selections'"))
+
+    def test_prices_and_ohlc(self):
+        history = history_app.PriceHistory(self.directory)
+        self.addCleanup(history.close)
+        self.assertEqual(history.record(self.conn)['points'], 6)
+        history.flush()
+
+        self.assertEqual(history.prices(1), [(999.0, 1.85), (1001.0, 1.5), (1002.0, 1.6),
+                                             (1003.0, 1.4), (1004.0, 1.55)])
+        self.assertEqual(history.prices(1, 1002, 1004), [(1002.0, 1.6), (1003.0, 1.4)])
+        self.assertEqual(history.prices(2), [(1000.0, 2.1)])
+        self.assertEqual(history.ohlc(1, 3), [
+            {'at': 999.0, 'open': 1.85, 'high': 1.85, 'low': 1.5, 'close': 1.5, 'ticks': 2},
+            {'at': 1002.0, 'open': 1.6, 'high': 1.6, 'low': 1.4, 'close': 1.55, 'ticks': 3}])
+
+        stream = io.StringIO()
+        history_app.write_prices(history, '{"selection": 1, "from": 1003}', stream)
+        self.assertEqual(stream.getvalue(), '{"at": 1003.0, "price": 1.4}\n{"at": 1004.0, "price": 1.55}\n')
+
+    def test_segments_reopen_and_merge(self):
+        # a segment for every point
+        history = history_app.PriceHistory(self.directory, segment_points=1)
+        history.record(self.conn)
+        self.assertEqual(len(history.segments), 6)
+
+        # a merge stopped before removing the segments it merged
+        leftover = history.segments[2].path
+        shutil.copy(leftover, leftover + '.copy')
+        history.merge(history.segments[2:])
+        history.close()
+        os.rename(leftover + '.copy', leftover)
+
+        # queries leave the files to the recorder
+        query = history_app.PriceHistory(self.directory, read_only=True)
+        self.assertEqual([price for at, price in query.prices(1)], [1.85, 1.5, 1.6, 1.4, 1.55])
+        self.assertTrue(os.path.exists(leftover))
+        with self.assertRaises(ValueError):
+            query.record(self.conn)
+        query.close()
+
+        reopened = history_app.PriceHistory(self.directory)
+        self.addCleanup(reopened.close)
+        self.assertEqual(len(reopened.segments), 3)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertEqual([price for at, price in reopened.prices(1)], [1.85, 1.5, 1.6, 1.4, 1.55])
+
+        # only the price changes since the last segment are recorded
+        self.run_command('u', '{"selection":{"id":1, "values": {"name": "France"}}}')
+        self.run_command('u', '{"selection":{"id":1, "values": {"price": "3"}}}')
+        self.assertEqual(reopened.record(self.conn)['points'], 1)
+        self.assertEqual(reopened.prices(1)[-1][1], 3.0)
+
+
+class KeywordSearchTest(TempDBTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_fixtures()
+
+    def keyword(self, element, keyword):
+        args = {'-f': True, '<element>': None,
+                '<filter>': json.dumps({element: keyword})}
+        return [row.name for row in search(self.conn, self.session, args)]
+
+    def test_substring_match(self):
+        self.assertEqual(self.keyword('all', 'fra'),
+                         ['France', 'France vs England'])
+        self.assertEqual(self.keyword('event', 'eng'), ['France vs England'])
+        self.assertEqual(self.keyword('sport', 'ball'), ['football'])
+        self.assertEqual(self.keyword('market', 'time res'), ['full time result'])
+        self.assertEqual(self.keyword('market', '"full'), [])
+
+    def test_same_rows_as_like(self):
+        self.run_command('a', '{"sport":{"name": "a_b 100%", "display_name": "X", "slug": "x", "order":2, "active": 0}}')
+        for element in ('all', 'sport', 'event', 'market', 'selection'):
+            for keyword in ('ball', 'FRANCE', 'vs eng', 'an', 'e', '', 'a_b', 'a%b', '0%', '"full', 'win'):
+                indexed = sorted(tuple(row)[:2] for row in keyword_search(self.conn, element, keyword))
+                scanned = sorted(tuple(row)[:2] for row in self.conn.execute(
+                    keyword_statement(element, False), {'pattern': keyword_pattern(keyword)}))
+                self.assertEqual(indexed, scanned, (element, keyword))
+
+    def test_streaming_output(self):
+        args = {'-f': True, '<element>': None, '<filter>': '{"all": "fra"}'}
+        result = search(self.conn, self.session, args)
+        output = io.StringIO()
+        count = write_rows(list(result.keys()), iter(lambda: result.fetchmany(1), []),
+                           output, 'ndjson', ['type', 'name'])
+
+        self.assertEqual(count, 2)
+        self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()],
+                         [{'type': 'selections', 'name': 'France'}, {'type': 'events', 'name': 'France vs England'}])
+
+    def test_index_follows_writes(self):
+        self.run_command('u', '{"selection":{"id":1, "values": {"name": "Spain"}}}')
+        self.run_command('d', '{"selection":{"id":2}}')
+        self.assertEqual(self.keyword('selection', 'spa'), ['Spain'])
+        self.assertEqual(self.keyword('all', 'england'), ['France vs England'])
+
+
+
+class AsyncStoreTest(TempDBTest):
+
+    def test_concurrent_writes(self):
+        config = dict(DB_CONFIG_DEFAULTS, url="sqlite:///" + self.path, profile='fast')
+
+        async def scenario():
+            async with async_app.AsyncStore(config, batch=8) as store:
+                sport_id = await store.add({"sport": {"name": "football", "display_name": "Football",
+                                                      "slug": "football", "order": 1, "active": 0}})
+                event_ids = await asyncio.gather(*[store.add({"event": {
+                    "sport_id": str(sport_id), "name": "team %d vs team %d" % (n, n + 1), "status": 0,
+                    "slug": "e%d" % n, "type": "0"}}) for n in range(20)])
+                self.assertIsNone(await store.add({"event": {"sport_id": "9", "name": "x", "status": 0,
+                                                             "slug": "x", "type": "0"}}))
+                with self.assertRaises(ValueError):
+                    await store.add({"event": {"sport_id": "one"}})
+
+                names = [row.name async for row in store.search({"event": "team"})]
+                with self.assertRaises(ValueError):
+                    [row async for row in store.search({"on": "event", "filters": [{"field": "x", "op": "eq"}]})]
+                return event_ids, names
+
+        event_ids, names = asyncio.run(scenario())
+        self.assertEqual(sorted(event_ids), list(range(1, 21)))
+        self.assertEqual(len(names), 20)
+        self.assertEqual(tuple(self.active('sports', 1)), (1, 20))
+
+
+class ServerTest(TempDBTest):
+
+    def test_round_trip(self):
+        engine = create_engine("sqlite:///" + self.path,
+                               connect_args={'check_same_thread': False})
+        path = self.path + '.sock'
+        server = make_server(engine, path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            element = {'-a': True, '-u': False, '-d': False, '-f': False, '<element>':
+                       '{"sport":{"name": "football", "display_name": "Football", "slug": "football", "order":1, "active": 0}}'}
+            self.assertEqual(send_command(path, element), {'response': 1})
+
+            search_args = {'-a': False, '-u': False, '-d': False, '-f': True, '<filter>': '{"sport": "foot"}'}
+            reply = send_command(path, search_args)
+            self.assertEqual(reply['rows'][0][:2], [1, 'football'])
+
+            element['<element>'] = '{"sport":{"name": "boxing"}}'
+            self.assertIn('error', send_command(path, element))
+
+            # valid JSON of the wrong shape is answered too
+            search_args['<filter>'] = '{"on": "sport", "filters": ["x"]}'
+            self.assertIn('error', send_command(path, search_args))
+            search_args['<filter>'] = '{"sport": "foot"}'
+            self.assertEqual(send_command(path, search_args)['rows'][0][:2], [1, 'football'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            server.session.close()
+            server.conn.close()
+            os.remove(path)
+
+        self.assertIn('no server on', send_command(path, search_args)['error'])
+
+
 if __name__ == '__main__':
     unittest.main()